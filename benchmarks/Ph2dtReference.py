@@ -0,0 +1,76 @@
+"""Reference outputs of ph2dt for the sample catalog of the tests.
+
+Runs the real ph2dt on tests/data/sample.out with the configuration of
+the repository and keeps dt.ct, event.dat, event.sel and ph2dt.inp in
+tests/data/ph2dt, where tests compare the built-in differential times
+against them. The stand-in of benchmarks/bin is refused.
+
+Usage:
+    python -m benchmarks.Ph2dtReference [outputPath]
+"""
+import os
+import shutil
+import sys
+from tempfile import TemporaryDirectory
+
+from core.Catalog import loadCatalog
+from core.Config import readConfiguration, readHypoddConfig
+from core.Extra import loadVelocityFile
+from core.Input import prepareHypoddInputs
+from core.Runner import runPh2dt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = os.path.join(ROOT, "tests", "data")
+STATION_FILE = os.path.join(DATA, "usedStations.csv")
+REFERENCE_FILES = ["dt.ct", "event.dat", "event.sel", "ph2dt.inp"]
+
+
+def realPh2dt():
+    """Path of ph2dt on PATH, if it is not the stand-in of benchmarks"""
+    program = shutil.which("ph2dt")
+    if program is None:
+        return None
+    standIns = os.path.join(ROOT, "benchmarks", "bin")
+    if os.path.dirname(os.path.realpath(program)) == standIns:
+        return None
+    return program
+
+
+def makeReference(config, hypoddConfig, path):
+    """Run ph2dt on the sample catalog
+
+    Args:
+        config (dict): configuration parameters
+        hypoddConfig (dict): hypoDD configuration parameters
+        path (str): directory of ph2dt inputs and outputs
+
+    Returns:
+        str: path
+    """
+    with TemporaryDirectory() as tmp:
+        catalog = loadCatalog(os.path.join(DATA, "sample.out"), tmp)
+        prepareHypoddInputs(config, hypoddConfig, catalog, STATION_FILE,
+                            loadVelocityFile(config), path, path)
+    runPh2dt(config, path=path)
+    return path
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    outputPath = argv[0] if argv else os.path.join(DATA, "ph2dt")
+    if realPh2dt() is None:
+        print("+++ ph2dt is not installed! Aborting ...")
+        return 1
+    config = readConfiguration(os.path.join(ROOT, "config.yml"))
+    hypoddConfig = readHypoddConfig(os.path.join(ROOT, "files", "hypodd.yml"))
+    os.makedirs(outputPath, exist_ok=True)
+    with TemporaryDirectory() as tmp:
+        makeReference(config, hypoddConfig, tmp)
+        for f in REFERENCE_FILES:
+            shutil.copy(os.path.join(tmp, f), outputPath)
+    print(f"+++ ph2dt reference written to {outputPath} ...")
+    return 0
+
+
+if "__main__" == __name__:
+    sys.exit(main())
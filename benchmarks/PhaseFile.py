@@ -0,0 +1,42 @@
+"""Throughput benchmark of the phase file writer.
+
+Usage:
+    python -m benchmarks.PhaseFile DB/Golestan.out [repeat]
+"""
+import os
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from core.Catalog import iterEvents, loadCatalog
+from core.Input import writePhaseFile
+
+
+def benchmarkPhaseFile(catalog, repeat=3):
+    """Time writing phase.dat for a whole catalog
+
+    Args:
+        catalog (dict): catalog tables
+        repeat (int, optional): number of runs, the best one is kept.
+
+    Returns:
+        dict: number of events, best wall time and throughput
+    """
+    best = float("inf")
+    with TemporaryDirectory() as tmp:
+        phaseFile = os.path.join(tmp, "phase.dat")
+        for _ in range(repeat):
+            st = perf_counter()
+            nEvents = writePhaseFile(iterEvents(catalog), phaseFile)
+            best = min(best, perf_counter() - st)
+    return {"events": nEvents,
+            "seconds": best,
+            "eventsPerSecond": nEvents/best if best else float("inf")}
+
+
+if "__main__" == __name__:
+    catalog = loadCatalog(sys.argv[1])
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    result = benchmarkPhaseFile(catalog, repeat)
+    print(f"+++ Wrote {result['events']} events in {result['seconds']:.3f} s \
+({result['eventsPerSecond']:.0f} events/s)")
@@ -0,0 +1,102 @@
+"""Startup time of the command line entry point.
+
+Each command is timed in a fresh interpreter, up to the point where its
+work would start: reading main.py and importing what the command needs.
+
+Usage:
+    python -m benchmarks.Startup --output startup.json
+    python -m benchmarks.Startup --baseline startup.json
+"""
+import json
+import platform
+import subprocess
+import sys
+from argparse import ArgumentParser
+from datetime import datetime
+from time import perf_counter
+
+from pandas import DataFrame
+
+from benchmarks.Suite import compareBaseline
+
+COMMANDS = {"help": "import main; main.parseArguments(['run'])",
+            "prepare-stations": "import main; "
+            "from core.PrepareInputs import CreatInputStationFile",
+            "locate": "import main; from core.Locate import locateHypoDD",
+            "optimize": "import main; from core.Optimizer import optimizeHypoDD",
+            "plot": "import main; from core.Visulize import plotSeismicityMap",
+            "figures": "import main; from core.Figures import plotFigures"}
+HEAVY_MODULES = ["obspy", "proplot", "seaborn", "skopt", "requests", "bs4"]
+
+
+def timeCommand(code, repeat):
+    """Best wall time of running code in a fresh interpreter
+
+    Args:
+        code (str): python code to run
+        repeat (int): number of runs
+
+    Returns:
+        dict: best time in s, heavy modules imported and error, if any
+    """
+    probe = (f"{code}\nimport sys\nprint(' '.join(m for m in "
+             f"{HEAVY_MODULES!r} if m in sys.modules))")
+    best = float("inf")
+    for _ in range(repeat):
+        st = perf_counter()
+        proc = subprocess.run([sys.executable, "-c", probe],
+                              capture_output=True, text=True)
+        elapsed = perf_counter() - st
+        if proc.returncode:
+            return {"seconds": elapsed, "heavy": "",
+                    "error": proc.stderr.strip().splitlines()[-1]}
+        best = min(best, elapsed)
+    return {"seconds": best,
+            "heavy": proc.stdout.strip().splitlines()[-1]
+            if proc.stdout.strip() else "",
+            "error": None}
+
+
+def parseArguments(argv=None):
+    parser = ArgumentParser(description="Benchmark startup time of the "
+                            "command line entry point.")
+    parser.add_argument("--commands", nargs="+", default=list(COMMANDS),
+                        choices=list(COMMANDS), help="commands to time")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="runs per command, the best one is kept")
+    parser.add_argument("--output", default=None,
+                        help="write results to this JSON file")
+    parser.add_argument("--baseline", default=None,
+                        help="compare against this JSON results file")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="tolerated relative slowdown")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArguments(argv)
+    results = {"startup": {command: timeCommand(COMMANDS[command],
+                                                args.repeat)
+                           for command in args.commands}}
+    report = DataFrame([{"command": command, **result}
+                        for command, result in results["startup"].items()])
+    print(report.to_string(index=False, float_format="%.3f"))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "date": datetime.now().isoformat(timespec="seconds"),
+                       "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        comparison = compareBaseline(results, baseline, args.threshold)
+        print(comparison.to_string(index=False, float_format="%.3f"))
+        if comparison.regression.any():
+            print("+++ Startup time regression detected!")
+            return 1
+    return 0
+
+
+if "__main__" == __name__:
+    sys.exit(main())
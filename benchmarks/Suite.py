@@ -0,0 +1,279 @@
+"""End-to-end benchmarks of the relocation pipeline on synthetic catalogs.
+
+Each stage runs in a forked child process, so its wall time and peak
+resident memory are measured on their own. The ph2dt and hypoDD stand-ins
+of benchmarks/bin are used unless --real is given.
+
+Usage:
+    python -m benchmarks.Suite --events 1000 10000 --output bench.json
+    python -m benchmarks.Suite --events 1000 --baseline bench.json
+"""
+import json
+import os
+import pickle
+import platform
+import sys
+import traceback
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+from shutil import rmtree
+from time import perf_counter
+
+from pandas import DataFrame
+
+from benchmarks.Synthetic import (generateCatalog, generateStations,
+                                  writeStationFile)
+from core.Catalog import loadCatalog
+from core.Extra import (catalog2xyzm, hypoDD2nordic, hypoddReloc2xyzm,
+                        loadVelocityFile, mergeDFs, readConfiguration,
+                        readHypoddConfig)
+from core.Input import (prepareHypoDD, preparePH2DT, preparePhaseFile,
+                        prepareStationFile)
+from core.Runner import runHypoDD, runPh2dt
+
+BIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bin")
+
+
+def runStage(stage, *args):
+    """Run a stage in a forked child and measure it
+
+    Args:
+        stage (function): stage to run
+        args: arguments of stage
+
+    Returns:
+        dict: wall time in s, peak RSS in MB and error message, if any
+    """
+    read, write = os.pipe()
+    st = perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        error = None
+        try:
+            stage(*args)
+        except BaseException:
+            error = traceback.format_exc(limit=3)
+        with os.fdopen(write, "wb") as f:
+            pickle.dump(error, f)
+        os._exit(0)
+    os.close(write)
+    with os.fdopen(read, "rb") as f:
+        data = f.read()
+    _, _, usage = os.wait4(pid, 0)
+    elapsed = perf_counter() - st
+    peak = usage.ru_maxrss/1024.0
+    if sys.platform == "darwin":
+        peak /= 1024.0
+    return {"seconds": elapsed,
+            "peakRSSMB": peak,
+            "error": pickle.loads(data) if data else "stage crashed"}
+
+
+def stageLoadCatalog(catalogFile, cachePath):
+    rmtree(cachePath, ignore_errors=True)
+    loadCatalog(catalogFile, cachePath)
+
+
+def stagePhaseFile(chunkPath, catalog):
+    os.chdir(chunkPath)
+    preparePhaseFile(catalog)
+
+
+def stageHypoDD(chunkPath, config, hypoddConfig, stationFile, velocity_df,
+                nEvents):
+    os.chdir(chunkPath)
+    prepareStationFile(stationFile)
+    preparePH2DT(config, hypoddConfig)
+    prepareHypoDD(config, hypoddConfig, velocity_df)
+    runPh2dt(config)
+    runHypoDD(config, "Benchmark", nEvents)
+
+
+def stageReloc2xyzm(chunkPath, nEvents, outName, fmt):
+    os.chdir(chunkPath)
+    hypoddReloc2xyzm(nEvents, outName, fmt)
+
+
+def stageNordic(chunkPath, catalog, stationFile, outName, mode, fmt):
+    os.chdir(chunkPath)
+    hypoDD2nordic(catalog, stationFile, outName, None, mode, fmt)
+
+
+def stageCatalog2xyzm(chunkPath, catalog, outName, fmt):
+    os.chdir(chunkPath)
+    catalog2xyzm(catalog, outName, fmt)
+
+
+def stageMerge(resultsPath, outName, fmt):
+    os.chdir(resultsPath)
+    mergeDFs([0], outName, fmt)
+
+
+def stagePlot(runPath, config):
+    from core.Visulize import plotSeismicityMap
+    os.chdir(runPath)
+    plotSeismicityMap(config)
+
+
+def benchmarkSize(config, hypoddConfig, nEvents, workPath, stages, nStations):
+    """Run all stages on a synthetic catalog of nEvents events
+
+    Args:
+        config (dict): configuration parameters
+        hypoddConfig (dict): hypoDD configuration parameters
+        nEvents (int): number of synthetic events
+        workPath (str): directory for synthetic data and outputs
+        stages (list): names of stages to run, None runs them all
+        nStations (int): number of synthetic stations
+
+    Returns:
+        dict: measurements of each stage
+    """
+    runPath = os.path.abspath(os.path.join(workPath, f"events_{nEvents}"))
+    resultsPath = os.path.join(runPath, "results")
+    chunkPath = os.path.join(resultsPath, "chunk_1")
+    Path(chunkPath).mkdir(parents=True, exist_ok=True)
+    Path(os.path.join(runPath, "DB")).mkdir(parents=True, exist_ok=True)
+    catalogFile = os.path.join(runPath, "DB", "synthetic.out")
+    stationFile = os.path.join(runPath, "stations", "usedStations.csv")
+    cachePath = os.path.join(resultsPath, "cache")
+    outName = config["Region"]["RegionName"]
+    fmt = config["Relocation"]["XyzmFormat"]
+    mode = config["Relocation"]["NordicOutput"]
+    velocity_df = loadVelocityFile(config)
+
+    def generate():
+        station_df = generateStations(config, nStations)
+        writeStationFile(station_df, stationFile)
+        generateCatalog(config, velocity_df, station_df, nEvents, catalogFile)
+
+    results = {}
+
+    def measure(name, stage, *args):
+        if stages and name not in stages:
+            return
+        print(f"+++ Benchmarking {name} with {nEvents} events ...")
+        result = runStage(stage, *args)
+        result["eventsPerSecond"] = nEvents/result["seconds"]
+        results[name] = result
+        if result["error"]:
+            print(f"+++ Stage {name} failed:\n{result['error']}")
+
+    measure("generate", generate)
+    measure("loadCatalog", stageLoadCatalog, catalogFile, cachePath)
+    catalog = loadCatalog(catalogFile, cachePath)
+    DataFrame({"evt": catalog["events"].index, "core": True}).to_csv(
+        os.path.join(chunkPath, "chunkEvents.csv"), index=False)
+    measure("preparePhaseFile", stagePhaseFile, chunkPath, catalog)
+    measure("hypoDD", stageHypoDD, chunkPath, config, hypoddConfig,
+            stationFile, velocity_df, nEvents)
+    measure("hypoddReloc2xyzm", stageReloc2xyzm, chunkPath, nEvents,
+            outName, fmt)
+    measure("hypoDD2nordic", stageNordic, chunkPath, catalog, stationFile,
+            outName, mode, fmt)
+    measure("catalog2xyzm", stageCatalog2xyzm, chunkPath, catalog, outName,
+            fmt)
+    measure("mergeDFs", stageMerge, resultsPath, outName, fmt)
+    measure("plotSeismicityMap", stagePlot, runPath, config)
+    return results
+
+
+def compareBaseline(results, baseline, threshold, minSeconds=0.05):
+    """Compare stage wall times against a baseline
+
+    Args:
+        results (dict): measurements by number of events and stage
+        baseline (dict): baseline measurements, same layout
+        threshold (float): tolerated relative slowdown, e.g. 0.2
+        minSeconds (float, optional): stages faster than this in both
+        runs are not compared, their timing is mostly noise.
+
+    Returns:
+        DataFrame: comparison of stages found in both runs
+    """
+    rows = []
+    for size, stages in results.items():
+        for stage, result in stages.items():
+            reference = baseline.get(size, {}).get(stage)
+            if not reference or result["error"] or reference["error"]:
+                continue
+            ratio = result["seconds"]/reference["seconds"]
+            rows.append({"events": size,
+                         "stage": stage,
+                         "baseline": reference["seconds"],
+                         "seconds": result["seconds"],
+                         "ratio": ratio,
+                         "regression": ratio > 1 + threshold and
+                         max(result["seconds"],
+                             reference["seconds"]) > minSeconds})
+    return DataFrame(rows, columns=["events", "stage", "baseline", "seconds",
+                                    "ratio", "regression"])
+
+
+def parseArguments(argv=None):
+    parser = ArgumentParser(description="Benchmark the relocation pipeline "
+                            "on synthetic catalogs.")
+    parser.add_argument("--events", type=int, nargs="+",
+                        default=[1000, 10000],
+                        help="catalog sizes, e.g. 1000 10000 100000 1000000")
+    parser.add_argument("--stations", type=int, default=60,
+                        help="number of synthetic stations")
+    parser.add_argument("--stages", nargs="+", default=None,
+                        help="stages to run, all by default")
+    parser.add_argument("--work", default=os.path.join("benchmarks", "work"),
+                        help="directory for synthetic data and outputs")
+    parser.add_argument("--output", default=None,
+                        help="write results to this JSON file")
+    parser.add_argument("--baseline", default=None,
+                        help="compare against this JSON results file")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="tolerated relative slowdown")
+    parser.add_argument("--real", action="store_true",
+                        help="use ph2dt and hypoDD found on PATH")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArguments(argv)
+    if not args.real:
+        os.environ["PATH"] = BIN_PATH + os.pathsep + os.environ["PATH"]
+    config = readConfiguration()
+    hypoddConfig = readHypoddConfig()
+    root = os.getcwd()
+    results = {}
+    for nEvents in args.events:
+        results[str(nEvents)] = benchmarkSize(config,
+                                              hypoddConfig,
+                                              nEvents,
+                                              args.work,
+                                              args.stages,
+                                              args.stations)
+        os.chdir(root)
+    report = DataFrame([{"events": size, "stage": stage, **result}
+                        for size, stages in results.items()
+                        for stage, result in stages.items()])
+    report["failed"] = report.error.notna()
+    print(report.drop(columns=["error"]).to_string(index=False,
+                                                   float_format="%.3f"))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "date": datetime.now().isoformat(timespec="seconds"),
+                       "stubs": not args.real,
+                       "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        comparison = compareBaseline(results, baseline, args.threshold)
+        print(comparison.to_string(index=False, float_format="%.3f"))
+        if comparison.regression.any():
+            print("+++ Performance regression detected!")
+            return 1
+    return 0
+
+
+if "__main__" == __name__:
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""Synthetic Nordic catalogs and station tables for benchmarks.
+
+Events are drawn in clusters around random centres of the study region
+and picked at their nearest stations. Pick times are computed through
+the configured 1D velocity model, plus noise.
+
+Usage:
+    python -m benchmarks.Synthetic nEvents outDir [nStations]
+"""
+import os
+import sys
+from pathlib import Path
+
+from numpy import (arange, arctan2, cos, datetime64, degrees, hypot, pi,
+                   repeat, sin, sqrt, timedelta64)
+from numpy.random import default_rng
+from pandas import DataFrame
+from scipy.spatial import cKDTree
+
+from core.Chunking import regionProjection
+from core.Extra import loadVelocityFile, readConfiguration
+from core.TravelTime import loadTravelTimeTable
+
+
+def generateStations(config, nStations, seed=0):
+    """Draw stations uniformly over the study region
+
+    Args:
+        config (dict): configuration parameters
+        nStations (int): number of stations
+        seed (int, optional): random seed.
+
+    Returns:
+        DataFrame: stations in the layout of usedStations.csv
+    """
+    rng = default_rng(seed)
+    radius = config["Region"]["Radius"]
+    r = radius*sqrt(rng.random(nStations))
+    azimuth = rng.random(nStations)*2*pi
+    x = r*sin(azimuth)
+    y = r*cos(azimuth)
+    lon, lat = regionProjection(config)(x, y, inverse=True)
+    elv = rng.random(nStations)*2000.0
+    return DataFrame({"code": [f"S{i:04d}" for i in range(nStations)],
+                      "lat": lat,
+                      "lon": lon,
+                      "elv": elv,
+                      "x": x,
+                      "y": y,
+                      "r": r,
+                      "z": elv})
+
+
+def nordicHeader(ort, lat, lon, dep, mag, nsta):
+    """Format type 1 line of an event"""
+    t = str(ort)
+    second = int(t[17:19]) + int(t[20:23])*1e-3
+    return (f" {t[:4]} {int(t[5:7]):2d}{int(t[8:10]):2d} "
+            f"{int(t[11:13]):2d}{int(t[14:16]):2d} {second:4.1f} L "
+            f"{lat:7.3f}{lon:8.3f}{dep:5.1f}     {nsta:3d} 0.1{mag:4.1f}L"
+            f"{'':19s}1\n")
+
+
+PHASE_HEADER = (" STAT SP IPHASW D HRMM SECON CODA AMPLIT PERI AZIMU VELO AIN"
+                " AR TRES W  DIS CAZ7\n")
+
+
+def generateCatalog(config,
+                    velocity_df,
+                    station_df,
+                    nEvents,
+                    outFile,
+                    picksPerEvent=12,
+                    seed=0,
+                    blockSize=10000):
+    """Write a synthetic Nordic catalog
+
+    Events are written block by block, so catalogs of millions of
+    events are generated in bounded memory.
+
+    Args:
+        config (dict): configuration parameters
+        velocity_df (DataFrame): velocity model
+        station_df (DataFrame): stations as made by generateStations
+        nEvents (int): number of events
+        outFile (str): path to output Nordic file
+        picksPerEvent (int, optional): number of picked stations per
+        event, each with a P and an S pick.
+        seed (int, optional): random seed.
+        blockSize (int, optional): number of events generated at once.
+    """
+    rng = default_rng(seed)
+    radius = config["Region"]["Radius"]
+    nClusters = max(1, nEvents//500)
+    centres = rng.uniform(-0.5*radius, 0.5*radius, (nClusters, 2))
+    stationXY = station_df[["x", "y"]].to_numpy()
+    tree = cKDTree(stationXY)
+    k = min(picksPerEvent, len(station_df))
+    maxDistance = 2.5*radius
+    table = loadTravelTimeTable(velocity_df, 40.0, maxDistance)
+    proj = regionProjection(config)
+    start = datetime64("2020-01-01T00:00:00", "ns")
+    codes = station_df.code.to_numpy()
+    with open(outFile, "w", buffering=1 << 20) as f:
+        for s in range(0, nEvents, blockSize):
+            n = min(blockSize, nEvents - s)
+            cluster = rng.integers(0, nClusters, n)
+            xy = centres[cluster] + rng.normal(0.0, 5.0, (n, 2))
+            dep = rng.normal(12.0, 5.0, n).clip(1.0, 35.0)
+            mag = rng.uniform(1.0, 4.5, n)
+            lon, lat = proj(xy[:, 0], xy[:, 1], inverse=True)
+            days = (s + arange(n))//24
+            tenths = rng.integers(0, 860000, n)
+            ort = (start + days*timedelta64(86400, "s") +
+                   tenths*timedelta64(100, "ms"))
+            _, nearest = tree.query(xy, k=k)
+            nearest = nearest.reshape(n, k)
+            evt = repeat(arange(n), k)
+            sta = nearest.ravel()
+            dx, dy = (stationXY[sta] - xy[evt]).T
+            dist = hypot(dx, dy)
+            azim = degrees(arctan2(-dx, -dy)) % 360.0
+            picks = {}
+            for phase in "PS":
+                tt = table.lookup(dep[evt], dist, phase)[0] + \
+                    rng.normal(0.0, 0.05, len(evt))
+                ms = (tenths[evt]*100 + (tt*1e2).round()*10).astype(int)
+                weights = rng.integers(0, 4, len(evt))
+                picks[phase] = (ms, weights)
+            lines = []
+            for i in range(n):
+                lines.append(nordicHeader(ort[i], lat[i], lon[i], dep[i],
+                                          mag[i], k))
+                lines.append(PHASE_HEADER)
+                for j in range(i*k, (i+1)*k):
+                    for phase in "PS":
+                        ms, weights = picks[phase]
+                        second = ms[j] % 60000
+                        minute = ms[j]//60000
+                        lines.append(
+                            f" {codes[sta[j]]:<5s}SZ  {phase:<4s}"
+                            f"{weights[j]:1d}   {minute//60:2d}"
+                            f"{minute % 60:2d}{second*1e-3:6.2f}"
+                            f"{'':35s} 0.1010{dist[j]:5.1f} "
+                            f"{azim[j]:3.0f} \n")
+                lines.append("\n")
+            f.write("".join(lines))
+
+
+def writeStationFile(station_df, stationFile):
+    """Write stations in the layout of usedStations.csv"""
+    Path(stationFile).parent.mkdir(parents=True, exist_ok=True)
+    station_df.to_csv(stationFile, index=False, float_format="%8.3f")
+
+
+if "__main__" == __name__:
+    config = readConfiguration()
+    nEvents = int(sys.argv[1])
+    outDir = sys.argv[2]
+    nStations = int(sys.argv[3]) if len(sys.argv) > 3 else 60
+    station_df = generateStations(config, nStations)
+    writeStationFile(station_df,
+                     os.path.join(outDir, "stations", "usedStations.csv"))
+    Path(os.path.join(outDir, "DB")).mkdir(parents=True, exist_ok=True)
+    generateCatalog(config,
+                    loadVelocityFile(config),
+                    station_df,
+                    nEvents,
+                    os.path.join(outDir, "DB", "synthetic.out"))
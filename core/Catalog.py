@@ -0,0 +1,265 @@
+import hashlib
+import os
+from io import BytesIO
+from pathlib import Path
+
+from numpy import argsort, array, load, nan, round_, savez
+from pandas import DataFrame, concat
+
+from core.Extra import getHer, getRMS, getZer, handleNone, logger
+from core.Nordic import iterNordicText, parseNordicEvent
+
+EVENT_COLUMNS = ["ORT", "Lon", "Lat", "Dep", "Mag",
+                 "Nus", "NuP", "NuS", "ADS", "MDS", "GAP", "RMS", "ERH", "ERZ",
+                 "start", "end"]
+PICK_COLUMNS = ["evt", "sta", "pha", "aph", "tt", "wgt", "dis", "arr"]
+
+
+def catalogKey(catalogPath, blockSize=1 << 20):
+    """Compute the cache key of a catalog file
+
+    Args:
+        catalogPath (str): path to the input Nordic file
+        blockSize (int, optional): read block size in bytes.
+
+    Returns:
+        str: sha1 digest of file content and modification time
+    """
+    sha = hashlib.sha1()
+    with open(catalogPath, "rb") as f:
+        for block in iter(lambda: f.read(blockSize), b""):
+            sha.update(block)
+    sha.update(str(os.stat(catalogPath).st_mtime_ns).encode())
+    return sha.hexdigest()
+
+
+def obspyEvent(lines):
+    """Parse one Nordic event through obspy
+
+    Args:
+        lines (list): lines of one event
+
+    Returns:
+        tuple: origin dict and list of pick tuples, as parseNordicEvent
+    """
+    from obspy import read_events
+    text = "".join(lines).encode("latin-1")
+    event = read_events(BytesIO(text), format="NORDIC")[0]
+    po = event.preferred_origin()
+    pm = event.preferred_magnitude()
+    try:
+        nus = handleNone(po.quality.used_station_count, dtype="int")
+    except AttributeError:
+        nus = nan
+    try:
+        gap = handleNone(po.quality.azimuthal_gap, dtype="int")
+    except AttributeError:
+        gap = nan
+    origin = {"ORT": po.time.ns,
+              "Lon": po.longitude,
+              "Lat": po.latitude,
+              "Dep": po.depth*1e-3 if po.depth is not None else nan,
+              "Mag": pm.mag if pm else nan,
+              "Nus": nus,
+              "GAP": gap,
+              "ERH": handleNone(getHer(event)),
+              "ERZ": handleNone(getZer(event))}
+    picks = []
+    eventPicks = {pick.resource_id: pick for pick in event.picks}
+    for arrival in po.arrivals:
+        pick = eventPicks.pop(arrival.pick_id, None)
+        if pick is None:
+            continue
+        picks.append(pickRecord(pick, po.time, arrival))
+    for pick in eventPicks.values():
+        picks.append(pickRecord(pick, po.time))
+    return origin, picks
+
+
+def pickRecord(pick, ort, arrival=None):
+    """Build a flat pick tuple from obspy objects
+
+    Args:
+        pick (obspy.pick): an obspy pick
+        ort (obspy.UTCDateTime): origin time of preferred origin
+        arrival (obspy.arrival, optional): arrival associated to the pick.
+
+    Returns:
+        tuple: pick tuple, see parsePhaseLine
+    """
+    try:
+        wgt = int(pick.extra["nordic_pick_weight"]["value"])
+    except (AttributeError, KeyError, ValueError):
+        wgt = 0
+    return (pick.waveform_id.station_code,
+            pick.phase_hint or "",
+            arrival.phase if arrival else "",
+            pick.time - ort,
+            wgt,
+            handleNone(arrival.distance) if arrival else nan,
+            arrival is not None,
+            arrival.time_residual if arrival else None,
+            arrival.time_weight if arrival else None)
+
+
+def eventRecord(origin, picks, start, end):
+    """Build a flat event row from its origin and picks
+
+    Args:
+        origin (dict): origin fields
+        picks (list): pick tuples, arrivals first
+        start (int): start byte offset of event
+        end (int): end byte offset of event
+
+    Returns:
+        tuple: event row, in EVENT_COLUMNS order
+    """
+    arrivals = [pick for pick in picks if pick[6]]
+    distances = [pick[5] for pick in arrivals]
+    return (origin["ORT"],
+            origin["Lon"],
+            origin["Lat"],
+            origin["Dep"],
+            origin["Mag"],
+            origin["Nus"],
+            len([a for a in arrivals if "P" in a[2].upper()]),
+            len([a for a in arrivals if "S" in a[2].upper()]),
+            round_(handleNone(array(distances).mean(), degree=True), 2)
+            if distances else nan,
+            handleNone(min(distances), degree=True) if distances else nan,
+            origin["GAP"],
+            getRMS([a[7] for a in arrivals], [a[8] for a in arrivals]),
+            origin["ERH"],
+            origin["ERZ"],
+            start,
+            end)
+
+
+def iterCatalog(catalogPath):
+    """Parse a Nordic file event by event
+
+    Events are read by the native parser, and through obspy only when
+    it does not cover them, so memory holds a single event at a time.
+
+    Args:
+        catalogPath (str): path to the input Nordic file
+
+    Yields:
+        tuple: event row and list of pick tuples
+    """
+    for start, end, lines in iterNordicText(catalogPath):
+        parsed = parseNordicEvent(lines)
+        if parsed is None:
+            parsed = obspyEvent(lines)
+        origin, picks = parsed
+        yield eventRecord(origin, picks, start, end), picks
+
+
+def parseCatalog(catalogPath, blockSize=10000):
+    """Parse a Nordic file into event and pick tables
+
+    Rows are collected in blocks of events turned into DataFrames, so
+    peak memory stays close to the size of the final tables.
+
+    Args:
+        catalogPath (str): path to the input Nordic file
+        blockSize (int, optional): number of events per block.
+
+    Returns:
+        tuple: events and picks DataFrames
+    """
+    print("+++ Reading catalog ...")
+    events = []
+    picks = []
+    eventRows = []
+    pickRows = []
+    for i, (event, eventPicks) in enumerate(iterCatalog(catalogPath)):
+        eventRows.append(event)
+        pickRows.extend((i,) + pick[:7] for pick in eventPicks)
+        if len(eventRows) == blockSize:
+            events.append(DataFrame(eventRows, columns=EVENT_COLUMNS))
+            if pickRows:
+                picks.append(DataFrame(pickRows, columns=PICK_COLUMNS))
+            eventRows = []
+            pickRows = []
+    if eventRows or not events:
+        events.append(DataFrame(eventRows, columns=EVENT_COLUMNS))
+    if pickRows or not picks:
+        picks.append(DataFrame(pickRows, columns=PICK_COLUMNS))
+    return (concat(events, ignore_index=True),
+            concat(picks, ignore_index=True))
+
+
+def loadCatalog(catalogPath, cachePath=os.path.join("results", "cache")):
+    """Load catalog tables, parsing the Nordic file only on cache miss
+
+    Args:
+        catalogPath (str): path to the input Nordic file
+        cachePath (str, optional): directory of catalog caches.
+
+    Returns:
+        dict: catalog with "events" and "picks" DataFrames
+    """
+    Path(cachePath).mkdir(parents=True, exist_ok=True)
+    key = catalogKey(catalogPath)
+    cacheFile = os.path.join(cachePath, f"catalog_{key}.npz")
+    if os.path.exists(cacheFile):
+        print("+++ Loading catalog from cache ...")
+        with load(cacheFile) as data:
+            events = DataFrame({c: data[f"events_{c}"] for c in EVENT_COLUMNS})
+            picks = DataFrame({c: data[f"picks_{c}"] for c in PICK_COLUMNS})
+    else:
+        events, picks = parseCatalog(catalogPath)
+        arrays = {f"events_{c}": events[c].to_numpy() for c in EVENT_COLUMNS}
+        arrays.update({f"picks_{c}": picks[c].to_numpy(
+            dtype=str if c in ["sta", "pha", "aph"] else None)
+            for c in PICK_COLUMNS})
+        savez(cacheFile, **arrays)
+        logger(f"Catalog cache was written to {cacheFile}")
+    return {"path": os.path.abspath(catalogPath),
+            "events": events,
+            "picks": picks}
+
+
+def selectEvents(catalog, index):
+    """Select a subset of events with their picks
+
+    Args:
+        catalog (dict): catalog tables
+        index (array): event numbers to keep, in output order
+
+    Returns:
+        dict: catalog tables of selected events
+    """
+    events = catalog["events"].loc[index]
+    picks = catalog["picks"]
+    picks = picks[picks.evt.isin(events.index)]
+    return {"path": catalog["path"],
+            "events": events,
+            "picks": picks}
+
+
+def iterEvents(catalog, arrivalsOnly=True):
+    """Yield events one at a time with their picks
+
+    Picks are looked up through a catalog-wide index built once, so each
+    event costs two array slices whatever the size of the catalog.
+
+    Args:
+        catalog (dict): catalog tables
+        arrivalsOnly (bool, optional): keep only picks associated to the
+        preferred origin. Defaults to True.
+
+    Yields:
+        tuple: event row and dict of pick column arrays
+    """
+    picks = catalog["picks"]
+    if arrivalsOnly:
+        picks = picks[picks.arr]
+    order = argsort(picks.evt.to_numpy(), kind="stable")
+    columns = {c: picks[c].to_numpy()[order] for c in PICK_COLUMNS}
+    events = catalog["events"]
+    starts = columns["evt"].searchsorted(events.index.values, "left")
+    ends = columns["evt"].searchsorted(events.index.values, "right")
+    for event, s, e in zip(events.itertuples(), starts, ends):
+        yield event, {c: v[s:e] for c, v in columns.items()}
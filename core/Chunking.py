@@ -0,0 +1,173 @@
+from numpy import (arange, argsort, array_split, column_stack, concatenate,
+                   flatnonzero, isnan, maximum, nan, nanmedian, sort, sqrt,
+                   zeros)
+from pyproj import Proj
+
+from core.Config import logger
+
+
+def indexChunks(nEvents, eventsPerChunk):
+    """Split events by their position in catalog
+
+    Args:
+        nEvents (int): number of events in catalog
+        eventsPerChunk (int): maximum number of events per chunk
+
+    Returns:
+        list: (core, members) event numbers of each chunk
+    """
+    nChunks = int(nEvents//eventsPerChunk)
+    chunks = []
+    for nChunk in range(nChunks+1):
+        s = int(nChunk*eventsPerChunk)
+        e = int(min((nChunk+1)*eventsPerChunk, nEvents))
+        members = arange(s, e)
+        if len(members):
+            chunks.append((members, members))
+    return chunks
+
+
+def regionProjection(config):
+    """Build the local projection of study region
+
+    Args:
+        config (dict): configuration parameters
+
+    Returns:
+        pyproj.Proj: stereographic projection in km
+    """
+    clat = config["Region"]["CentralLat"]
+    clon = config["Region"]["CentralLon"]
+    return Proj(f"+proj=sterea\
+            +lon_0={clon}\
+            +lat_0={clat}\
+            +units=km")
+
+
+def projectEvents(config, events):
+    """Project hypocentres to local cartesian coordinates
+
+    Args:
+        config (dict): configuration parameters
+        events (DataFrame): events table of catalog
+
+    Returns:
+        array: x, y and z of events in km
+    """
+    clat = config["Region"]["CentralLat"]
+    clon = config["Region"]["CentralLon"]
+    proj = regionProjection(config)
+    lon = events.Lon.to_numpy(dtype=float)
+    lat = events.Lat.to_numpy(dtype=float)
+    dep = events.Dep.to_numpy(dtype=float)
+    lon[isnan(lon)] = clon
+    lat[isnan(lat)] = clat
+    dep[isnan(dep)] = nanmedian(dep) if (~isnan(dep)).any() else 10.0
+    x, y = proj(longitude=lon, latitude=lat)
+    return column_stack([x, y, dep])
+
+
+def kdPartition(xyz, index, eventsPerChunk):
+    """Recursively bisect events along their widest axis
+
+    Args:
+        xyz (array): coordinates of all events
+        index (array): event numbers to partition
+        eventsPerChunk (int): maximum number of events per cell
+
+    Returns:
+        list: event numbers of each cell
+    """
+    if len(index) <= eventsPerChunk:
+        return [index]
+    points = xyz[index]
+    axis = (points.max(axis=0) - points.min(axis=0)).argmax()
+    order = index[argsort(points[:, axis], kind="stable")]
+    cells = []
+    for half in array_split(order, 2):
+        cells.extend(kdPartition(xyz, half, eventsPerChunk))
+    return cells
+
+
+def spatialChunks(config, events, eventsPerChunk, halo, maxHalo=None):
+    """Split events into spatially coherent cells with overlap halos
+
+    Each event is relocated in every chunk whose halo reaches it, but
+    its result is only taken from the chunk of its own cell. Since halo
+    events lie at most `halo` km outside a cell, the own cell is always
+    the chunk in which the event is most central. In dense clusters a
+    halo may hold many more events than its cell, so only the maxHalo
+    events nearest to the cell are kept.
+
+    Args:
+        config (dict): configuration parameters
+        events (DataFrame): events table of catalog
+        eventsPerChunk (int): target number of events per cell
+        halo (float): width of overlap halo in km
+        maxHalo (int, optional): maximum number of halo events of a
+        chunk, eventsPerChunk if not given.
+
+    Returns:
+        list: (core, members) event numbers of each chunk, none for an
+        empty catalog
+    """
+    if not len(events):
+        return []
+    maxHalo = eventsPerChunk if maxHalo is None else maxHalo
+    xyz = projectEvents(config, events)
+    cells = kdPartition(xyz, arange(len(xyz)), eventsPerChunk)
+    chunks = []
+    nCut = 0
+    for core in cells:
+        lo = xyz[core].min(axis=0)
+        hi = xyz[core].max(axis=0)
+        outside = maximum(maximum(lo - xyz, xyz - hi), 0)
+        distance = sqrt((outside**2).sum(axis=1))
+        distance[core] = nan
+        inHalo = flatnonzero(distance <= halo)
+        if len(inHalo) > maxHalo:
+            nCut += 1
+            inHalo = inHalo[argsort(distance[inHalo],
+                                    kind="stable")[:maxHalo]]
+        members = sort(concatenate([core, inHalo]))
+        chunks.append((core[argsort(core)], members))
+    if nCut:
+        msg = f"Halos of {nCut} of {len(cells)} chunks cut to their \
+{maxHalo} nearest events"
+        print(f"+++ {msg}")
+        logger(msg)
+    return chunks
+
+
+def makeChunks(config, hypoddConfig, events):
+    """Split catalog events into relocation chunks
+
+    Args:
+        config (dict): configuration parameters
+        hypoddConfig (dict): hypoDD configuration parameters
+        events (DataFrame): events table of catalog
+
+    Returns:
+        list: (core, members) event numbers of each chunk
+    """
+    chunking = config["Relocation"]["Chunking"]
+    eventsPerChunk = config["Relocation"]["EventsPerChunk"]
+    if chunking == "spatial":
+        halo = config["Relocation"]["HaloFactor"]*hypoddConfig["MAXSEP"]
+        return spatialChunks(config, events, eventsPerChunk, halo)
+    return indexChunks(len(events), eventsPerChunk)
+
+
+def coreMask(core, members):
+    """Flag the members of a chunk that belong to its own cell
+
+    Args:
+        core (array): event numbers of chunk cell
+        members (array): event numbers of chunk, including halo
+
+    Returns:
+        array: boolean mask over members
+    """
+    mask = zeros(len(members), dtype=bool)
+    mask[members.searchsorted(core)] = True
+    return mask
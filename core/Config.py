@@ -0,0 +1,150 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from multiprocessing import get_all_start_methods, get_context
+from pathlib import Path
+
+from yaml import SafeLoader, load
+
+RUN = ContextVar("run", default=None)
+
+
+class RelocationError(RuntimeError):
+    """Failure of a relocation run, reported before it is raised
+
+    Attributes:
+        failed (list): labels of failed chunks, realizations or projects
+    """
+
+    def __init__(self, message, failed=()):
+        self.failed = list(failed)
+        super().__init__(message)
+
+
+def currentRun():
+    """Get the run the current thread works for
+
+    Outside of any run, the working directory is the run directory.
+
+    Returns:
+        dict: run with "path", its directory, "id" and metrics settings
+    """
+    run = RUN.get()
+    if run is None:
+        return {"path": os.getcwd(), "id": "", "metrics": True,
+                "profile": "none", "profileStages": []}
+    return run
+
+
+@contextmanager
+def runContext(run):
+    """Make logs and metrics of the current thread go to a run
+
+    Args:
+        run (dict): run, see currentRun
+
+    Yields:
+        dict: the run
+    """
+    token = RUN.set(run)
+    try:
+        yield run
+    finally:
+        RUN.reset(token)
+
+
+def processPool(maxWorkers):
+    """Start a pool of worker processes
+
+    Projects may run in threads, and forking a threaded process can copy
+    locks held by other threads, so workers are started from a fork
+    server, or spawned where there is none. Tasks and their arguments
+    must therefore be picklable module-level objects.
+
+    Args:
+        maxWorkers (int): number of worker processes
+
+    Returns:
+        ProcessPoolExecutor: the pool
+    """
+    method = "forkserver" if "forkserver" in get_all_start_methods() \
+        else "spawn"
+    return ProcessPoolExecutor(max_workers=maxWorkers,
+                               mp_context=get_context(method))
+
+
+def runFile(*parts):
+    """Get the path of a file of the current run"""
+    return os.path.join(currentRun()["path"], *parts)
+
+
+def logger(message, mode="a"):
+    """
+    Function for generating logs in results/running.log of the current
+    run.
+
+    Parameters
+    ----------
+    message : str
+        message to be loged.
+    mode : str, optional
+        loging mode. The default is "a".
+
+    Returns
+    -------
+    None.
+
+    """
+    Path(runFile("results")).mkdir(parents=True, exist_ok=True)
+    logPath = runFile("results", "running.log")
+    message = time.strftime("%d %b %Y %H:%M:%S - ") + message + "\n"
+    with open(logPath, mode) as f:
+        f.write(message)
+
+
+def readConfiguration(configPath="config.yml"):
+    """
+    Read configuration file
+
+    Parameters
+    ----------
+    configPath : str, optional
+        path to configuration file. The default is "config.yml".
+
+    Returns
+    -------
+    config : dict
+        configuration parameters.
+
+    Raises
+    ------
+    RelocationError
+        if the configuration file is missing.
+
+    """
+    if not os.path.exists(configPath):
+        msg = "+++ Could not find configuration file! Aborting ..."
+        print(msg)
+        logger(msg, mode="w")
+        raise RelocationError(msg)
+    with open(configPath) as f:
+        config = load(f, Loader=SafeLoader)
+    msg = "+++ Configuration file was loaded successfully ..."
+    print(msg)
+    logger(msg, mode="w")
+    return config
+
+
+def readHypoddConfig(hypoddConfigPath=os.path.join("files", "hypodd.yml")):
+    if not os.path.exists(hypoddConfigPath):
+        msg = "+++ Could not find hypoDD configuration file! Aborting ..."
+        print(msg)
+        logger(msg)
+        raise RelocationError(msg)
+    with open(hypoddConfigPath) as f:
+        config = load(f, Loader=SafeLoader)
+    msg = "+++ HypoDD Configuration file was loaded successfully ..."
+    print(msg)
+    return config
@@ -0,0 +1,495 @@
+import hashlib
+import json
+import os
+import sqlite3
+from glob import glob
+from io import BytesIO
+from mmap import ACCESS_READ, mmap
+from pathlib import Path
+
+from numpy import (arange, argmax, array, clip, concatenate, conj,
+                   datetime64, dtype, float64, frombuffer, int64, isnan, nan,
+                   round_, sqrt, stack, take_along_axis, where)
+from pandas import DataFrame, concat
+from scipy.fft import irfft, next_fast_len, rfft
+
+from core.Config import processPool
+
+
+def readPairs(dtFile):
+    """Read observations of a dt.ct file, keeping their order
+
+    Args:
+        dtFile (str): path to dt.ct file
+
+    Returns:
+        DataFrame: one row per observation with event ids, station, travel
+        times and phase
+    """
+    rows = []
+    with open(dtFile) as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[0] == "#":
+                id1, id2 = int(fields[1]), int(fields[2])
+                continue
+            rows.append((id1, id2, fields[0], float(fields[1]),
+                         float(fields[2]), fields[-1].upper()))
+    return DataFrame(rows, columns=["id1", "id2", "sta", "tt1", "tt2", "pha"])
+
+
+def settingsDigest(ccConfig):
+    """Hash the settings correlation results depend on"""
+    settings = {k: v for k, v in ccConfig.items()
+                if k not in ["Enabled", "Workers", "BatchSize"]}
+    return hashlib.sha1(json.dumps(settings, sort_keys=True,
+                                   default=str).encode()).hexdigest()[:16]
+
+
+def openCorrelationCache(cacheFile):
+    """Open the cross-correlation cache, creating it if needed
+
+    Args:
+        cacheFile (str): path to the SQLite cache file
+
+    Returns:
+        sqlite3.Connection: connection to the cache
+    """
+    Path(cacheFile).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(cacheFile, timeout=600)
+    conn.execute("""CREATE TABLE IF NOT EXISTS correlations (
+                        key TEXT PRIMARY KEY,
+                        shift REAL,
+                        cc REAL)""")
+    return conn
+
+
+def readCachedCorrelations(conn, keys):
+    """Look up correlations in the cache
+
+    Args:
+        conn (sqlite3.Connection): connection to the cache
+        keys (list): correlation keys
+
+    Returns:
+        dict: (shift, cc) by key, shift is None for rejected lags
+    """
+    found = {}
+    keys = list(keys)
+    for s in range(0, len(keys), 500):
+        block = keys[s:s+500]
+        found.update(
+            (key, (shift, cc)) for key, shift, cc in conn.execute(
+                "SELECT key, shift, cc FROM correlations WHERE key IN "
+                f"({','.join('?'*len(block))})", block))
+    return found
+
+
+def writeCachedCorrelations(conn, results):
+    """Store correlations in the cache
+
+    Args:
+        conn (sqlite3.Connection): connection to the cache
+        results (dict): (shift, cc) by key
+    """
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO correlations VALUES (?, ?, ?)",
+            [(key, shift, cc) for key, (shift, cc) in results.items()])
+
+
+def archiveFiles(archive, sta, channel, day):
+    """Find day files of a station in an SDS miniSEED archive
+
+    Args:
+        archive (str): root of the archive, YEAR/NET/STA/CHAN.D/files
+        sta (str): station code
+        channel (str): channel code or glob pattern, e.g. "??Z"
+        day (datetime64): day of data
+
+    Returns:
+        list: paths of matching day files, sorted
+    """
+    year = str(day.astype("datetime64[Y]"))
+    doy = (day.astype("datetime64[D]") -
+           day.astype("datetime64[Y]")).astype(int) + 1
+    return sorted(glob(os.path.join(archive, year, "*", sta,
+                                    f"{channel}.D",
+                                    f"*.{sta}.*.*.D.{year}.{doy:03d}")))
+
+
+class MiniSeedFile():
+    """A miniSEED day file read span by span
+
+    The file is memory-mapped and the start times of its records, in time
+    order with a fixed length as in SDS archives, are read from their
+    fixed headers at once. Only records overlapping a span are then
+    decoded. Other files are read at once.
+
+    Args:
+        fileName (str): path to miniSEED file
+    """
+
+    def __init__(self, fileName):
+        from obspy.io.mseed.util import get_record_information
+        self.fileName = fileName
+        self.file = open(fileName, "rb")
+        size = os.path.getsize(fileName)
+        info = get_record_information(self.file) if size else {}
+        self.recordLength = info.get("record_length", 0)
+        self.mm = None
+        if self.recordLength and not size % self.recordLength:
+            self.mm = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+            self.starts = recordStarts(self.mm, self.recordLength,
+                                       info["byteorder"])
+
+    def read(self, starttime, endtime):
+        """Read the traces of a time span
+
+        Args:
+            starttime (UTCDateTime): start of span
+            endtime (UTCDateTime): end of span
+
+        Returns:
+            Stream: traces of the span, may be empty
+        """
+        from obspy import Stream, read
+        if self.mm is None:
+            if not self.recordLength:
+                return Stream()
+            return read(self.fileName, format="MSEED", starttime=starttime,
+                        endtime=endtime)
+        first = max(self.starts.searchsorted(starttime.ns, "right") - 2, 0)
+        last = self.starts.searchsorted(endtime.ns, "right") + 1
+        data = self.mm[first*self.recordLength:last*self.recordLength]
+        if not data:
+            return Stream()
+        return read(BytesIO(data), format="MSEED", starttime=starttime,
+                    endtime=endtime)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.file.close()
+
+
+def recordStarts(mm, recordLength, byteorder):
+    """Get start times of the records of a miniSEED file
+
+    Times are read from the BTIME field of the fixed headers, ignoring
+    time corrections, so they are good to a few records for a search.
+
+    Args:
+        mm (mmap): mapped file
+        recordLength (int): record length in bytes
+        byteorder (str): ">" or "<"
+
+    Returns:
+        array: start times in ns
+    """
+    header = dtype({"names": ["year", "doy", "hour", "minute", "second",
+                              "fract"],
+                    "formats": [f"{byteorder}u2", f"{byteorder}u2", "u1",
+                                "u1", "u1", f"{byteorder}u2"],
+                    "offsets": [20, 22, 24, 25, 26, 28],
+                    "itemsize": recordLength})
+    h = frombuffer(mm, header)
+    days = (array(h["year"] - 1970, dtype="datetime64[Y]").astype(
+        "datetime64[D]") + (h["doy"].astype(int64) - 1)).astype(int64)
+    starts = (days*86400 + h["hour"].astype(int64)*3600 +
+              h["minute"].astype(int64)*60 + h["second"])*1000000000 + \
+        h["fract"].astype(int64)*100000
+    del h
+    return starts
+
+
+def readSegments(ccConfig, sta, picks):
+    """Read raw waveform segments around the picks of a station
+
+    Segments span the pick windows plus a padding of two periods of
+    Freqmin on both sides, absorbing filter edge effects. Each day file
+    is opened once for all picks of the station.
+
+    Args:
+        ccConfig (dict): CrossCorrelation configuration parameters
+        sta (str): station code
+        picks (DataFrame): picks with "pha" and absolute "time" in ns
+
+    Returns:
+        dict: (segment, sampling rate, offset) by pick index, the offset in
+        seconds is from the nominal segment start to its first sample.
+        Picks with gaps or missing data are left out.
+    """
+    from obspy import Stream, UTCDateTime
+    pad = 2.0/ccConfig["Freqmin"]
+    segments = {}
+    files = {}
+    readers = {}
+    for i, pha, time in zip(picks.index, picks.pha, picks.time):
+        before, after = ccConfig["Window"][pha]
+        t = UTCDateTime(ns=int(time))
+        start, end = t - before - pad, t + after + pad
+        days = {datetime64(start.ns, "ns").astype("datetime64[D]"),
+                datetime64(end.ns, "ns").astype("datetime64[D]")}
+        st = Stream()
+        for day in sorted(days):
+            key = (ccConfig["Channels"][pha], day)
+            if key not in files:
+                files[key] = archiveFiles(ccConfig["Archive"], sta,
+                                          key[0], day)[:1]
+            for fileName in files[key]:
+                if fileName not in readers:
+                    readers[fileName] = MiniSeedFile(fileName)
+                st += readers[fileName].read(start, end)
+        st.merge(method=1)
+        if len(st) != 1 or hasattr(st[0].data, "mask"):
+            continue
+        tr = st[0]
+        sr = tr.stats.sampling_rate
+        i0 = int(round_((start - tr.stats.starttime)*sr))
+        n = int(round_((end - start)*sr)) + 1
+        if i0 < 0 or i0 + n > tr.stats.npts:
+            continue
+        offset = tr.stats.starttime + i0/sr - start
+        segments[i] = (tr.data[i0:i0+n].astype(float64), sr, offset)
+    for reader in readers.values():
+        reader.close()
+    return segments
+
+
+def filterWindows(ccConfig, picks, segments):
+    """Filter segments and cut their pick windows, in batches
+
+    Segments of the same phase and sampling rate have the same length,
+    they are demeaned, tapered over the padding and band-pass filtered
+    forward and backward as one array.
+
+    Args:
+        ccConfig (dict): CrossCorrelation configuration parameters
+        picks (DataFrame): picks with "pha"
+        segments (dict): segments by pick index, see readSegments
+
+    Returns:
+        dict: (window, sampling rate, offset) by pick index, the offset in
+        seconds is from the nominal window start to its first sample
+    """
+    from scipy.signal import butter, sosfiltfilt
+    from scipy.signal.windows import tukey
+    fmin, fmax = ccConfig["Freqmin"], ccConfig["Freqmax"]
+    pad = 2.0/fmin
+    groups = {}
+    for i, (segment, sr, offset) in segments.items():
+        groups.setdefault((picks.pha[i], sr), []).append(i)
+    windows = {}
+    for (pha, sr), index in groups.items():
+        before, after = ccConfig["Window"][pha]
+        x = stack([segments[i][0] for i in index])
+        x -= x.mean(axis=1, keepdims=True)
+        nPad = int(round_(pad*sr))
+        x *= tukey(x.shape[1], 2.0*nPad/x.shape[1])
+        sos = butter(4, [fmin, min(fmax, 0.45*sr)], btype="bandpass", fs=sr,
+                     output="sos")
+        x = sosfiltfilt(sos, x, axis=1)
+        n = int(round_((before + after)*sr)) + 1
+        for i, w in zip(index, x[:, nPad:nPad+n]):
+            windows[i] = (w, sr, segments[i][2] + nPad/sr - pad)
+    return windows
+
+
+def correlateBatch(x, y, maxLag):
+    """Normalized cross-correlation lags of batches of window pairs
+
+    Args:
+        x (array): first windows, one per row
+        y (array): second windows, same shape as x
+        maxLag (int): largest lag searched, in samples
+
+    Returns:
+        tuple: lags in samples, with sub-sample precision, by which x is
+        delayed relative to y, NaN when the peak is at the lag limit, and
+        correlation coefficients
+    """
+    n = x.shape[1]
+    x = x - x.mean(axis=1, keepdims=True)
+    y = y - y.mean(axis=1, keepdims=True)
+    nfft = next_fast_len(2*n - 1)
+    cc = irfft(rfft(x, nfft, axis=1)*conj(rfft(y, nfft, axis=1)), nfft, axis=1)
+    cc = concatenate([cc[:, nfft-maxLag:], cc[:, :maxLag+1]], axis=1)
+    norm = sqrt((x**2).sum(axis=1)*(y**2).sum(axis=1))
+    cc /= where(norm > 0, norm, 1.0)[:, None]
+    peak = argmax(cc, axis=1)
+    inner = clip(peak, 1, 2*maxLag - 1)
+    c0 = take_along_axis(cc, (inner - 1)[:, None], axis=1)[:, 0]
+    c1 = take_along_axis(cc, inner[:, None], axis=1)[:, 0]
+    c2 = take_along_axis(cc, (inner + 1)[:, None], axis=1)[:, 0]
+    curvature = c0 - 2.0*c1 + c2
+    delta = where(curvature < 0, 0.5*(c0 - c2)/where(curvature < 0,
+                                                     curvature, -1.0), 0.0)
+    lag = where((peak > 0) & (peak < 2*maxLag), inner + delta - maxLag, nan)
+    coefficient = clip(c1 - 0.25*(c0 - c2)*delta, -1.0, 1.0)
+    return lag, coefficient
+
+
+def correlateStation(ccConfig, sta, picks, pairs):
+    """Correlate pick pairs of one station
+
+    Args:
+        ccConfig (dict): CrossCorrelation configuration parameters
+        sta (str): station code
+        picks (DataFrame): picks of the station, see readSegments
+        pairs (DataFrame): "p1" and "p2" pick indices and "key" of pairs
+
+    Returns:
+        dict: (shift, cc) by key, shift in seconds is added to the pick
+        differential time, None when rejected
+    """
+    windows = filterWindows(ccConfig, picks,
+                            readSegments(ccConfig, sta, picks))
+    ok = pairs.p1.isin(list(windows)) & pairs.p2.isin(list(windows))
+    pairs = pairs[ok].copy()
+    pairs["sr"] = [windows[p][1] for p in pairs.p1]
+    pairs["sr2"] = [windows[p][1] for p in pairs.p2]
+    pairs = pairs[pairs.sr == pairs.sr2]
+    pairs["pha"] = picks.pha.reindex(pairs.p1).values
+    results = {}
+    batchSize = ccConfig["BatchSize"]
+    for (pha, sr), group in pairs.groupby(["pha", "sr"]):
+        maxLag = int(round_(ccConfig["MaxLag"]*sr))
+        for s in range(0, len(group), batchSize):
+            batch = group.iloc[s:s+batchSize]
+            x = stack([windows[p][0] for p in batch.p1])
+            y = stack([windows[p][0] for p in batch.p2])
+            lag, coefficient = correlateBatch(x, y, maxLag)
+            offsets = array([windows[p][2] - windows[q][2]
+                             for p, q in zip(batch.p1, batch.p2)])
+            shift = offsets + lag/sr
+            for key, dt, cc in zip(batch.key, shift, coefficient):
+                results[key] = (None if isnan(dt) else float(dt), float(cc))
+    return results
+
+
+def correlatePairs(config,
+                   catalog,
+                   obs,
+                   cacheFile=os.path.join("results", "cache",
+                                          "crosscorr.sqlite")):
+    """Measure differential times of pick pairs by waveform correlation
+
+    Windows are cut around both picks of every observation from the SDS
+    miniSEED archive set in config. Stations are correlated in parallel,
+    each in FFT batches of pairs. Correlations are cached by station,
+    phase and pick times, so reruns only correlate new or moved picks.
+
+    Args:
+        config (dict): configuration parameters
+        catalog (dict): catalog tables
+        obs (DataFrame): catalog observations with event numbers "id1"
+        and "id2", starting from one, "sta", "pha", "tt1" and "tt2"
+        cacheFile (str, optional): path to correlation cache file.
+
+    Returns:
+        DataFrame: observations correlated above MinCoefficient, with
+        differential travel time "dt" and weight "w", the squared
+        correlation coefficient
+    """
+    ccConfig = config["CrossCorrelation"]
+    obs = obs[["id1", "id2", "sta", "pha", "tt1", "tt2"]].copy()
+    if not len(obs):
+        return obs.assign(dt=[], w=[])
+    ort = catalog["events"].ORT.to_numpy(dtype=int64)
+    obs["t1"] = ort[obs.id1.values - 1] + (obs.tt1.values*1e9).round()
+    obs["t2"] = ort[obs.id2.values - 1] + (obs.tt2.values*1e9).round()
+    digest = settingsDigest(ccConfig)
+    obs["key"] = (digest + "|" + obs.sta + "|" + obs.pha + "|" +
+                  obs.t1.astype(int64).astype(str) + "|" +
+                  obs.t2.astype(int64).astype(str))
+    conn = openCorrelationCache(cacheFile)
+    results = readCachedCorrelations(conn, obs.key.unique())
+    todo = obs[~obs.key.isin(results)].drop_duplicates("key")
+    print(f"+++ Correlating {len(todo)} of {len(obs)} phase pairs ...")
+    tasks = []
+    for sta, group in todo.groupby("sta"):
+        picks = concat([
+            DataFrame({"pha": group.pha.values, "time": group.t1.values}),
+            DataFrame({"pha": group.pha.values, "time": group.t2.values})])
+        picks = picks.drop_duplicates().reset_index(drop=True)
+        index = {(p, t): i for i, (p, t) in enumerate(zip(picks.pha,
+                                                          picks.time))}
+        pairs = DataFrame({
+            "p1": [index[p, t] for p, t in zip(group.pha, group.t1)],
+            "p2": [index[p, t] for p, t in zip(group.pha, group.t2)],
+            "key": group.key.values})
+        tasks.append((ccConfig, sta, picks, pairs))
+    nWorkers = min(ccConfig["Workers"], len(tasks))
+    if nWorkers > 1:
+        with processPool(nWorkers) as executor:
+            jobs = [executor.submit(correlateStation, *task) for task in tasks]
+            computed = [job.result() for job in jobs]
+    else:
+        computed = [correlateStation(*task) for task in tasks]
+    for stationResults in computed:
+        writeCachedCorrelations(conn, stationResults)
+        results.update(stationResults)
+    conn.close()
+    shift = array([results.get(k, (None, nan))[0] for k in obs.key],
+                  dtype=float64)
+    cc = array([results.get(k, (None, nan))[1] for k in obs.key],
+               dtype=float64)
+    keep = ~isnan(shift) & (cc >= ccConfig["MinCoefficient"])
+    obs = obs[keep]
+    return obs.assign(dt=obs.tt1.values - obs.tt2.values + shift[keep],
+                      w=cc[keep]**2)[["id1", "id2", "sta", "pha", "dt",
+                                      "w"]]
+
+
+def buildCrossCorrelationTimes(config,
+                               catalog,
+                               dtFile="dt.ct",
+                               ccFile="dt.cc",
+                               cacheFile=os.path.join("results", "cache",
+                                                      "crosscorr.sqlite")):
+    """Measure differential times of dt.ct pairs by waveform correlation,
+    see correlatePairs
+
+    Args:
+        config (dict): configuration parameters
+        catalog (dict): catalog tables, in the event order of dt.ct
+        dtFile (str, optional): path to input dt.ct file.
+        ccFile (str, optional): path to output dt.cc file.
+        cacheFile (str, optional): path to correlation cache file.
+
+    Returns:
+        int: number of observations written
+    """
+    obs = correlatePairs(config, catalog, readPairs(dtFile), cacheFile)
+    writeCrossCorrelationTimes(ccFile, obs)
+    return len(obs)
+
+
+def writeCrossCorrelationTimes(ccFile, obs):
+    """Write dt.cc observations grouped by event pair
+
+    Differential times are from the catalog origin times, so the origin
+    time correction of every pair is zero.
+
+    Args:
+        ccFile (str): path to output dt.cc file
+        obs (DataFrame): observations made by correlatePairs
+    """
+    id1 = obs.id1.values
+    id2 = obs.id2.values
+    starts = concatenate([[0], arange(1, len(obs))[
+        (id1[1:] != id1[:-1]) | (id2[1:] != id2[:-1])], [len(obs)]])
+    with open(ccFile, "w") as f:
+        for s, e in zip(starts[:-1], starts[1:]):
+            if s == e:
+                continue
+            f.write(f"# {id1[s]:9d} {id2[s]:9d} {0.0:6.3f}\n")
+            f.write("".join(
+                f"{sta:<7s} {d:8.4f} {w:6.4f} {pha}\n"
+                for sta, d, w, pha in zip(obs.sta.values[s:e],
+                                          obs.dt.values[s:e],
+                                          obs.w.values[s:e],
+                                          obs.pha.values[s:e])))
@@ -0,0 +1,122 @@
+from numpy import (append, arange, asarray, clip, diff, digitize,
+                   histogram2d, lexsort, linspace, minimum, nan, ones, sort,
+                   unique, zeros)
+from numpy.random import default_rng
+from scipy.ndimage import gaussian_filter
+
+from core.Chunking import regionProjection
+
+
+def projectLonLat(config, lon, lat):
+    """Project coordinates of study region as whole arrays
+
+    Args:
+        config (dict): configuration parameters
+        lon (array): longitudes in degree
+        lat (array): latitudes in degree
+
+    Returns:
+        tuple: easting and northing in km
+    """
+    return regionProjection(config)(lon, lat)
+
+
+def gridExtent(x, y, pad=0.05):
+    """Padded bounds of points, as (xmin, xmax, ymin, ymax)"""
+    xmin, xmax = x.min(), x.max()
+    ymin, ymax = y.min(), y.max()
+    dx = max(xmax - xmin, 1.0)*pad
+    dy = max(ymax - ymin, 1.0)*pad
+    return xmin-dx, xmax+dx, ymin-dy, ymax+dy
+
+
+def densityGrid(x, y, extent, nBins=200, bwAdjust=0.5):
+    """Estimate event density on a regular grid
+
+    Events are binned in a 2D histogram which is then smoothed by a
+    Gaussian filter, with the bandwidth of Scott's rule scaled by
+    bwAdjust, as in a Gaussian KDE. Cost grows with the number of bins,
+    not of events.
+
+    Args:
+        x (array): eastings in km
+        y (array): northings in km
+        extent (tuple): grid bounds, (xmin, xmax, ymin, ymax)
+        nBins (int, optional): number of bins along each axis.
+        bwAdjust (float, optional): bandwidth factor.
+
+    Returns:
+        tuple: density per km^2 normalized to unit integral, shaped
+        (nBins, nBins) with y along rows, and bin edges along x and y
+    """
+    xEdges = linspace(extent[0], extent[1], nBins+1)
+    yEdges = linspace(extent[2], extent[3], nBins+1)
+    counts, _, _ = histogram2d(y, x, bins=[yEdges, xEdges])
+    n = len(x)
+    if n > 1:
+        factor = bwAdjust*n**(-1.0/6.0)
+        sigma = (factor*y.std()/(yEdges[1]-yEdges[0]),
+                 factor*x.std()/(xEdges[1]-xEdges[0]))
+        counts = gaussian_filter(counts, sigma, mode="constant")
+    area = (xEdges[1]-xEdges[0])*(yEdges[1]-yEdges[0])
+    density = counts/(max(n, 1)*area)
+    return density, xEdges, yEdges
+
+
+def decimateEvents(x, y, mag, maxPoints, nBins=200, seed=0):
+    """Pick events to draw so that dense areas are thinned first
+
+    Events are binned on a grid and every bin keeps at most the same
+    number of events, the largest magnitudes first, with the cap chosen
+    so that at most maxPoints events are kept. Sparse bins are kept
+    whole, so isolated events never disappear. The grid is coarsened
+    while there are more occupied bins than maxPoints.
+
+    Args:
+        x (array): eastings in km
+        y (array): northings in km
+        mag (array): magnitudes, NaN sorts last
+        maxPoints (int): largest number of events to keep, 0 keeps all
+        nBins (int, optional): number of bins along each axis.
+        seed (int, optional): random seed breaking magnitude ties.
+
+    Returns:
+        array: boolean mask of kept events
+    """
+    n = len(x)
+    if not maxPoints or n <= maxPoints:
+        return ones(n, dtype=bool)
+    extent = gridExtent(x, y)
+    while True:
+        ix = digitize(x, linspace(extent[0], extent[1], nBins+1))
+        iy = digitize(y, linspace(extent[2], extent[3], nBins+1))
+        cell = clip(iy, 1, nBins)*(nBins+2) + clip(ix, 1, nBins)
+        if nBins == 1 or len(unique(cell)) <= maxPoints:
+            break
+        nBins //= 2
+    order = lexsort((default_rng(seed).random(n),
+                     -asarray(mag, dtype=float),
+                     cell))
+    sortedCell = cell[order]
+    starts = ones(n, dtype=bool)
+    starts[1:] = sortedCell[1:] != sortedCell[:-1]
+    groupStart = arange(n)[starts]
+    counts = sort(diff(append(groupStart, n)))
+    low, high = 1, int(counts[-1])
+    while low < high:
+        cap = (low + high + 1)//2
+        if minimum(counts, cap).sum() <= maxPoints:
+            low = cap
+        else:
+            high = cap - 1
+    rank = arange(n) - groupStart[starts.cumsum()-1]
+    keep = zeros(n, dtype=bool)
+    keep[order[rank < low]] = True
+    return keep
+
+
+def maskedDensity(density, threshold=0.01):
+    """Hide grid cells below a fraction of the peak density"""
+    density = density.copy()
+    density[density < threshold*density.max()] = nan
+    return density
@@ -0,0 +1,317 @@
+from numpy import (arange, array, concatenate, flatnonzero, hypot, int64,
+                   isin, maximum, minimum, repeat, tile)
+from pandas import (DataFrame, MultiIndex, concat, factorize, read_csv,
+                    to_datetime)
+from scipy.spatial import cKDTree
+
+from core.Chunking import projectEvents, regionProjection
+from core.Input import PICK_WEIGHTS
+
+
+def loadPickTable(config, catalog, stationFile, minWeight=0.0):
+    """Prepare picks of a catalog for pairing
+
+    Picks lighter than minWeight are dropped, as ph2dt does with MINWGHT,
+    so they link no pair.
+
+    Args:
+        config (dict): configuration parameters
+        catalog (dict): catalog tables
+        stationFile (str): path to the used stations file
+        minWeight (float, optional): smallest pick weight kept.
+
+    Returns:
+        DataFrame: picks with event position, station/phase code,
+        station coordinates and pick weight
+    """
+    picks = catalog["picks"]
+    picks = picks[picks.arr]
+    table = DataFrame({
+        "pos": catalog["events"].index.get_indexer(picks.evt),
+        "sta": picks.sta.values,
+        "pha": picks.pha.str[:1].str.upper().values,
+        "tt": picks.tt.values,
+        "w": picks.wgt.map(PICK_WEIGHTS).fillna(0.0).values,
+    })
+    station_df = read_csv(stationFile)
+    station_df.code = station_df.code.str.strip()
+    station_df.drop_duplicates(["code"], inplace=True)
+    station_df.set_index("code", inplace=True)
+    proj = regionProjection(config)
+    station_df["sx"], station_df["sy"] = proj(longitude=station_df.lon.values,
+                                              latitude=station_df.lat.values)
+    table = table[table.pha.isin(["P", "S"]) &
+                  table.sta.isin(station_df.index) &
+                  (table.w >= minWeight)]
+    table = table.drop_duplicates(["pos", "sta", "pha"])
+    table["sp"] = factorize(table.sta + "_" + table.pha)[0]
+    table["sx"] = station_df.sx.reindex(table.sta).values
+    table["sy"] = station_df.sy.reindex(table.sta).values
+    return table.sort_values(by=["pos", "sp"]).reset_index(drop=True)
+
+
+def linkPairs(pairs, table, xyz, hypoddConfig):
+    """Match common station/phase picks of event pairs
+
+    Args:
+        pairs (DataFrame): candidate pairs with "i" and "k" positions
+        table (DataFrame): picks prepared by loadPickTable
+        xyz (array): event coordinates in km
+        hypoddConfig (dict): hypoDD configuration parameters
+
+    Returns:
+        DataFrame: one row per differential time observation
+    """
+    obs = pairs.merge(table, left_on="i", right_on="pos")
+    obs = obs.merge(table[["pos", "sp", "tt", "w"]],
+                    left_on=["k", "sp"],
+                    right_on=["pos", "sp"],
+                    suffixes=("1", "2"))
+    mx = (xyz[obs.i.values, 0] + xyz[obs.k.values, 0])*0.5
+    my = (xyz[obs.i.values, 1] + xyz[obs.k.values, 1])*0.5
+    obs["dist"] = hypot(obs.sx.values - mx, obs.sy.values - my)
+    obs["w"] = (obs.w1 + obs.w2)*0.5
+    obs = obs[obs.dist <= hypoddConfig["MAXDIST"]]
+    return obs[["i", "k", "rank", "sta", "pha", "tt1", "tt2", "w", "dist"]]
+
+
+def selectNeighbours(tree, xyz, ids, table, hypoddConfig):
+    """Select neighbours of a block of events the way ph2dt does
+
+    Neighbours within MAXSEP are visited by increasing separation until
+    MAXNGH strong neighbours (at least MINLNKS links) are found. Every
+    visited neighbour with at least MINOBS links is kept.
+
+    Args:
+        tree (cKDTree): spatial index of event coordinates
+        xyz (array): event coordinates in km
+        ids (array): positions of events to search from
+        table (DataFrame): picks prepared by loadPickTable
+        hypoddConfig (dict): hypoDD configuration parameters
+
+    Returns:
+        DataFrame: observations of selected pairs
+    """
+    MAXSEP = hypoddConfig["MAXSEP"]
+    MAXNGH = hypoddConfig["MAXNGH"]
+    MINLNKS = hypoddConfig["MINLNKS"]
+    MINOBS = hypoddConfig["MINOBS"]
+    n = len(xyz)
+    k = min(n, 2*MAXNGH+1)
+    selected = []
+    while len(ids):
+        _, nb = tree.query(xyz[ids], k=k, distance_upper_bound=MAXSEP)
+        nb = nb.reshape(len(ids), k)
+        i = repeat(ids, k)
+        j = nb.ravel()
+        valid = (j < n) & (j != i)
+        pairs = DataFrame({"i": i[valid],
+                           "k": j[valid],
+                           "rank": tile(arange(k), len(ids))[valid]})
+        obs = linkPairs(pairs, table, xyz, hypoddConfig)
+        nobs = obs.groupby(["i", "k"]).size()
+        pairs["nobs"] = nobs.reindex(
+            MultiIndex.from_arrays([pairs.i, pairs.k]), fill_value=0).values
+        strong = pairs.nobs >= MINLNKS
+        visited = (strong.groupby(pairs.i).cumsum() - strong) < MAXNGH
+        nStrong = strong.groupby(pairs.i).sum().reindex(ids, fill_value=0)
+        unresolved = (nb[:, -1] < n) & (nStrong.values < MAXNGH) & (k < n)
+        keep = visited & (pairs.nobs >= MINOBS) & ~pairs.i.isin(ids[unresolved])
+        keep = pairs[keep]
+        selected.append(obs.merge(keep[["i", "k"]], on=["i", "k"]))
+        ids = ids[unresolved]
+        k = min(n, 2*k)
+    return concat(selected, ignore_index=True)
+
+
+def writeEventFile(catalog, eventFile="event.dat"):
+    """Write the hypoDD event file of a catalog
+
+    Args:
+        catalog (dict): catalog tables
+        eventFile (str, optional): path to output event file.
+    """
+    events = catalog["events"]
+    ort = to_datetime(events.ORT, unit="ns")
+    dates = ort.dt.strftime("%Y%m%d").values
+    times = (ort.dt.strftime("%H%M%S") +
+             (ort.dt.microsecond//10000).map("{:02d}".format)).values
+    depths = events.Dep.fillna(10.0).replace(0.0, 10.0).values
+    with open(eventFile, "w") as f:
+        for e, (date, time, lat, lon, dep, mag) in enumerate(
+                zip(dates, times, events.Lat.values, events.Lon.values,
+                    depths, events.Mag.values)):
+            f.write(f"{date}  {time:>8s} {lat:8.4f} {lon:9.4f} {dep:9.3f} \
+{mag:4.1f} {0.0:6.2f} {0.0:6.2f} {0.0:6.2f} {e+1:10d}\n")
+
+
+def pairBlocks(config, hypoddConfig, catalog, stationFile, blockSize=2000):
+    """Select differential time observations block by block
+
+    Pairs are searched through a k-d tree for blocks of events, each pair
+    is kept once, in the block of its first event.
+
+    Args:
+        config (dict): configuration parameters
+        hypoddConfig (dict): hypoDD configuration parameters
+        catalog (dict): catalog tables
+        stationFile (str): path to the used stations file
+        blockSize (int, optional): number of events searched at once.
+
+    Yields:
+        DataFrame: observations of a block sorted by event pair, with
+        event positions "i" and "k" and pair "key"
+    """
+    MAXOBS = hypoddConfig["MAXOBS"]
+    xyz = projectEvents(config, catalog["events"])
+    n = len(xyz)
+    tree = cKDTree(xyz)
+    table = loadPickTable(config, catalog, stationFile,
+                          hypoddConfig["MINWGHT"])
+    written = array([], dtype=int64)
+    for s in range(0, n, blockSize):
+        e = min(s+blockSize, n)
+        obs = selectNeighbours(tree, xyz, arange(s, e), table, hypoddConfig)
+        if not len(obs):
+            continue
+        a = minimum(obs.i.values, obs.k.values).astype(int64)
+        b = maximum(obs.i.values, obs.k.values).astype(int64)
+        obs["key"] = a*n + b
+        firstOwner = obs.groupby("key").i.transform("min")
+        obs = obs[~isin(obs.key.values, written) & (obs.i == firstOwner)]
+        obs = obs.sort_values(by=["i", "rank", "dist"], kind="stable")
+        obs = obs[obs.groupby(["i", "k"]).cumcount() < MAXOBS]
+        if not len(obs):
+            continue
+        keys = obs.key.unique()
+        written = concatenate([written[written % n >= e],
+                               keys[keys % n >= e]])
+        yield obs
+
+
+def differentialTimes(config, hypoddConfig, catalog, stationFile):
+    """Select catalog differential times in memory, as written to dt.ct
+
+    Args:
+        config (dict): configuration parameters
+        hypoddConfig (dict): hypoDD configuration parameters
+        catalog (dict): catalog tables
+        stationFile (str): path to the used stations file
+
+    Returns:
+        DataFrame: observations with event positions "i" and "k", "sta",
+        "pha", travel times "tt1" and "tt2" and weight "w"
+    """
+    blocks = list(pairBlocks(config, hypoddConfig, catalog, stationFile))
+    if not blocks:
+        return DataFrame(columns=["i", "k", "sta", "pha", "tt1", "tt2", "w"])
+    return concat(blocks, ignore_index=True)[["i", "k", "sta", "pha", "tt1",
+                                              "tt2", "w"]]
+
+
+def buildDifferentialTimes(config,
+                           hypoddConfig,
+                           catalog,
+                           stationFile,
+                           dtFile="dt.ct",
+                           eventFile="event.dat",
+                           blockSize=2000):
+    """Build catalog differential times without ph2dt
+
+    Pairs are written to dt.ct as soon as a block is done, see
+    pairBlocks, so memory is bounded by block size and not by catalog
+    size.
+
+    Args:
+        config (dict): configuration parameters
+        hypoddConfig (dict): hypoDD configuration parameters
+        catalog (dict): catalog tables
+        stationFile (str): path to the used stations file
+        dtFile (str, optional): path to output dt.ct file.
+        eventFile (str, optional): path to output event file.
+        blockSize (int, optional): number of events searched at once.
+
+    Returns:
+        int: number of event pairs written
+    """
+    writeEventFile(catalog, eventFile)
+    nPairs = 0
+    with open(dtFile, "w") as f:
+        for obs in pairBlocks(config, hypoddConfig, catalog, stationFile,
+                              blockSize):
+            nPairs += obs.key.nunique()
+            writePairs(f, obs)
+    return nPairs
+
+
+def writePairs(f, obs):
+    """Write differential time observations grouped by event pair
+
+    Args:
+        f (file): opened dt.ct file
+        obs (DataFrame): sorted observations of event pairs
+    """
+    i = obs.i.values
+    k = obs.k.values
+    lines = [f"{sta:<7s} {tt1:9.3f} {tt2:9.3f} {w:6.4f} {pha}\n"
+             for sta, tt1, tt2, w, pha in zip(obs.sta.values,
+                                              obs.tt1.values,
+                                              obs.tt2.values,
+                                              obs.w.values,
+                                              obs.pha.values)]
+    starts = flatnonzero((i[1:] != i[:-1]) | (k[1:] != k[:-1])) + 1
+    starts = concatenate([[0], starts, [len(lines)]])
+    for s, e in zip(starts[:-1], starts[1:]):
+        f.write(f"# {i[s]+1:9d} {k[s]+1:9d}\n")
+        f.write("".join(lines[s:e]))
+
+
+def readDifferentialTimes(dtFile):
+    """Read observations of a dt.ct file
+
+    Args:
+        dtFile (str): path to dt.ct file
+
+    Returns:
+        DataFrame: one row per observation, with ordered event ids and
+        weight "w"
+    """
+    rows = []
+    with open(dtFile) as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[0] == "#":
+                id1, id2 = int(fields[1]), int(fields[2])
+                continue
+            rows.append((min(id1, id2), max(id1, id2), fields[0], fields[-1],
+                         float(fields[-2])))
+    return DataFrame(rows, columns=["id1", "id2", "sta", "pha", "w"])
+
+
+def compareDifferentialTimes(dtFile, refFile):
+    """Compare a dt.ct file against a reference one, e.g. made by ph2dt
+
+    Args:
+        dtFile (str): path to dt.ct file to check
+        refFile (str): path to reference dt.ct file
+
+    Returns:
+        dict: number of pairs and observations in each file and in both,
+        and largest weight difference of common observations
+    """
+    keys = ["id1", "id2", "sta", "pha"]
+    dt = readDifferentialTimes(dtFile)
+    ref = readDifferentialTimes(refFile)
+    pairs = dt[["id1", "id2"]].drop_duplicates()
+    refPairs = ref[["id1", "id2"]].drop_duplicates()
+    common = dt.merge(ref, on=keys, suffixes=("", "Ref"))
+    return {"pairs": len(pairs),
+            "refPairs": len(refPairs),
+            "commonPairs": len(pairs.merge(refPairs)),
+            "obs": len(dt),
+            "refObs": len(ref),
+            "commonObs": len(common),
+            "maxWeightDifference": float((common.w - common.wRef).abs().max())
+            if len(common) else 0.0}
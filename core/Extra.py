@@ -1,66 +1,15 @@
 import os
-import sys
-import time
 import warnings
-from pathlib import Path
-
-from numpy import array, diff, max, mean, nan, round_, sqrt
-from obspy import UTCDateTime as utc
-from obspy import read_events
-from obspy.core.event import Catalog
-from obspy.geodetics.base import degrees2kilometers as d2k
-from obspy.geodetics.base import gps2dist_azimuth as gps
-from obspy.geodetics.base import kilometers2degrees as k2d
-from pandas import DataFrame, Series, read_csv, to_datetime, concat
-from yaml import SafeLoader, load
 
-warnings.filterwarnings("ignore")
-
-
-def logger(message, mode="a"):
-    """
-    Function for generating logs.
-
-    Parameters
-    ----------
-    message : str
-        message to be loged.
-    mode : str, optional
-        loging mode. The default is "a".
-
-    Returns
-    -------
-    None.
-
-    """
-    Path("results").mkdir(parents=True, exist_ok=True)
-    logPath = os.path.join("results", "running.log")
-    message = time.strftime("%d %b %Y %H:%M:%S - ") + message + "\n"
-    with open(logPath, mode) as f:
-        f.write(message)
-
-
-def readConfiguration():
-    """
-    Read configuration file
+from numpy import array, floor, isnan, nan, sqrt
+from pandas import DataFrame, read_csv, to_datetime, concat
+from pyproj import Geod
 
-    Returns
-    -------
-    config : dict
-        configuration parameters.
+from core.Config import logger, readConfiguration, readHypoddConfig  # noqa
+from core.Nordic import patchNordic, writeNordicEvents
+from core.Xyzm import readXyzm, writeXyzm, xyzmPath
 
-    """
-    if not os.path.exists("config.yml"):
-        msg = "+++ Could not find configuration file! Aborting ..."
-        print(msg)
-        logger(msg, mode="w")
-        sys.exit()
-    with open("config.yml") as f:
-        config = load(f, Loader=SafeLoader)
-    msg = "+++ Configuration file was loaded successfully ..."
-    print(msg)
-    logger(msg, mode="w")
-    return config
+warnings.filterwarnings("ignore")
 
 
 def handleNone(value, degree=False, dtype="float"):
@@ -78,17 +27,26 @@ def handleNone(value, degree=False, dtype="float"):
         return nan
     else:
         if degree:
+            from obspy.geodetics.base import degrees2kilometers as d2k
             return d2k(value)
         return int(value) if dtype == "int" else value
 
 
-def getRMS(arrivals):
+def getRMS(residuals, weights):
+    """Get weighted RMS of arrival time residuals
+
+    Args:
+        residuals (list): time residuals of arrivals, None if missing
+        weights (list): time weights of arrivals, None if missing
+
+    Returns:
+        float: weighted RMS
+    """
     time_residuals = array([
-        arrival.time_residual for arrival in arrivals if isinstance(
-            arrival.time_residual, float)
+        residual for residual in residuals if isinstance(residual, float)
     ])
     time_weights = array([
-        arrival.time_weight if isinstance(arrival.time_weight, float) else nan for arrival in arrivals
+        weight if isinstance(weight, float) else nan for weight in weights
     ])
     if time_residuals.size:
         weighted_rms = sum(time_weights * time_residuals **
@@ -108,6 +66,7 @@ def getHer(event):
     Returns:
         float: event horizontal error
     """
+    from obspy.geodetics.base import degrees2kilometers as d2k
     try:
         x = event.origins[0].latitude_errors.uncertainty
         y = event.origins[0].longitude_errors.uncertainty
@@ -131,20 +90,7 @@ def getZer(event):
         return None
 
 
-def readHypoddConfig():
-    hypoddConfigPath = os.path.join("files", "hypodd.yml")
-    if not os.path.exists(hypoddConfigPath):
-        msg = "+++ Could not find hypoDD configuration file! Aborting ..."
-        print(msg)
-        sys.exit()
-    with open(hypoddConfigPath) as f:
-        config = load(f, Loader=SafeLoader)
-    msg = "+++ HypoDD Configuration file was loaded successfully ..."
-    print(msg)
-    return config
-
-
-def loadHypoDDRelocFile():
+def loadHypoDDRelocFile(path=""):
     names = ["ID",  "LAT",  "LON",  "DEPTH",
              "X",  "Y",  "Z",
              "EX",  "EY",  "EZ",
@@ -154,7 +100,8 @@ def loadHypoDDRelocFile():
              "NCTP",  "NCTS",
              "RCC",  "RCT",
              "CID "]
-    hypodd_df = read_csv("hypoDD.reloc", delim_whitespace=True, names=names)
+    hypodd_df = read_csv(os.path.join(path, "hypoDD.reloc"),
+                         delim_whitespace=True, names=names)
     hypodd_df.sort_values(by=["ID"], inplace=True)
     hypodd_df.set_index(["ID"], inplace=True, drop=False)
     return hypodd_df
@@ -169,9 +116,10 @@ def loadVelocityFile(config):
     return velocity_df
 
 
-def hypoddReloc2xyzm(nEvents, outName):
-    hypodd_df = loadHypoDDRelocFile()
-    outputFile = f"xyzm_{outName}.dat"
+def hypoddReloc2xyzm(nEvents, outName, fmt="text", path="", hypodd_df=None):
+    if hypodd_df is None:
+        hypodd_df = loadHypoDDRelocFile(path)
+    outputFile = xyzmPath(outName, fmt, path)
     hypodd_df["year"] = hypodd_df.YR
     hypodd_df["month"] = hypodd_df.MO.replace(0, 1)
     hypodd_df["day"] = hypodd_df.DY.replace(0, 1)
@@ -198,250 +146,166 @@ def hypoddReloc2xyzm(nEvents, outName):
     hypodd_df["RMS"] = hypodd_df.RCT
     hypodd_df["ERH"] = sqrt(hypodd_df.EX**2 + hypodd_df.EY**2)*1e-3
     hypodd_df["ERZ"] = hypodd_df.EZ*1e-3
-    columns = ["ORT", "Lon", "Lat", "Dep", "Mag",
-               "Nus", "NuP", "NuS", "ADS", "MDS", "GAP", "RMS", "ERH", "ERZ"]
     UnLocatedEventsID = set(range(1, nEvents+1)) - set(hypodd_df.index)
     for i in UnLocatedEventsID:
         hypodd_df.loc[i] = nan
     hypodd_df.sort_index(inplace=True)
-    with open(outputFile, "w") as f:
-        hypodd_df.to_string(f, columns=columns, index=False, formatters={
-            "ORT": "{:}".format,
-            "Lon": "{:7.3f}".format,
-            "Lat": "{:7.3f}".format,
-            "Dep": "{:7.3f}".format,
-            "Mag": "{:4.1f}".format,
-            "Nus": "{:3.0f}".format,
-            "NuP": "{:3.0f}".format,
-            "NuS": "{:3.0f}".format,
-            "ADS": "{:5.1f}".format,
-            "MDS": "{:5.1f}".format,
-            "GAP": "{:3.0f}".format,
-            "RMS": "{:5.2f}".format,
-            "ERH": "{:7.3f}".format,
-            "ERZ": "{:7.3f}".format,
-        })
+    writeXyzm(hypodd_df, outputFile)
     return len(hypodd_df)
 
 
-def computeExtraInfo(evLon, evLat, arrivals, stationFile):
+def loadStationTable(stationFile):
+    """Load used stations once, indexed by station code
+
+    Args:
+        stationFile (str): path to the used stations file
+
+    Returns:
+        DataFrame: station coordinates
+    """
     station_df = read_csv(stationFile)
-    codes = list(set([arv.pick.waveform_id.station_code for arv in arrivals]))
-    station_df = station_df[station_df.code.isin(codes)]
-    station_df[["Dist"]] = station_df.apply(
-        lambda x: Series(gps(evLat, evLon, x.lat, x.lon)[0]*1e-3), axis=1)
-    station_df[["Azim"]] = station_df.apply(
-        lambda x: Series(gps(evLat, evLon, x.lat, x.lon)[1]), axis=1)
-    azimuths = station_df["Azim"].sort_values()
-    Dist = station_df["Dist"]
-    GAP = int(max(diff(azimuths)))
-    ADS = Dist.mean()
-    MDS = Dist.min()
-    Nus = len(codes)
-    NuP = sum([1 for arrival in arrivals if arrival.phase.upper().startswith("P")])
-    NuS = sum([1 for arrival in arrivals if arrival.phase.upper().startswith("S")])
-    return Nus, NuP, NuS, ADS, MDS, GAP
-
-
-def hypoDD2nordic(catalog, stationFile, outName):
-    catalog = catalog.copy()
+    station_df.code = station_df.code.str.strip()
+    station_df.drop_duplicates(["code"], inplace=True)
+    return station_df.set_index("code")
+
+
+def computeStationStats(lons, lats, picks, station_df):
+    """Compute station statistics of a whole chunk in one call
+
+    Distances and azimuths are computed at once with vectorized geodesics,
+    only for the event/station pairs that were actually used.
+
+    Args:
+        lons (array): event longitudes, one per chunk row
+        lats (array): event latitudes, one per chunk row
+        picks (DataFrame): arrivals with chunk row "pos", "sta" and "aph"
+        station_df (DataFrame): stations indexed by code
+
+    Returns:
+        DataFrame: Nus, NuP, NuS, ADS, MDS and GAP indexed by chunk row
+    """
+    stats = DataFrame(index=range(len(lons)),
+                      columns=["Nus", "NuP", "NuS", "ADS", "MDS", "GAP"],
+                      dtype=float)
+    located = ~(isnan(lons) | isnan(lats))
+    picks = picks[located[picks.pos.values]]
+    phase = picks.aph.str.upper()
+    pos = picks.pos
+    stats["NuP"] = phase.str.startswith("P").groupby(pos).sum()
+    stats["NuS"] = phase.str.startswith("S").groupby(pos).sum()
+    pairs = picks[["pos", "sta"]].drop_duplicates()
+    stats["Nus"] = pairs.groupby("pos").size()
+    pairs = pairs[pairs.sta.isin(station_df.index)]
+    staLons = station_df.lon.reindex(pairs.sta).values
+    staLats = station_df.lat.reindex(pairs.sta).values
+    azim, _, dist = Geod(ellps="WGS84").inv(lons[pairs.pos.values],
+                                            lats[pairs.pos.values],
+                                            staLons,
+                                            staLats)
+    pairs = pairs.assign(Dist=dist*1e-3, Azim=azim % 360.0)
+    stats["ADS"] = pairs.groupby("pos").Dist.mean()
+    stats["MDS"] = pairs.groupby("pos").Dist.min()
+    pairs = pairs.sort_values(by=["pos", "Azim"])
+    pairs["gap"] = pairs.groupby("pos").Azim.diff()
+    stats["GAP"] = pairs.groupby("pos").gap.max().apply(floor)
+    stats.loc[~located] = nan
+    return stats
+
+
+def hypoDD2nordic(catalog,
+                  stationFile,
+                  outName,
+                  core=None,
+                  mode="patch",
+                  fmt="text",
+                  path=""):
+    """Write relocated origins to Nordic and xyzm files
+
+    Args:
+        catalog (dict): catalog tables of the chunk
+        stationFile (str): path to the used stations file
+        outName (str): name used for output files
+        core (array, optional): mask of events written to Nordic file.
+        mode (str, optional): "patch" rewrites hypocentre lines of input
+        file, "obspy" re-serializes events. Defaults to "patch".
+        fmt (str, optional): xyzm file format. Defaults to "text".
+        path (str, optional): directory of input and output files, the
+        working directory by default.
+    """
     print(f"+++ Reading & Updating catalog for {outName} ...")
-    hypodd_df = read_csv(f"xyzm_{outName}.dat", delim_whitespace=True)
+    hypodd_df = readXyzm(xyzmPath(outName, fmt, path))
+    picks = catalog["picks"]
+    picks = picks[picks.arr]
+    picks = picks.assign(pos=catalog["events"].index.get_indexer(picks.evt))
+    stats = computeStationStats(hypodd_df.Lon.values,
+                                hypodd_df.Lat.values,
+                                picks,
+                                loadStationTable(stationFile))
     hypodd_df_out = hypodd_df.copy()
-    hypodd_df.ERH = k2d(hypodd_df.ERH)
-    hypodd_df.ERZ = hypodd_df.ERZ*1e3
-    hypodd_df.replace(nan, None, inplace=True)
-    outCatalog = Catalog()
-    for r, row in hypodd_df.iterrows():
-        event = catalog[r]
-        preferred_origin = event.preferred_origin()
-        arrivals = preferred_origin.arrivals
-        picks = {pick.resource_id: pick for pick in event.picks}
-        for arrival in arrivals:
-            arrival.update({"pick": picks[arrival.pick_id]})
-        eOrt = utc(row.ORT) if row.ORT else preferred_origin.time
-        eLat = row.Lat
-        erLat = row.ERH
-        eLon = row.Lon
-        erLon = row.ERH
-        eDep = row.Dep
-        erDep = row.ERZ
-        preferred_origin.time = eOrt
-        preferred_origin.latitude = eLat
-        preferred_origin.longitude = eLon
-        preferred_origin.depth = eDep*1e3 if eDep else None
-        preferred_origin.latitude_errors.uncertainty = erLat
-        preferred_origin.longitude_errors.uncertainty = erLon
-        preferred_origin.depth_errors.uncertainty = erDep
-        preferred_origin.quality.azimuthal_gap = row.GAP
-        if None not in [eLat, eLon]:
-            Nus, NuP, NuS, ADS, MDS, GAP = computeExtraInfo(
-                eLon, eLat, arrivals, stationFile)
-            hypodd_df_out.loc[r, "Nus"] = Nus
-            hypodd_df_out.loc[r, "NuP"] = NuP
-            hypodd_df_out.loc[r, "NuS"] = NuS
-            hypodd_df_out.loc[r, "ADS"] = ADS
-            hypodd_df_out.loc[r, "MDS"] = MDS
-            hypodd_df_out.loc[r, "GAP"] = GAP
-            preferred_origin.quality.azimuthal_gap = GAP
-        outCatalog.append(event)
-        hypodd_df_out.loc[r, "Mag"] = row.Mag
-    outCatalog.write(f"{outName}_hypodd.out",
-                     format="nordic", high_accuracy=False)
-    columns = ["ORT", "Lon", "Lat", "Dep", "Mag",
-               "Nus", "NuP", "NuS", "ADS", "MDS", "GAP", "RMS", "ERH", "ERZ"]
-    with open(f"xyzm_{outName}_hypodd.dat", "w") as f:
-        hypodd_df_out.to_string(
-            f, columns=columns, index=False, formatters={
-                "ORT": "{:}".format,
-                "Lon": "{:7.3f}".format,
-                "Lat": "{:7.3f}".format,
-                "Dep": "{:7.3f}".format,
-                "Mag": "{:4.1f}".format,
-                "Nus": "{:3.0f}".format,
-                "NuP": "{:3.0f}".format,
-                "NuS": "{:3.0f}".format,
-                "ADS": "{:5.1f}".format,
-                "MDS": "{:5.1f}".format,
-                "GAP": "{:3.0f}".format,
-                "RMS": "{:5.2f}".format,
-                "ERH": "{:7.3f}".format,
-                "ERZ": "{:7.3f}".format,
-            })
-
-
-def catalog2xyzm(catalog, outName):
+    hypodd_df_out.update(stats)
+    relocated = hypodd_df[["ORT", "Lat", "Lon", "Dep", "ERH", "ERZ"]].assign(
+        GAP=stats.GAP.where(stats.Nus.notna(), hypodd_df.GAP))
+    nordicFile = os.path.join(path, f"{outName}_hypodd.out")
+    if mode == "obspy":
+        writeNordicEvents(catalog, relocated, nordicFile, core)
+    else:
+        patchNordic(catalog, relocated, nordicFile, core)
+    writeXyzm(hypodd_df_out, xyzmPath(f"{outName}_hypodd", fmt, path))
+
+
+def catalog2xyzm(catalog, outName, fmt="text", path=""):
     """Convert catalog to xyzm file format
 
     Args:
-        hypInp (str): file name of NORDIC file
-        catalogFileName (str): file name of xyzm.dat file
+        catalog (dict): catalog tables
+        outName (str): name used for xyzm file
+        fmt (str, optional): xyzm file format. Defaults to "text".
+        path (str, optional): directory of xyzm file, the working
+        directory by default.
     """
-    outputFile = f"xyzm_{outName:s}_initial.dat"
-    catDict = {}
-    for i, event in enumerate(catalog):
-        preferred_origin = event.preferred_origin()
-        preferred_magnitude = event.preferred_magnitude()
-        arrivals = preferred_origin.arrivals
-        ort = preferred_origin.time
-        lat = preferred_origin.latitude
-        lon = preferred_origin.longitude
-        mag = preferred_magnitude.mag if preferred_magnitude else nan
-        try:
-            dep = preferred_origin.depth*0.001
-        except TypeError:
-            dep = nan
-        try:
-            nus = handleNone(
-                preferred_origin.quality.used_station_count, dtype="int")
-        except AttributeError:
-            nus = nan
-        nuP = len(
-            [arrival.phase for arrival in arrivals if "P" in arrival.phase.upper()])
-        nuS = len(
-            [arrival.phase for arrival in arrivals if "S" in arrival.phase.upper()])
-        mds = handleNone(
-            min([handleNone(arrival.distance) for arrival in preferred_origin.arrivals]), degree=True)
-        ads = round_(handleNone(
-            mean([handleNone(arrival.distance) for arrival in preferred_origin.arrivals]), degree=True), 2)
-        try:
-            gap = handleNone(
-                preferred_origin.quality.azimuthal_gap, dtype="int")
-        except AttributeError:
-            gap = nan
-        rms = getRMS(preferred_origin.arrivals)
-        erh = getHer(event)
-        erz = getZer(event)
-        catDict[i] = {
-            "ORT": ort,
-            "Lon": lon,
-            "Lat": lat,
-            "Dep": dep,
-            "Mag": mag,
-            "Nus": nus,
-            "NuP": nuP,
-            "NuS": nuS,
-            "ADS": ads,
-            "MDS": mds,
-            "GAP": gap,
-            "RMS": rms,
-            "ERH": erh,
-            "ERZ": erz,
-        }
-    df = DataFrame(catDict).T
-    df = df.replace({"None": nan})
-    with open(outputFile, "w") as f:
-        df.to_string(f, index=False, formatters={
-            "ORT": "{:}".format,
-            "Lon": "{:7.3f}".format,
-            "Lat": "{:7.3f}".format,
-            "Dep": "{:7.3f}".format,
-            "Mag": "{:4.1f}".format,
-            "Nus": "{:3.0f}".format,
-            "NuP": "{:3.0f}".format,
-            "NuS": "{:3.0f}".format,
-            "ADS": "{:5.1f}".format,
-            "MDS": "{:5.1f}".format,
-            "GAP": "{:3.0f}".format,
-            "RMS": "{:5.2f}".format,
-            "ERH": "{:5.1f}".format,
-            "ERZ": "{:5.1f}".format,
-        })
+    df = catalog["events"].copy()
+    df["ORT"] = to_datetime(df.ORT, unit="ns").dt.strftime(
+        "%Y-%m-%dT%H:%M:%S.%fZ")
+    writeXyzm(df, xyzmPath(f"{outName}_initial", fmt, path))
 
 
 def loadxyzm(*xyzmPaths):
     reports = []
-    for xyzmPath in xyzmPaths:
-        report = read_csv(xyzmPath, sep="\s+")
+    for path in xyzmPaths:
+        report = readXyzm(path)
         reports.append(report)
     return reports
 
 
-def mergeDFs(nChunks, outName):
-    initial_xyzm_df = DataFrame()
-    hypodd_xyzm_df = DataFrame()
-    for nChunk in range(nChunks+1):
-        initial_db_path = os.path.join(
-            f"chunk_{nChunk+1}", f"xyzm_{outName}_initial.dat")
-        hypodd_db_path = os.path.join(
-            f"chunk_{nChunk+1}", f"xyzm_{outName}_hypodd.dat")
-        initial_db, hypodd_db = loadxyzm(initial_db_path, hypodd_db_path)
-        initial_xyzm_df = concat([initial_xyzm_df, initial_db])
-        hypodd_xyzm_df = concat([hypodd_xyzm_df, hypodd_db])
-    columns = ["ORT", "Lon", "Lat", "Dep", "Mag",
-               "Nus", "NuP", "NuS", "ADS", "MDS", "GAP", "RMS", "ERH", "ERZ"]
-    with open(f"xyzm_{outName}_initial.dat", "w") as f, open(f"xyzm_{outName}_hypodd.dat", "w") as g:
-        initial_xyzm_df.to_string(
-            f, columns=columns, index=False, formatters={
-                "ORT": "{:}".format,
-                "Lon": "{:7.3f}".format,
-                "Lat": "{:7.3f}".format,
-                "Dep": "{:7.3f}".format,
-                "Mag": "{:4.1f}".format,
-                "Nus": "{:3.0f}".format,
-                "NuP": "{:3.0f}".format,
-                "NuS": "{:3.0f}".format,
-                "ADS": "{:5.1f}".format,
-                "MDS": "{:5.1f}".format,
-                "GAP": "{:3.0f}".format,
-                "RMS": "{:5.2f}".format,
-                "ERH": "{:7.3f}".format,
-                "ERZ": "{:7.3f}".format,
-            })
-        hypodd_xyzm_df.to_string(
-            g, columns=columns, index=False, formatters={
-                "ORT": "{:}".format,
-                "Lon": "{:7.3f}".format,
-                "Lat": "{:7.3f}".format,
-                "Dep": "{:7.3f}".format,
-                "Mag": "{:4.1f}".format,
-                "Nus": "{:3.0f}".format,
-                "NuP": "{:3.0f}".format,
-                "NuS": "{:3.0f}".format,
-                "ADS": "{:5.1f}".format,
-                "MDS": "{:5.1f}".format,
-                "GAP": "{:3.0f}".format,
-                "RMS": "{:5.2f}".format,
-                "ERH": "{:7.3f}".format,
-                "ERZ": "{:7.3f}".format,
-            })
+def mergeDFs(chunkIds, outName, fmt="text", previous=None, path=""):
+    """Merge core events of chunks into one pair of xyzm files
+
+    Args:
+        chunkIds (list): numbers of chunks to merge, starting from zero
+        outName (str): name used for xyzm files
+        fmt (str, optional): xyzm file format. Defaults to "text".
+        previous (tuple, optional): initial and hypoDD xyzm tables, with
+        "evt", of events kept from a previous run.
+        path (str, optional): results directory holding chunk directories,
+        the working directory by default.
+
+    Returns:
+        tuple: merged initial and hypoDD xyzm tables, sorted by event
+    """
+    initial_dbs = [] if previous is None else [previous[0]]
+    hypodd_dbs = [] if previous is None else [previous[1]]
+    for nChunk in chunkIds:
+        chunkPath = os.path.join(path, f"chunk_{nChunk+1}")
+        initial_db, hypodd_db = loadxyzm(
+            xyzmPath(f"{outName}_initial", fmt, chunkPath),
+            xyzmPath(f"{outName}_hypodd", fmt, chunkPath))
+        chunk_events = read_csv(os.path.join(chunkPath, "chunkEvents.csv"))
+        for db in [initial_db, hypodd_db]:
+            db["evt"] = chunk_events.evt.values
+        initial_dbs.append(initial_db[chunk_events.core.values])
+        hypodd_dbs.append(hypodd_db[chunk_events.core.values])
+    initial_xyzm_df = concat(initial_dbs).sort_values(by=["evt"])
+    hypodd_xyzm_df = concat(hypodd_dbs).sort_values(by=["evt"])
+    writeXyzm(initial_xyzm_df, xyzmPath(f"{outName}_initial", fmt, path))
+    writeXyzm(hypodd_xyzm_df, xyzmPath(f"{outName}_hypodd", fmt, path))
+    return initial_xyzm_df, hypodd_xyzm_df
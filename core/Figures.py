@@ -0,0 +1,300 @@
+import hashlib
+import json
+import os
+from concurrent.futures import as_completed
+from pathlib import Path
+
+import proplot as plt
+from numpy import abs as npabs
+from numpy import hypot, iinfo, load, savez
+from pandas import DataFrame, Timestamp, period_range, read_csv, to_datetime
+
+from core.Chunking import regionProjection
+from core.Config import processPool
+from core.Density import decimateEvents
+from core.Extra import loadxyzm, logger
+from core.Pipeline import fileDigest
+from core.Xyzm import xyzmPath
+
+PROJECTED_COLUMNS = ["t", "x", "y", "z", "Mag"]
+CATALOGS = ["initial", "hypodd"]
+NAT = iinfo("int64").min
+TITLES = {"initial": "Initial", "hypodd": "Relocated"}
+
+
+def projectedCatalogs(config, figuresPath, resultsPath="results"):
+    """Load initial and relocated events with projected coordinates
+
+    Projected tables are cached next to the figures and reused while the
+    xyzm files and study region are unchanged.
+
+    Args:
+        config (dict): configuration parameters
+        figuresPath (str): directory of figures
+        resultsPath (str, optional): directory of xyzm files.
+
+    Returns:
+        dict: "initial" and "hypodd" tables of origin time in ns (NAT if
+        unknown), x, y and z in km and magnitude
+    """
+    outName = f"{config['Region']['RegionName']}"
+    xyzmFormat = config["Relocation"]["XyzmFormat"]
+    paths = [xyzmPath(f"{outName}_{name}", xyzmFormat, resultsPath)
+             for name in CATALOGS]
+    key = hashlib.sha1(json.dumps([[fileDigest(p) for p in paths],
+                                   config["Region"]],
+                                  sort_keys=True).encode()).hexdigest()
+    cacheFile = os.path.join(figuresPath, f"projected_{outName}.npz")
+    if os.path.exists(cacheFile):
+        with load(cacheFile) as data:
+            if str(data["key"]) == key:
+                return {name: DataFrame({c: data[f"{name}_{c}"]
+                                         for c in PROJECTED_COLUMNS})
+                        for name in CATALOGS}
+    print("+++ Projecting catalogs for figures ...")
+    proj = regionProjection(config)
+    tables = {}
+    reports = loadxyzm(*paths)
+    valid = (reports[1].ORT.notna() & reports[1].Lon.notna() &
+             reports[1].Lat.notna()).values
+    for name, report in zip(CATALOGS, reports):
+        report = report[valid]
+        x, y = proj(report.Lon.values, report.Lat.values)
+        tables[name] = DataFrame({
+            "t": to_datetime(report.ORT, errors="coerce").dt.tz_localize(
+                None).values.astype("datetime64[ns]").astype("int64"),
+            "x": x,
+            "y": y,
+            "z": report.Dep.values,
+            "Mag": report.Mag.values})
+    Path(figuresPath).mkdir(parents=True, exist_ok=True)
+    savez(cacheFile, key=key, **{f"{name}_{c}": tables[name][c].values
+                                 for name in CATALOGS
+                                 for c in PROJECTED_COLUMNS})
+    return tables
+
+
+def profileSection(config, profile, db):
+    """Select events near a profile and measure their position along it
+
+    Args:
+        config (dict): configuration parameters
+        profile (dict): profile with "Start" and "End" as [lon, lat] and
+        "Width", the half-width in km
+        db (DataFrame): projected events
+
+    Returns:
+        DataFrame: events within Width of the profile, with "d" the
+        distance along it in km
+    """
+    proj = regionProjection(config)
+    x0, y0 = proj(*profile["Start"])
+    x1, y1 = proj(*profile["End"])
+    length = hypot(x1 - x0, y1 - y0)
+    ux, uy = (x1 - x0)/length, (y1 - y0)/length
+    d = (db.x.values - x0)*ux + (db.y.values - y0)*uy
+    offset = (db.x.values - x0)*uy - (db.y.values - y0)*ux
+    inside = (d >= 0) & (d <= length) & (npabs(offset) <= profile["Width"])
+    return db[inside].assign(d=d[inside])
+
+
+def plotProfile(task):
+    """Draw depth sections of initial and relocated events along a profile
+
+    Args:
+        task (dict): figure file, profile, style settings and sections
+
+    Returns:
+        str: figure file
+    """
+    style = task["style"]
+    plt.rc.update(
+        {'fontsize': 7, 'legend.fontsize': 6, 'label.weight': 'bold'})
+    fig, axs = plt.subplots(ncols=2, share=True, refaspect=2)
+    axs.format(
+        xlabel="Distance along profile (km)",
+        ylabel="Depth (km)",
+        xlim=(0, task["length"]),
+        ylim=(style["EventsMaxDepth"], 0),
+        suptitle=f"Profile {task['name']}")
+    for ax, name in zip(axs, CATALOGS):
+        db = task["sections"][name]
+        ax.scatter(db.d, db.z, s=10*10**db.Mag, c="gray5",
+                   mec="k", mew=0.2, rasterized=True)
+        ax.format(title=f"{TITLES[name]} ({len(db)} events)")
+        ax.grid(True, ls=":")
+    fig.save(task["file"])  # type: ignore
+    plt.close(fig)
+    return task["file"]
+
+
+def plotFrame(task):
+    """Draw map views of initial and relocated events of a time window
+
+    Events before the window are drawn in light gray for context.
+
+    Args:
+        task (dict): figure file, window, style settings and events
+
+    Returns:
+        str: figure file
+    """
+    style = task["style"]
+    plt.rc.update(
+        {'fontsize': 7, 'legend.fontsize': 6, 'label.weight': 'bold'})
+    fig, axs = plt.subplots(ncols=2, share=True)
+    axs.format(
+        xlabel="Easting (km)",
+        ylabel="Northing (km)",
+        xlim=task["extent"][:2],
+        ylim=task["extent"][2:],
+        suptitle=f"{task['start']} to {task['end']}")
+    for ax, name in zip(axs, CATALOGS):
+        before = task["before"][name]
+        ax.scatter(before.x, before.y, s=2, c="gray3", rasterized=True)
+        db = task["events"][name]
+        sc = ax.scatter(db.x, db.y, s=10*10**db.Mag, cmap="plasma_r",
+                        c=db.z, vmin=0, vmax=style["EventsMaxDepth"],
+                        mec="k", mew=0.2, rasterized=True)
+        ax.plot(task["stations"].x, task["stations"].y, marker="^", ms=3,
+                ls="", c="white", mec="k", mew=1.0, autoreverse=False)
+        ax.format(title=f"{TITLES[name]} ({len(db)} events)")
+        ax.grid(True, ls=":")
+    axs[1].colorbar(sc, loc="r", label="Depth (km)", format="%.0f")
+    fig.save(task["file"])  # type: ignore
+    plt.close(fig)
+    return task["file"]
+
+
+def taskKey(task):
+    """Hash the style settings and the data of a figure"""
+    sha = hashlib.sha1(json.dumps(task["spec"], sort_keys=True,
+                                  default=str).encode())
+    for group in ["sections", "events", "before"]:
+        for name in CATALOGS:
+            if group in task:
+                sha.update(task[group][name].values.tobytes())
+    return sha.hexdigest()
+
+
+def profileTasks(config, tables, figuresPath, style):
+    """Build a task per profile of Figures.Profiles"""
+    tasks = []
+    proj = regionProjection(config)
+    for profile in config["Figures"]["Profiles"]:
+        x0, y0 = proj(*profile["Start"])
+        x1, y1 = proj(*profile["End"])
+        sections = {name: profileSection(config, profile, tables[name])
+                    for name in CATALOGS}
+        tasks.append({"plot": plotProfile,
+                      "file": os.path.join(figuresPath,
+                                           f"profile_{profile['Name']}.png"),
+                      "name": profile["Name"],
+                      "length": hypot(x1 - x0, y1 - y0),
+                      "style": style,
+                      "spec": {"profile": profile, "style": style},
+                      "sections": sections})
+    return tasks
+
+
+def frameTasks(config, tables, stations_df, figuresPath, style):
+    """Build a task per time window of Figures.TimeLapse"""
+    window = config["Figures"]["TimeLapse"]
+    if not window:
+        return []
+    times = tables["hypodd"].t
+    times = times[times != NAT]
+    if not len(times):
+        return []
+    periods = period_range(Timestamp(times.min()), Timestamp(times.max()),
+                           freq=window)
+    extent = (min(t.x.min() for t in tables.values()),
+              max(t.x.max() for t in tables.values()),
+              min(t.y.min() for t in tables.values()),
+              max(t.y.max() for t in tables.values()))
+    maxPoints = config["Figures"]["MaxScatterPoints"]
+    tasks = []
+    for period in periods:
+        start = period.start_time
+        end = (period + 1).start_time
+        events = {}
+        before = {}
+        for name in CATALOGS:
+            db = tables[name]
+            t = db.t.values
+            events[name] = db[(t >= start.value) & (t < end.value)]
+            earlier = db[(t < start.value) & (t != NAT)]
+            before[name] = earlier[decimateEvents(earlier.x.values,
+                                                  earlier.y.values,
+                                                  earlier.Mag.values,
+                                                  maxPoints)]
+        if not len(events["hypodd"]) and not len(events["initial"]):
+            continue
+        label = start.strftime("%Y%m%d")
+        tasks.append({"plot": plotFrame,
+                      "file": os.path.join(figuresPath,
+                                           f"timelapse_{label}.png"),
+                      "start": start.date(),
+                      "end": end.date(),
+                      "extent": extent,
+                      "style": style,
+                      "spec": {"window": window, "style": style,
+                               "extent": extent,
+                               "stations": stations_df.values.tolist()},
+                      "stations": stations_df,
+                      "events": events,
+                      "before": before})
+    return tasks
+
+
+def plotFigures(config, runPath="."):
+    """Render cross-sections and time-lapse frames in parallel
+
+    Coordinates are projected once and cached. A figure is skipped when
+    its events and style settings are the same as when it was drawn.
+
+    Args:
+        config (dict): configuration parameters
+        runPath (str, optional): run directory holding stations and
+        results. Defaults to ".".
+
+    Returns:
+        list: figure files drawn
+    """
+    print("+++ Plotting cross-sections and time-lapse frames ...")
+    resultsPath = os.path.join(runPath, "results")
+    figuresPath = os.path.join(resultsPath, "figures")
+    Path(figuresPath).mkdir(parents=True, exist_ok=True)
+    tables = projectedCatalogs(config, figuresPath, resultsPath)
+    stations_df = read_csv(os.path.join(runPath, "stations",
+                                        "usedStations.csv"))
+    stations_df = stations_df[["x", "y"]]
+    style = {"EventsMaxDepth": config["Figures"]["EventsMaxDepth"]}
+    tasks = profileTasks(config, tables, figuresPath, style)
+    tasks += frameTasks(config, tables, stations_df, figuresPath, style)
+    manifestFile = os.path.join(figuresPath, "figures.json")
+    manifest = {}
+    if os.path.exists(manifestFile):
+        with open(manifestFile) as f:
+            manifest = json.load(f)
+    pending = []
+    for task in tasks:
+        task["key"] = taskKey(task)
+        if manifest.get(task["file"]) != task["key"] or \
+                not os.path.exists(task["file"]):
+            pending.append(task)
+    msg = f"Figures: {len(pending)} of {len(tasks)} to draw"
+    print(f"+++ {msg}")
+    logger(msg)
+    drawn = []
+    nWorkers = max(1, min(config["Figures"]["Workers"], len(pending)))
+    with processPool(nWorkers) as pool:
+        jobs = {pool.submit(task["plot"], task): task for task in pending}
+        for job in as_completed(jobs):
+            task = jobs[job]
+            job.result()
+            manifest[task["file"]] = task["key"]
+            drawn.append(task["file"])
+    with open(manifestFile, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return drawn
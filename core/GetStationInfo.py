@@ -1,31 +1,175 @@
-import os
-from urllib.request import urlretrieve
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 
-from github import Github
+import requests
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from yaml import safe_load
 
+from core.Extra import logger
+from core.StationCache import (openStationCache, readCachedStations,
+                               writeCachedStations)
 
-def download_IRSSI(outPath):
+
+def makeSession(nWorkers):
+    """Make an HTTP session keeping up to nWorkers connections alive
+
+    Args:
+        nWorkers (int): number of concurrent requests
+
+    Returns:
+        requests.Session: pooled session
     """
-    Download Iran Seismic Station Information Files
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=nWorkers, pool_maxsize=nWorkers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class StationProvider(ABC):
+    """Base class of station metadata providers
+
+    A provider gets station codes and returns the stations it knows as
+    dicts with "code", "lat", "lon" and "elv". It may return more
+    stations than asked for, they are cached as well. New providers are
+    registered in PROVIDERS and selected in the Stations section of
+    config.yml.
+    """
+    name = ""
+
+    def __init__(self, url, session, nWorkers=8, timeout=30):
+        self.url = url
+        self.session = session
+        self.nWorkers = nWorkers
+        self.timeout = timeout
+
+    def get(self, url, params=None):
+        response = self.session.get(url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    @abstractmethod
+    def fetch(self, codes):
+        """Get stations of codes, see StationProvider"""
+
+
+class IRSSIProvider(StationProvider):
+    """Iran Seismic Station Information files, listed through the GitHub
+    contents API and downloaded concurrently"""
+    name = "IRSSI"
+
+    def fetch(self, codes):
+        contents = self.get(self.url).json()
+        urls = [content["download_url"] for content in contents
+                if content["name"].endswith("yml")]
+        with ThreadPoolExecutor(max_workers=self.nWorkers) as pool:
+            texts = pool.map(lambda url: self.get(url).text, urls)
+        stations = {}
+        for text in texts:
+            for code, epochs in (safe_load(text) or {}).items():
+                stations[code] = {"code": code,
+                                  "lat": epochs[-1]["latitude"],
+                                  "lon": epochs[-1]["longitude"],
+                                  "elv": epochs[-1]["elevation"]}
+        return list(stations.values())
+
+
+class ISCProvider(StationProvider):
+    """ISC station search, queried concurrently in batches of codes"""
+    name = "ISC"
+    batchSize = 50
+
+    def fetchBatch(self, codes):
+        params = {"stnsearch": "STN",
+                  "sta_list": ",".join(codes),
+                  "stn_ctr_lat": "",
+                  "stn_ctr_lon": "",
+                  "stn_radius": "",
+                  "max_stn_dist_units": "deg",
+                  "stn_bot_lat": "",
+                  "stn_top_lat": "",
+                  "stn_left_lon": "",
+                  "stn_right_lon": "",
+                  "stn_srn": "",
+                  "stn_grn": ""}
+        soup = BeautifulSoup(self.get(self.url, params).content,
+                             "html.parser")
+        stations = []
+        for line in soup.text.splitlines():
+            code = line[:5].strip()
+            if code in codes:
+                stations.append({"code": code,
+                                 "lat": float(line[59:67]),
+                                 "lon": float(line[69:77]),
+                                 "elv": float(line[79:88])})
+        return stations
+
+    def fetch(self, codes):
+        batches = [codes[i:i+self.batchSize]
+                   for i in range(0, len(codes), self.batchSize)]
+        with ThreadPoolExecutor(max_workers=self.nWorkers) as pool:
+            results = pool.map(self.fetchBatch, batches)
+        return [station for stations in results for station in stations]
+
+
+PROVIDERS = {IRSSIProvider.name: IRSSIProvider,
+             ISCProvider.name: ISCProvider}
+
+
+def getStationsInfo(config, codes):
+    """Get coordinates of stations, from the cache first
+
+    Cache misses are asked to each configured provider in turn. In
+    offline mode only the cache is used, whatever the age of its rows.
+    Stations no provider knows are cached as missing, unless a provider
+    failed.
 
-    Returns
-    -------
-    names : list
-        A list of downloaded files.
+    Args:
+        config (dict): configuration parameters
+        codes (list): station codes
 
+    Returns:
+        tuple: list of found stations, in order of codes, and list of
+        missed station codes
     """
-    username = "saeedsltm"
-    g = Github()
-    user = g.get_user(username)
-
-    repo = user.get_repo("IR-SSI")
-    contents = repo.get_contents("")
-    names = []
-    for content in contents:
-        name = content.name
-        if name.endswith("yml"):
-            print(f"+++ Downloading {name} ...")
-            url = content.download_url
-            urlretrieve(url, filename=os.path.join(outPath, name))
-            names.append(name)
-    return names
+    stationsConfig = config["Stations"]
+    offline = stationsConfig["Offline"]
+    nWorkers = stationsConfig["Workers"]
+    conn = openStationCache(stationsConfig["CacheFile"])
+    ttl = None if offline else stationsConfig["CacheTTL"]
+    found, missed = readCachedStations(conn, codes, ttl)
+    print(f"+++ Found {len(found)} stations in cache ...")
+    toFetch = [code for code in codes if code not in found and
+               code not in missed]
+    if offline:
+        missed.extend(toFetch)
+        toFetch = []
+    session = makeSession(nWorkers)
+    failed = False
+    for name in stationsConfig["Providers"]:
+        if not toFetch:
+            break
+        print(f"+++ Fetching {len(toFetch)} stations from {name} ...")
+        provider = PROVIDERS[name](stationsConfig[f"{name}Url"],
+                                   session,
+                                   nWorkers)
+        try:
+            stations = provider.fetch(toFetch)
+        except (requests.RequestException, ValueError) as error:
+            msg = f"+++ Station provider {name} failed: {error}"
+            print(msg)
+            logger(msg)
+            failed = True
+            continue
+        writeCachedStations(conn, stations, name)
+        wanted = set(toFetch)
+        fetched = {s["code"]: s for s in stations if s["code"] in wanted}
+        found.update(fetched)
+        toFetch = [code for code in toFetch if code not in fetched]
+    if toFetch and not failed:
+        writeCachedStations(conn, [], "", toFetch)
+    conn.close()
+    missed.extend(toFetch)
+    stations = [found[code] for code in codes if code in found]
+    return stations, [code for code in codes if code in missed]
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from numpy import arange, isfinite, isin, load, ones, savez, vstack
+from pandas import DataFrame, Series
+from pandas.util import hash_pandas_object
+from scipy.spatial import cKDTree
+
+from core.Chunking import projectEvents
+from core.Xyzm import XYZM_COLUMNS, readXyzm, writeXyzm, xyzmPath
+
+PICK_FINGERPRINT_COLUMNS = ["sta", "pha", "aph", "tt", "wgt", "arr"]
+
+
+def eventFingerprints(catalog):
+    """Fingerprint origin and picks of each event
+
+    Picks are combined by a wrapping sum of their hashes, so the
+    fingerprint does not depend on pick order.
+
+    Args:
+        catalog (dict): catalog tables
+
+    Returns:
+        array: uint64 fingerprint of each event
+    """
+    events = catalog["events"]
+    picks = catalog["picks"]
+    eventHash = hash_pandas_object(events[XYZM_COLUMNS], index=False)
+    pickHash = hash_pandas_object(picks[PICK_FINGERPRINT_COLUMNS], index=False)
+    pickSum = pickHash.groupby(picks.evt.values).sum()
+    pickSum = pickSum.reindex(events.index, fill_value=0)
+    return hash_pandas_object(DataFrame({"event": eventHash.values,
+                                         "picks": pickSum.values}),
+                              index=False).values
+
+
+def settingsKey(config, hypoddConfig, stationFile):
+    """Compute the key of settings that relocation results depend on
+
+    Args:
+        config (dict): configuration parameters
+        hypoddConfig (dict): hypoDD configuration parameters
+        stationFile (str): path to the used stations file
+
+    Returns:
+        str: sha1 digest of settings and station file
+    """
+    relocation = {k: v for k, v in config["Relocation"].items()
+                  if k not in ["Workers", "Incremental", "ProgramTimeout",
+                               "ProgramMaxMemoryMB"]}
+    settings = {"Region": config["Region"],
+                "VelocityModel": config["VelocityModel"],
+                "Relocation": relocation,
+                "hypoDD": hypoddConfig}
+    if config["CrossCorrelation"]["Enabled"]:
+        settings["CrossCorrelation"] = {
+            k: v for k, v in config["CrossCorrelation"].items()
+            if k not in ["Workers", "BatchSize"]}
+    sha = hashlib.sha1(json.dumps(settings, sort_keys=True,
+                                  default=str).encode())
+    with open(stationFile, "rb") as f:
+        sha.update(f.read())
+    return sha.hexdigest()
+
+
+def loadState(statePath, outName, key):
+    """Load results of the previous run
+
+    Args:
+        statePath (str): directory of persisted state
+        outName (str): name used for output files
+        key (str): settings key of current run
+
+    Returns:
+        dict: fingerprints, initial and hypoDD xyzm tables, or None if
+        there is no state or it was made with other settings
+    """
+    fingerprintFile = os.path.join(statePath, f"{outName}_fingerprints.npz")
+    if not os.path.exists(fingerprintFile):
+        return None
+    with load(fingerprintFile) as data:
+        if str(data["key"]) != key:
+            return None
+        fingerprints = data["fingerprints"]
+    return {"fingerprints": fingerprints,
+            "initial": readXyzm(xyzmPath(f"{outName}_initial", "npz",
+                                         statePath)),
+            "hypodd": readXyzm(xyzmPath(f"{outName}_hypodd", "npz",
+                                        statePath))}
+
+
+def saveState(statePath, outName, key, fingerprints, initial_df, hypodd_df):
+    """Persist results of this run for the next incremental one
+
+    Args:
+        statePath (str): directory of persisted state
+        outName (str): name used for output files
+        key (str): settings key of current run
+        fingerprints (array): fingerprint of each event
+        initial_df (DataFrame): initial xyzm table, in catalog order
+        hypodd_df (DataFrame): relocated xyzm table, in catalog order
+    """
+    Path(statePath).mkdir(parents=True, exist_ok=True)
+    writeXyzm(initial_df, xyzmPath(f"{outName}_initial", "npz", statePath))
+    writeXyzm(hypodd_df, xyzmPath(f"{outName}_hypodd", "npz", statePath))
+    savez(os.path.join(statePath, f"{outName}_fingerprints.npz"),
+          key=key,
+          fingerprints=fingerprints)
+
+
+def affectedEvents(config, hypoddConfig, catalog, fingerprints, state):
+    """Flag events whose relocation may differ from the previous run
+
+    New or changed events are affected, and so is every event within
+    MAXSEP of them or of an event removed from the catalog, since its
+    differential times may have changed.
+
+    Args:
+        config (dict): configuration parameters
+        hypoddConfig (dict): hypoDD configuration parameters
+        catalog (dict): catalog tables
+        fingerprints (array): fingerprint of each event
+        state (dict): state of the previous run, None flags all events
+
+    Returns:
+        array: boolean mask over catalog events
+    """
+    if state is None:
+        return ones(len(catalog["events"]), dtype=bool)
+    changed = ~isin(fingerprints, state["fingerprints"])
+    removed = ~isin(state["fingerprints"], fingerprints)
+    xyz = projectEvents(config, catalog["events"])
+    seeds = vstack([xyz[changed],
+                    projectEvents(config, state["initial"][removed])])
+    if not len(seeds):
+        return changed
+    distance, _ = cKDTree(seeds).query(
+        xyz, distance_upper_bound=hypoddConfig["MAXSEP"])
+    return changed | isfinite(distance)
+
+
+def previousResults(state, fingerprints, keep, index):
+    """Take results of unaffected events from the previous run
+
+    Args:
+        state (dict): state of the previous run
+        fingerprints (array): fingerprint of each event
+        keep (array): mask of events whose results are reused
+        index (array): event numbers in catalog
+
+    Returns:
+        tuple: initial and hypoDD xyzm tables of kept events with "evt"
+    """
+    rows = Series(arange(len(state["fingerprints"])),
+                  index=state["fingerprints"])
+    rows = rows[~rows.index.duplicated()]
+    rows = rows.reindex(fingerprints[keep]).values
+    tables = []
+    for name in ["initial", "hypodd"]:
+        db = state[name].iloc[rows].reset_index(drop=True)
+        db["evt"] = index[keep]
+        tables.append(db)
+    return tuple(tables)
+
+
+def chunkKey(settings, fingerprints, index, core, members):
+    """Compute the key of a chunk relocation
+
+    Args:
+        settings (str): settings key of current run
+        fingerprints (array): fingerprint of each event
+        index (array): event numbers in catalog
+        core (array): positions of events whose results are kept
+        members (array): positions of chunk events, halo included
+
+    Returns:
+        str: sha1 digest of settings, chunk events and core mask
+    """
+    sha = hashlib.sha1(settings.encode())
+    sha.update(fingerprints[members].tobytes())
+    sha.update(index[members].astype("int64").tobytes())
+    sha.update(isin(members, core).tobytes())
+    return sha.hexdigest()
+
+
+def chunkComplete(chunkPath, key):
+    """Check if a chunk was fully relocated with the given key"""
+    markerFile = os.path.join(chunkPath, "chunkDone.json")
+    if not os.path.exists(markerFile):
+        return False
+    with open(markerFile) as f:
+        return json.load(f)["key"] == key
+
+
+def markChunk(chunkPath, key=None):
+    """Mark a chunk as fully relocated, or clear the mark if key is None"""
+    markerFile = os.path.join(chunkPath, "chunkDone.json")
+    if key is None:
+        if os.path.exists(markerFile):
+            os.remove(markerFile)
+        return
+    with open(markerFile, "w") as f:
+        json.dump({"key": key}, f)
@@ -1,13 +1,28 @@
 import os
 
-from numpy import nan
+from numpy import datetime64, isnan
 from pandas import read_csv
 
+from core.Catalog import iterEvents
+from core.Config import RelocationError, logger
 
-def prepareStationFile(stationFile):
+PICK_WEIGHTS = {0: 1.00,
+                1: 0.75,
+                2: 0.50,
+                3: 0.25,
+                4: 0.00, }
+# NITER, WTCTP, WTCTS, WRCT, WDCT of each iteration set, DAMP and WTCC
+# come from hypodd.yml
+ITERATION_SETS = [(5, 1.0, 1.0, -9, -9),
+                  (5, 1.0, 0.8, 10, 20),
+                  (5, 1.0, 0.8, 9, 15),
+                  (5, 1.0, 0.8, 8, 10)]
+
+
+def prepareStationFile(stationFile, path=""):
     station_df = read_csv(stationFile)
     station_df.code = station_df.code.str.strip()
-    station_df.to_csv("station.dat",
+    station_df.to_csv(os.path.join(path, "station.dat"),
                       header=None,
                       index=None,
                       sep=" ",
@@ -26,37 +41,49 @@ def prepareVelocity(velocity_df):
     return velocities, depths, VpVs, nLayers
 
 
-def preparePhaseFile(catalog):
-    phaseFile = os.path.join("phase.dat")
-    ws = {"0": 1.00,
-          "1": 0.75,
-          "2": 0.50,
-          "3": 0.25,
-          "4": 0.00, }
-    with open(phaseFile, "w") as f:
-        for e, event in enumerate(catalog):
-            po = event.preferred_origin()
-            pm = event.preferred_magnitude()
-            ORT = po.time.strftime("%Y %m %d %H %M %S.%f")
-            LAT = po.latitude
-            LON = po.longitude
-            DEP = po.depth*1e-3 if po.depth else 10.0
-            MAG = pm.mag if pm else nan
-            picks = event.picks
-            header = f"# {ORT} {LAT:6.3f} {LON:6.3f} {DEP:5.1f} {MAG:4.1f} 0.0 0.0 0.0 {e+1:9.0f}\n"
-            f.write(header)
-            for arrival in po.arrivals:
-                pick = [p for p in picks if p.resource_id == arrival.pick_id][0]
-                sta = pick.waveform_id.station_code
-                tt = pick.time - po.time
-                w = ws[pick.extra["nordic_pick_weight"]["value"]]
-                pha = pick.phase_hint
-                phase = f"{sta:4s} {tt:6.3f} {w:4.2f} {pha:1s}\n"
-                f.write(phase)
-
-
-def preparePH2DT(config, hypoddConfig):
-    ph2dtFile = os.path.join("ph2dt.inp")
+def writePhaseFile(events, phaseFile="phase.dat", flushEvery=1000):
+    """Write a ph2dt phase file from a stream of events
+
+    Args:
+        events (iterable): (event, picks) records as yielded by iterEvents
+        phaseFile (str, optional): path to output phase file.
+        flushEvery (int, optional): number of events buffered per write.
+
+    Returns:
+        int: number of events written
+    """
+    ws = PICK_WEIGHTS
+    buffer = []
+    nEvents = 0
+    with open(phaseFile, "w", buffering=1 << 20) as f:
+        for event, picks in events:
+            nEvents += 1
+            t = str(datetime64(int(event.ORT), "ns"))
+            ORT = f"{t[:4]} {t[5:7]} {t[8:10]} {t[11:13]} {t[14:16]} {t[17:26]}"
+            LAT = event.Lat
+            LON = event.Lon
+            DEP = event.Dep if event.Dep and not isnan(event.Dep) else 10.0
+            MAG = event.Mag
+            buffer.append(f"# {ORT} {LAT:6.3f} {LON:6.3f} {DEP:5.1f} {MAG:4.1f} 0.0 0.0 0.0 {nEvents:9.0f}\n")
+            buffer.extend([f"{sta:4s} {tt:6.3f} {ws[w]:4.2f} {pha:1s}\n"
+                           for sta, tt, w, pha in zip(picks["sta"],
+                                                      picks["tt"],
+                                                      picks["wgt"],
+                                                      picks["pha"])])
+            if nEvents % flushEvery == 0:
+                f.write("".join(buffer))
+                buffer.clear()
+        f.write("".join(buffer))
+    return nEvents
+
+
+def preparePhaseFile(catalog, path=""):
+    phaseFile = os.path.join(path, "phase.dat")
+    writePhaseFile(iterEvents(catalog), phaseFile)
+
+
+def preparePH2DT(config, hypoddConfig, path=""):
+    ph2dtFile = os.path.join(path, "ph2dt.inp")
     MINWGHT = hypoddConfig["MINWGHT"]
     MAXDIST = hypoddConfig["MAXDIST"]
     MAXSEP = hypoddConfig["MAXSEP"]
@@ -81,19 +108,59 @@ def preparePH2DT(config, hypoddConfig):
         f.write("*MINOBS: min. number of links per pair saved [8]\n")
         f.write("*MAXOBS: max. number of links per pair saved [20]\n")
         f.write("*MINWGHT MAXDIST MAXSEP MAXNGH MINLNKS MINOBS MAXOBS\n")
-        f.write(f"{MINWGHT:0.0f}      {MAXDIST:0.0f}       {MAXSEP:0.0f}      {MAXNGH:0.0f}       {MINLNKS:0.0f}      {MINOBS:0.0f}      {MAXOBS:0.0f}\n")
+        f.write(f"{MINWGHT:g}      {MAXDIST:0.0f}       {MAXSEP:0.0f}      {MAXNGH:0.0f}       {MINLNKS:0.0f}      {MINOBS:0.0f}      {MAXOBS:0.0f}\n")
+
+
+def iterationSets(hypoddConfig, crossCorrelation=False):
+    """Get the iteration sets and weighting schedule of relocation
+
+    Args:
+        hypoddConfig (dict): hypoDD configuration parameters
+        crossCorrelation (bool, optional): weight cross-correlation data
+        with WTCC, otherwise they are not used (-9).
 
+    Raises:
+        RelocationError: if DAMP, or WTCC when used, do not have one value
+        per iteration set
 
-def prepareHypoDD(config, hypoddConfig, velocity_df):
+    Returns:
+        list: dicts of hypoDD iteration set parameters, NITER, WTCCP,
+        WTCCS, WRCC, WDCC, WTCTP, WTCTS, WRCT, WDCT and DAMP
+    """
+    for key in ["DAMP", "WTCC"] if crossCorrelation else ["DAMP"]:
+        if len(hypoddConfig[key]) != len(ITERATION_SETS):
+            msg = f"+++ {key} in hypoDD configuration must have \
+{len(ITERATION_SETS)} values, one per iteration set! Aborting ..."
+            print(msg)
+            logger(msg)
+            raise RelocationError(msg)
+    DAMP = hypoddConfig["DAMP"]
+    WTCC = hypoddConfig["WTCC"] if crossCorrelation else [-9]*len(DAMP)
+    return [{"NITER": NITER,
+             "WTCCP": WTCC[i], "WTCCS": WTCC[i], "WRCC": -9, "WDCC": -9,
+             "WTCTP": WTCTP, "WTCTS": WTCTS, "WRCT": WRCT, "WDCT": WDCT,
+             "DAMP": DAMP[i]}
+            for i, (NITER, WTCTP, WTCTS, WRCT, WDCT) in enumerate(
+                ITERATION_SETS)]
+
+
+def prepareHypoDD(config, hypoddConfig, velocity_df, path="",
+                  crossCorrelation=False):
+    """Write hypoDD.inp, using dt.cc along dt.ct if crossCorrelation is set"""
     DIST = hypoddConfig["DIST"]
     OBSCT = hypoddConfig["OBSCT"]
-    hypoddFile = os.path.join("hypoDD.inp")
+    IDAT, OBSCC = (3, hypoddConfig["OBSCC"]) if crossCorrelation else (2, 0)
+    hypoddFile = os.path.join(path, "hypoDD.inp")
     velocities, depths, VpVs, nLayers = prepareVelocity(velocity_df)
     with open(hypoddFile, "w") as f:
         f.write("* Make hypoDD.INP.\n")
         f.write("*--- input file selection\n")
-        f.write("* cross correlation diff times: (not used)\n")
-        f.write("\n")
+        if crossCorrelation:
+            f.write("* cross correlation diff times:\n")
+            f.write("dt.cc\n")
+        else:
+            f.write("* cross correlation diff times: (not used)\n")
+            f.write("\n")
         f.write("*\n")
         f.write("*catalog P & S diff times:\n")
         f.write("dt.ct\n")
@@ -123,13 +190,13 @@ def prepareHypoDD(config, hypoddConfig, velocity_df):
         f.write("* IPHA: 1= P; 2= S; 3= P&S\n")
         f.write("* DIST:max dist (km) between cluster centroid and station \n")
         f.write("* IDAT   IPHA   DIST\n")
-        f.write(f"    2     3     {DIST}\n")
+        f.write(f"    {IDAT}     3     {DIST}\n")
         f.write("*\n")
         f.write("*--- event clustering:\n")
         f.write("* OBSCC:    min # of obs/pair for crosstime data (0= no clustering)\n")
         f.write("* OBSCT:    min # of obs/pair for network data (0= no clustering)\n")
         f.write("* OBSCC  OBSCT    \n")
-        f.write(f"     0     {OBSCT}      \n")
+        f.write(f"     {OBSCC}     {OBSCT}      \n")
         f.write("*\n")
         f.write("*--- solution control:\n")
         f.write("* ISTART:       1 = from single source; 2 = from network sources\n")
@@ -147,10 +214,9 @@ def prepareHypoDD(config, hypoddConfig, velocity_df):
         f.write("* DAMP:                 damping (for lsqr only) \n")
         f.write("*       ---  CROSS DATA ----- ----CATALOG DATA ----\n")
         f.write("* NITER WTCCP WTCCS WRCC WDCC WTCTP WTCTS WRCT WDCT DAMP\n")
-        f.write("  5      -9     -9   -9   -9   1.0   1.0  -9    -9   95\n")
-        f.write("  5      -9     -9   -9   -9   1.0   0.8   10   20   85\n")
-        f.write("  5      -9     -9   -9   -9   1.0   0.8   9    15   75\n")
-        f.write("  5      -9     -9   -9   -9   1.0   0.8   8    10   65\n")
+        for iSet in iterationSets(hypoddConfig, crossCorrelation):
+            f.write("  {NITER}  {WTCCP:6g} {WTCCS:6g} {WRCC:4g} {WDCC:4g}   \
+{WTCTP:3.1f}   {WTCTS:3.1f} {WRCT:4g} {WDCT:5g}   {DAMP:0.0f}\n".format(**iSet))
         f.write("*\n")
         f.write("*--- 1D model:\n")
         f.write("* NLAY:         number of model layers  \n")
@@ -178,9 +244,10 @@ def prepareHypoddInputs(config,
                         catalog,
                         stationFile,
                         velocity_df,
-                        locationPath):
+                        locationPath,
+                        path=""):
     print("+++ Preparing HypoDD input files ...")
-    preparePhaseFile(catalog)
-    prepareStationFile(stationFile)
-    preparePH2DT(config, hypoddConfig)
-    prepareHypoDD(config, hypoddConfig, velocity_df)
+    preparePhaseFile(catalog, path)
+    prepareStationFile(stationFile, path)
+    preparePH2DT(config, hypoddConfig, path)
+    prepareHypoDD(config, hypoddConfig, velocity_df, path)
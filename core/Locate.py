@@ -1,62 +1,299 @@
 import os
+from concurrent.futures import as_completed
 from glob import glob
 from pathlib import Path
-from shutil import copy
+from shutil import copy, rmtree
 from time import time
 
+from numpy import arange, ones
+from pandas import DataFrame
+
+from core.Catalog import loadCatalog, selectEvents
+from core.Chunking import coreMask, makeChunks
+from core.Config import (RelocationError, currentRun, processPool,
+                         runContext)
+from core.CrossCorr import buildCrossCorrelationTimes
+from core.DiffTime import buildDifferentialTimes
 from core.Extra import (catalog2xyzm, hypoDD2nordic, loadVelocityFile, logger,
                         readHypoddConfig, hypoddReloc2xyzm, mergeDFs)
-from core.Input import prepareHypoddInputs
-from obspy import read_events
+from core.Incremental import (affectedEvents, chunkComplete, chunkKey,
+                              eventFingerprints, loadState, markChunk,
+                              previousResults, saveState, settingsKey)
+from core.Input import prepareHypoDD, prepareHypoddInputs
+from core.Metrics import measure
+from core.Nordic import patchNordic, writeNordicEvents
+from core.Runner import ProgramError, reportProgramError, runHypoDD, runPh2dt
+from core.Solver import relocateInProcess
+from core.Xyzm import xyzmPath
+
+
+def relocateChunk(nChunk,
+                  config,
+                  hypoddConfig,
+                  catalog,
+                  core,
+                  stationFile,
+                  velocity_df,
+                  locationPath,
+                  outName,
+                  key,
+                  run):
+    """Relocate one chunk of events inside its own directory
+
+    The chunk is marked complete with its key once all its outputs are
+    written, so an interrupted run resumes from unfinished chunks.
 
-def locateHypoDD(config):
-    hypoddConfig = readHypoddConfig()
+    Args:
+        nChunk (int): chunk number, starting from zero
+        config (dict): configuration parameters
+        hypoddConfig (dict): hypoDD configuration parameters
+        catalog (dict): catalog tables of the chunk
+        core (array): mask of chunk events whose results are kept
+        stationFile (str): path to the used stations file
+        velocity_df (DataFrame): velocity model
+        locationPath (str): path to the results directory
+        outName (str): name used for output files
+        key (str): chunk key, see core.Incremental.chunkKey
+        run (dict): run logs and metrics go to, see core.Config.currentRun
+
+    Returns:
+        tuple: chunk number, number of events and wall-clock time
+    """
+    st = time()
+    chunkPath = os.path.join(locationPath, f"chunk_{nChunk+1}")
+    Path(chunkPath).mkdir(parents=True, exist_ok=True)
+    with runContext(run):
+        markChunk(chunkPath)
+        nEvents = len(catalog["events"])
+        DataFrame({"evt": catalog["events"].index, "core": core}).to_csv(
+            os.path.join(chunkPath, "chunkEvents.csv"), index=False)
+        chunk = nChunk+1
+        files = {f: os.path.join(chunkPath, f)
+                 for f in ["phase.dat", "station.dat", "ph2dt.inp",
+                           "hypoDD.inp", "dt.ct", "dt.cc", "event.dat",
+                           "hypoDD.reloc", "hypoDD.log"]}
+        hypodd_df = None
+        if config["Relocation"]["Engine"] == "python":
+            with measure("solver", chunk, [stationFile], [],
+                         nEvents) as record:
+                hypodd_df = relocateInProcess(
+                    config, hypoddConfig, catalog, stationFile, velocity_df,
+                    os.path.join(locationPath, "cache"))
+                record["events"] = len(hypodd_df)
+        else:
+            with measure("phase", chunk, [stationFile],
+                         [files[f] for f in ["phase.dat", "station.dat",
+                                             "ph2dt.inp", "hypoDD.inp"]],
+                         nEvents):
+                prepareHypoddInputs(config,
+                                    hypoddConfig,
+                                    catalog,
+                                    stationFile,
+                                    velocity_df,
+                                    locationPath,
+                                    chunkPath)
+            with measure("ph2dt", chunk, [files["phase.dat"],
+                                          files["station.dat"]],
+                         [files["dt.ct"], files["event.dat"]],
+                         nEvents) as record:
+                if config["Relocation"]["DiffTimes"] == "builtin":
+                    buildDifferentialTimes(config, hypoddConfig, catalog,
+                                           stationFile, files["dt.ct"],
+                                           files["event.dat"])
+                else:
+                    runPh2dt(config, record, chunkPath)
+            if config["CrossCorrelation"]["Enabled"]:
+                with measure("crosscorr", chunk, [files["dt.ct"]],
+                             [files["dt.cc"]], nEvents):
+                    nObs = buildCrossCorrelationTimes(
+                        config, catalog, files["dt.ct"], files["dt.cc"],
+                        os.path.join(locationPath, "cache",
+                                     "crosscorr.sqlite"))
+                if nObs:
+                    prepareHypoDD(config, hypoddConfig, velocity_df,
+                                  chunkPath, crossCorrelation=True)
+            with measure("hypoDD", chunk, [files["dt.ct"], files["dt.cc"],
+                                           files["event.dat"],
+                                           files["station.dat"]],
+                         [files["hypoDD.reloc"], files["hypoDD.log"]],
+                         nEvents) as record:
+                runHypoDD(config, f"Chunk {chunk}", nEvents, record,
+                          chunkPath)
+        print(f"+++ Making summary files for chunk {chunk} ...")
+        xyzmFormat = config["Relocation"]["XyzmFormat"]
+        with measure("reloc", chunk, [files["hypoDD.reloc"]],
+                     [xyzmPath(outName, xyzmFormat, chunkPath)]) as record:
+            nEvents = hypoddReloc2xyzm(nEvents, outName, xyzmFormat,
+                                       chunkPath, hypodd_df)
+            record["events"] = nEvents
+        with measure("nordic", chunk,
+                     [xyzmPath(outName, xyzmFormat, chunkPath)],
+                     [os.path.join(chunkPath, f"{outName}_hypodd.out"),
+                      xyzmPath(f"{outName}_hypodd", xyzmFormat, chunkPath)],
+                     nEvents):
+            hypoDD2nordic(catalog, stationFile, outName, core,
+                          config["Relocation"]["NordicOutput"], xyzmFormat,
+                          chunkPath)
+        for f in glob(os.path.join(chunkPath, "hypoDD.reloc*")):
+            os.remove(f)
+        with measure("xyzm", chunk, [],
+                     [xyzmPath(f"{outName}_initial", xyzmFormat, chunkPath)],
+                     len(catalog["events"])):
+            catalog2xyzm(catalog, outName, xyzmFormat, chunkPath)
+        markChunk(chunkPath, key)
+    return nChunk, int(core.sum()), time()-st
+
+
+def locateHypoDD(config,
+                 force=False,
+                 runPath=".",
+                 catalog=None,
+                 hypoddConfig=None):
+    """Relocate the input catalog chunk by chunk
+
+    Chunks completed by a previous run with the same settings and events
+    are not relocated again, unless force is set. Core events of all
+    chunks are merged into the relocated xyzm and Nordic files of
+    results. All files are read and written under runPath, so several
+    regions may be relocated at once from threads of one process, see
+    core.Project.
+
+    Args:
+        config (dict): configuration parameters
+        force (bool, optional): relocate all chunks. Defaults to False.
+        runPath (str, optional): run directory holding files, stations
+        and results. Defaults to ".".
+        catalog (dict, optional): catalog tables of the input catalog,
+        loaded from Files.InputCatalogFileName if not given.
+        hypoddConfig (dict, optional): hypoDD configuration parameters,
+        read from files/hypodd.yml if not given.
+
+    Raises:
+        RelocationError: if chunks fail, with their numbers
+    """
+    if hypoddConfig is None:
+        hypoddConfig = readHypoddConfig(
+            os.path.join(runPath, "files", "hypodd.yml"))
     outName = f"{config['Region']['RegionName']}"
-    stationPath = os.path.join("stations", "usedStations.csv")
+    stationPath = os.path.join(runPath, "stations", "usedStations.csv")
     stationFile = os.path.abspath(stationPath)
-    locationPath = os.path.abspath("results")
+    locationPath = os.path.abspath(os.path.join(runPath, "results"))
     Path(locationPath).mkdir(parents=True, exist_ok=True)
     velocity_df = loadVelocityFile(config)
-    catalogFile = config["Files"]["InputCatalogFileName"]
+    catalogFile = os.path.join(runPath,
+                               config["Files"]["InputCatalogFileName"])
     copy(catalogFile, os.path.join(locationPath, f"{outName}.out"))
-    root = os.getcwd()
-    os.chdir(locationPath)
-    catalog = read_events(f"{outName}.out")
-    maxAllowdedEventsPerChunk = 6e3
-    nEvents = len(catalog)
-    nChunks = int(nEvents//maxAllowdedEventsPerChunk)
-    for nChunk in range(nChunks+1):
-        print(f"+++ Relocating chunk {nChunk+1} ...")
-        s = int(nChunk*maxAllowdedEventsPerChunk)
-        if nChunk != nChunks:
-            e = int((nChunk+1)*maxAllowdedEventsPerChunk)
-            selectedCatalog = catalog[s:e]
+    with measure("catalog", inputs=[catalogFile]) as record:
+        if catalog is None:
+            catalog = loadCatalog(catalogFile,
+                                  os.path.join(locationPath, "cache"))
+        record["events"] = len(catalog["events"])
+    nWorkers = config["Relocation"]["Workers"]
+    xyzmFormat = config["Relocation"]["XyzmFormat"]
+    incremental = config["Relocation"]["Incremental"]
+    nEvents = len(catalog["events"])
+    chunks = makeChunks(config, hypoddConfig, catalog["events"])
+    if config["Relocation"]["Engine"] == "python":
+        chunks = [(arange(nEvents), arange(nEvents))]
+    statePath = os.path.join(locationPath, "state")
+    fingerprints = eventFingerprints(catalog)
+    settings = settingsKey(config, hypoddConfig, stationFile)
+    state = None
+    if incremental:
+        state = loadState(statePath, outName, settings)
+    affected = affectedEvents(config, hypoddConfig, catalog, fingerprints,
+                              state)
+    chunkIds = [nChunk for nChunk, (core, _) in enumerate(chunks)
+                if affected[core].any()]
+    reused = ones(nEvents, dtype=bool)
+    for nChunk in chunkIds:
+        reused[chunks[nChunk][0]] = False
+    index = catalog["events"].index.values
+    keys = {nChunk: chunkKey(settings, fingerprints, index, *chunks[nChunk])
+            for nChunk in chunkIds}
+    if incremental:
+        msg = f"Incremental relocation: {int(affected.sum())} of {nEvents} \
+events affected, {len(chunkIds)} of {len(chunks)} chunks to relocate"
+        print(f"+++ {msg}")
+        logger(msg)
+        for chunkPath in glob(os.path.join(locationPath, "chunk_*")):
+            nChunk = int(chunkPath.rsplit("_", 1)[1])-1
+            if not chunkComplete(chunkPath, keys.get(nChunk)):
+                rmtree(chunkPath)
+    pending = [nChunk for nChunk in chunkIds
+               if force or not chunkComplete(os.path.join(locationPath,
+                                                 f"chunk_{nChunk+1}"),
+                                    keys[nChunk])]
+    if len(pending) < len(chunkIds):
+        msg = f"Resuming relocation: {len(chunkIds)-len(pending)} of \
+{len(chunkIds)} chunks already relocated"
+        print(f"+++ {msg}")
+        logger(msg)
+    crossCorrelation = config["CrossCorrelation"]
+    chunkConfig = dict(config, CrossCorrelation=dict(
+        crossCorrelation,
+        Archive=os.path.abspath(os.path.join(runPath,
+                                             crossCorrelation["Archive"]))))
+    run = currentRun()
+    st = time()
+    with processPool(max(1, min(nWorkers, len(pending)))) as pool:
+        jobs = {}
+        for nChunk in pending:
+            core, members = chunks[nChunk]
+            print(f"+++ Relocating chunk {nChunk+1} ...")
+            selectedCatalog = selectEvents(catalog, members)
+            job = pool.submit(relocateChunk,
+                              nChunk,
+                              chunkConfig,
+                              hypoddConfig,
+                              selectedCatalog,
+                              coreMask(core, members),
+                              stationFile,
+                              velocity_df,
+                              locationPath,
+                              outName,
+                              keys[nChunk],
+                              run)
+            jobs[job] = nChunk
+        failed = []
+        for job in as_completed(jobs):
+            try:
+                nChunk, nChunkEvents, elapsed = job.result()
+            except ProgramError as error:
+                failed.append(jobs[job]+1)
+                reportProgramError(error, f"Chunk {jobs[job]+1}")
+                continue
+            msg = f"Processing time for relocating chunk {nChunk+1} with \
+{nChunkEvents} events using HypoDD is: {elapsed:.3f} s"
+            print(f"+++ {msg}")
+            logger(msg)
+    et = time()
+    if failed:
+        msg = f"Relocation failed for chunks {sorted(failed)}, see logs!"
+        print(f"+++ {msg}")
+        logger(msg)
+        raise RelocationError(msg, sorted(failed))
+    previous = None
+    if state is not None:
+        previous = previousResults(state, fingerprints, reused, index)
+    nordicFile = os.path.join(locationPath, f"{outName}_hypodd.out")
+    with measure("merge",
+                 outputs=[xyzmPath(f"{outName}_initial", xyzmFormat,
+                                   locationPath),
+                          xyzmPath(f"{outName}_hypodd", xyzmFormat,
+                                   locationPath),
+                          nordicFile],
+                 events=nEvents):
+        initial_df, hypodd_df = mergeDFs(chunkIds, outName, xyzmFormat,
+                                         previous, locationPath)
+        relocated = hypodd_df[["ORT", "Lat", "Lon", "Dep", "ERH", "ERZ",
+                               "GAP"]]
+        if config["Relocation"]["NordicOutput"] == "obspy":
+            writeNordicEvents(catalog, relocated, nordicFile)
         else:
-            selectedCatalog = catalog[s:]
-        nEvents = len(selectedCatalog)
-        chunkPath = os.path.join(f"chunk_{nChunk+1}")
-        Path(chunkPath).mkdir(parents=True, exist_ok=True)
-        os.chdir(chunkPath)
-        prepareHypoddInputs(config,
-                            hypoddConfig,
-                            selectedCatalog,
-                            stationFile,
-                            velocity_df,
-                            locationPath)
-        cmd = "ph2dt ph2dt.inp >/dev/null 2>/dev/null"
-        os.system(cmd)
-        cmd = "hypoDD hypoDD.inp >/dev/null 2>/dev/null"
-        st = time()
-        os.system(cmd)
-        et = time()
-        print("+++ Making summary files ...")
-        nEvents = hypoddReloc2xyzm(nEvents, outName)
-        hypoDD2nordic(selectedCatalog, stationFile, outName)
-        for f in glob("hypoDD.reloc*"):
-            os.remove(f)
-        catalog2xyzm(selectedCatalog, outName)
-        os.chdir(locationPath)
-    mergeDFs(nChunks, outName)
-    os.chdir(root)
+            patchNordic(catalog, relocated, nordicFile)
+        if incremental:
+            saveState(statePath, outName, settings, fingerprints, initial_df,
+                      hypodd_df)
     logger(f"Processing time for relocating {nEvents} events using HypoDD is: \
-{et-st:.3f} s")
\ No newline at end of file
+{et-st:.3f} s")
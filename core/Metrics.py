@@ -0,0 +1,216 @@
+import json
+import os
+import resource
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+from core.Config import RUN, currentRun, logger, runFile
+
+
+def makeRun(config, runPath="."):
+    """Make a new instrumented run
+
+    Args:
+        config (dict): configuration parameters
+        runPath (str, optional): run directory. Defaults to ".".
+
+    Returns:
+        dict: run, see core.Config.currentRun
+    """
+    metricsConfig = config["Metrics"]
+    return {"path": os.path.abspath(runPath),
+            "id": datetime.now().strftime("%Y%m%dT%H%M%S%f") +
+            f"-{os.getpid()}",
+            "metrics": metricsConfig["Enabled"],
+            "profile": metricsConfig["Profile"],
+            "profileStages": list(metricsConfig["ProfileStages"])}
+
+
+def startRun(config, runPath="."):
+    """Start a new instrumented run in the current thread
+
+    Worker processes get the run passed along with their task, see
+    core.Config.runContext.
+
+    Args:
+        config (dict): configuration parameters
+        runPath (str, optional): run directory. Defaults to ".".
+
+    Returns:
+        str: run id
+    """
+    run = makeRun(config, runPath)
+    RUN.set(run)
+    return run["id"]
+
+
+def maxRSS(who):
+    """Peak resident memory in MB"""
+    peak = resource.getrusage(who).ru_maxrss/1024.0
+    return peak/1024.0 if sys.platform == "darwin" else peak
+
+
+def cpuTime(who):
+    """User plus system CPU time in s"""
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def fileSize(paths):
+    """Total size in bytes of existing files"""
+    return sum(os.path.getsize(p) for p in paths if os.path.isfile(p))
+
+
+def profiling(stage):
+    """Get the profiler selected for a stage, if any"""
+    run = currentRun()
+    profile = run["profile"]
+    stages = run["profileStages"]
+    if profile == "none" or (stages and stage not in stages):
+        return None
+    return profile
+
+
+@contextmanager
+def measure(stage, chunk=None, inputs=(), outputs=(), events=None):
+    """Time a pipeline stage and record its resource use
+
+    One JSON line is appended to results/metrics.jsonl of the current run
+    per stage. CPU
+    time of external programs, e.g. ph2dt and hypoDD, is reported as
+    childCPU. Peak RSS is the peak of the process up to the stage end.
+
+    Args:
+        stage (str): name of stage
+        chunk (int, optional): chunk number, starting from one.
+        inputs (list, optional): paths of files read by the stage.
+        outputs (list, optional): paths of files written by the stage.
+        events (int, optional): number of events processed.
+
+    Yields:
+        dict: the record, stages may update "events" before it is written
+    """
+    run = currentRun()
+    record = {"run": run["id"],
+              "stage": stage,
+              "chunk": chunk,
+              "pid": os.getpid(),
+              "start": datetime.now().isoformat(timespec="milliseconds"),
+              "events": events}
+    if not run["metrics"]:
+        yield record
+        return
+    profiler = startProfiler(profiling(stage))
+    st = perf_counter()
+    cpu = cpuTime(resource.RUSAGE_SELF)
+    childCPU = cpuTime(resource.RUSAGE_CHILDREN)
+    record["error"] = None
+    try:
+        yield record
+    except BaseException as error:
+        record["error"] = type(error).__name__
+        raise
+    finally:
+        record["wall"] = perf_counter() - st
+        record["cpu"] = cpuTime(resource.RUSAGE_SELF) - cpu
+        record["childCPU"] = cpuTime(resource.RUSAGE_CHILDREN) - childCPU
+        record["peakRSSMB"] = maxRSS(resource.RUSAGE_SELF)
+        record["childPeakRSSMB"] = maxRSS(resource.RUSAGE_CHILDREN)
+        record["inBytes"] = fileSize(inputs)
+        record["outBytes"] = fileSize(outputs)
+        stopProfiler(profiler, stage, chunk)
+        Path(runFile("results")).mkdir(parents=True, exist_ok=True)
+        with open(runFile("results", "metrics.jsonl"), "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def startProfiler(profile):
+    """Start a cProfile or pyinstrument profiler"""
+    if profile == "cprofile":
+        from cProfile import Profile
+        profiler = Profile()
+        profiler.enable()
+        return profiler
+    if profile == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            msg = "+++ pyinstrument is not installed, profiling is skipped!"
+            print(msg)
+            logger(msg)
+            return None
+        profiler = Profiler()
+        profiler.start()
+        return profiler
+    return None
+
+
+def stopProfiler(profiler, stage, chunk):
+    """Stop a profiler and save its report under results/profiles"""
+    if profiler is None:
+        return
+    profilesPath = runFile("results", "profiles")
+    Path(profilesPath).mkdir(parents=True, exist_ok=True)
+    name = f"{stage}" if chunk is None else f"{stage}_chunk_{chunk}"
+    name = os.path.join(profilesPath, f"{name}_{os.getpid()}")
+    if hasattr(profiler, "disable"):
+        profiler.disable()
+        profiler.dump_stats(f"{name}.prof")
+    else:
+        profiler.stop()
+        with open(f"{name}.html", "w") as f:
+            f.write(profiler.output_html())
+
+
+def loadMetrics(runId=None):
+    """Load recorded stages
+
+    Args:
+        runId (str, optional): keep only stages of this run.
+
+    Returns:
+        DataFrame: one row per recorded stage
+    """
+    from pandas import DataFrame
+    metricsFile = runFile("results", "metrics.jsonl")
+    if not os.path.exists(metricsFile):
+        return DataFrame()
+    with open(metricsFile) as f:
+        metrics_df = DataFrame([json.loads(line) for line in f if line.strip()])
+    if runId is not None and len(metrics_df):
+        metrics_df = metrics_df[metrics_df.run == runId]
+    return metrics_df
+
+
+def summarizeMetrics(runId):
+    """Print and log a per-stage summary of a run
+
+    Args:
+        runId (str): run id
+
+    Returns:
+        DataFrame: summary, one row per stage
+    """
+    metrics_df = loadMetrics(runId)
+    if not len(metrics_df):
+        return metrics_df
+    summary = metrics_df.groupby("stage", sort=False).agg(
+        calls=("wall", "size"),
+        wall=("wall", "sum"),
+        maxWall=("wall", "max"),
+        cpu=("cpu", "sum"),
+        childCPU=("childCPU", "sum"),
+        peakRSSMB=("peakRSSMB", "max"),
+        childPeakRSSMB=("childPeakRSSMB", "max"),
+        inMB=("inBytes", "sum"),
+        outMB=("outBytes", "sum"),
+        events=("events", "sum"),
+        errors=("error", "count"))
+    summary[["inMB", "outMB"]] /= 1024.0**2
+    table = summary.to_string(float_format="%.3f")
+    print(f"+++ Stage summary of run {runId}:\n{table}")
+    logger(f"Stage summary of run {runId}:\n{table}")
+    return summary
@@ -0,0 +1,520 @@
+from datetime import datetime, timedelta
+from io import BytesIO
+from math import pi
+from sys import intern
+
+from numpy import cos, isnan, nan, ones, radians, sqrt
+from pandas import to_datetime
+
+EPOCH = datetime(1970, 1, 1)
+DEGREE_KM = 2.0*6371.0*pi/360.0
+NORDIC_TAGS = ("1", "6", "7", "E", " ", "F", "M", "3", "H", "I")
+MAGNITUDE_TYPES = {"B": "mB", "b": "mb", "G": "MbLg", "s": "Ms", "S": "MS",
+                   "W": "MW", "w": "Mw", "C": "Mc", "N": "MN", "n": "Mn"}
+COVARIANCE_COLUMNS = ["COVXY", "COVXZ", "COVYZ"]
+PREFERRED_MAGNITUDES = ["MW", "Mw", "ML", "Ml", "MB", "Mb",
+                        "MS", "Ms", "MC", "Mc"]
+
+
+def iterNordicText(catalogPath):
+    """Yield events of a Nordic file one at a time
+
+    Each byte range runs up to the start of the next event, so blank
+    lines separating events belong to the event before them. Only the
+    lines of the current event are held in memory.
+
+    Args:
+        catalogPath (str): path to the input Nordic file
+
+    Yields:
+        tuple: start and end byte offsets and decoded lines of one event
+    """
+    lines = []
+    blank = True
+    start = position = 0
+    with open(catalogPath, "rb") as f:
+        for line in f:
+            if not line.strip():
+                blank = True
+            else:
+                if blank:
+                    if lines:
+                        yield start, position, lines
+                    start = position
+                    lines = []
+                    blank = False
+                lines.append(line.decode("latin-1").replace("\r\n", "\n"))
+            position += len(line)
+    if lines:
+        yield start, position, lines
+
+
+def toFloat(text):
+    """Convert a Nordic field to float, None if blank or invalid"""
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def toInt(text):
+    """Convert a Nordic field to int, None if blank or invalid"""
+    try:
+        return int(text)
+    except ValueError:
+        return None
+
+
+def timeNs(year, month, day, hour, minute, seconds):
+    """Convert time components to ns since epoch, as obspy does"""
+    base = datetime(year, month, day, hour, minute) - EPOCH
+    return base//timedelta(microseconds=1)*1000 + int(round(seconds*1e9))
+
+
+def preferredMagnitude(headers):
+    """Pick the magnitude obspy would prefer among type 1 lines
+
+    Args:
+        headers (list): type 1 lines of the event
+
+    Returns:
+        float: magnitude, nan if missing
+    """
+    magnitudes = []
+    for line in headers:
+        for index in [59, 67, 75]:
+            if not line[index].isspace():
+                kind = line[index]
+                kind = "ML" if kind.upper() == "L" else \
+                    MAGNITUDE_TYPES.get(kind, "")
+                magnitudes.append((toFloat(line[index-4:index]), kind))
+    if not magnitudes:
+        return nan
+    try:
+        mag = sorted(magnitudes,
+                     key=lambda m: PREFERRED_MAGNITUDES.index(m[1]))[0][0]
+    except ValueError:
+        mag = magnitudes[0][0]
+    return nan if mag is None else mag
+
+
+def isOldPhaseLine(line):
+    """Check that a phase line can only be read as old Nordic format"""
+    seconds = line[24:28].strip(" ").replace(" ", "").replace("A", "")
+    return toInt(seconds) is None
+
+
+def parsePhaseLine(line, ortNs, ort):
+    """Parse an old format Nordic phase line
+
+    Args:
+        line (str): phase line
+        ortNs (int): origin time in ns since epoch
+        ort (datetime): origin time
+
+    Returns:
+        tuple: station, phase, arrival phase, travel time, weight, distance
+        in degree, arrival flag, time residual and arrival weight; None for
+        lines without a time
+    """
+    if line[18:28].strip() == "":
+        return None
+    line = line.ljust(80)
+    weight = line[14]
+    if weight not in " 012349_":
+        weight = line[8]
+        phase = line[10:17].strip()
+    elif weight == "_":
+        phase = line[10:17]
+        weight = " "
+    else:
+        phase = line[10:14].strip()
+    hour = int(line[18:20].strip() or 0)
+    minute = int(line[20:22].strip() or 0)
+    seconds = float(line[22:29].strip() or 0.0)
+    if hour == 0 and ort.hour == 23:
+        dayAdd = 86400
+    elif hour >= 24:
+        dayAdd = 86400
+        hour -= 24
+    else:
+        dayAdd = 0
+    pickNs = timeNs(ort.year, ort.month, ort.day, hour, minute,
+                    float(seconds + dayAdd))
+    try:
+        wgt = int(weight)
+    except ValueError:
+        wgt = 0
+    phase = intern(phase)
+    arrival = toFloat(line[33:40]) is None
+    distance = toFloat(line[70:75]) if arrival else None
+    finalWeight = toInt(line[68:70]) if arrival else None
+    return (intern(line[1:6].strip()),
+            phase,
+            phase if arrival else "",
+            round((pickNs - ortNs)/1e9, 6),
+            wgt,
+            nan if distance is None else distance/DEGREE_KM,
+            arrival,
+            toFloat(line[63:68]) if arrival else None,
+            None if finalWeight is None else finalWeight/10)
+
+
+def parseNordicEvent(lines):
+    """Parse one Nordic event into flat records without obspy
+
+    Values match those read through obspy's Nordic reader. Events this
+    parser does not cover, e.g. new format phase lines or several high
+    accuracy lines, return None and are left to obspy.
+
+    Args:
+        lines (list): lines of one event
+
+    Returns:
+        tuple: origin dict and list of pick tuples (see parsePhaseLine),
+        arrivals first; None if the event needs obspy's reader
+    """
+    if len(lines[0].rstrip()) != 80:
+        return None
+    tagged = {}
+    for i, line in enumerate(lines):
+        body = line.rstrip()
+        tag = body[79] if len(body) > 79 else " "
+        if tag in NORDIC_TAGS:
+            tagged.setdefault(tag, []).append((i, line))
+    headers = tagged.get("1", [])
+    highAccuracy = tagged.get("H", [])
+    if not headers or len(highAccuracy) > 1 or \
+            (highAccuracy and (len(headers) > 1 or
+                               highAccuracy[0][0] < headers[0][0])):
+        return None
+    header = headers[0][1]
+    try:
+        seconds = header[16:20].strip()
+        ortNs = timeNs(int(header[1:5]), int(header[6:8]), int(header[8:10]),
+                       int(header[11:13]), int(header[13:15]),
+                       float(seconds) if seconds else 0.0)
+        nus = header[49:51].strip()
+        nus = int(nus) if nus else nan
+    except ValueError:
+        return None
+    lat = toFloat(header[23:30])
+    lon = toFloat(header[30:38])
+    depth = toFloat(header[38:43])
+    if depth:
+        depth *= 1000.
+    erh = erz = gap = nan
+    if "E" in tagged:
+        line = tagged["E"][0][1]
+        xErr, yErr, zErr = toFloat(line[32:38]), toFloat(line[24:30]), \
+            toFloat(line[38:43])
+        if xErr is not None and yErr is not None and lat:
+            latErr = yErr/DEGREE_KM
+            lonErr = xErr/DEGREE_KM/cos(radians(lat))
+            erh = round(sqrt(latErr**2 + lonErr**2)*DEGREE_KM, 1)
+        if zErr is not None and zErr*1000.:
+            erz = zErr*1000.*0.001
+        gap = toInt(line[5:8])
+        gap = nan if gap is None else gap
+    if highAccuracy:
+        line = highAccuracy[0][1]
+        fields = [toInt(line[1:5]), toInt(line[6:8]), toInt(line[8:10]),
+                  toInt(line[11:13]), toInt(line[13:15]),
+                  toFloat(line[16:23])]
+        if None in fields:
+            return None
+        try:
+            haNs = timeNs(*fields)
+        except ValueError:
+            return None
+        if abs(round((ortNs - haNs)/1e9, 6)) < 0.1:
+            ortNs = haNs
+        haLat, haLon, haDepth = toFloat(line[23:32]), \
+            toFloat(line[33:43]), toFloat(line[44:52])
+        lat = lat if haLat is None else haLat
+        lon = lon if haLon is None else haLon
+        depth = depth if haDepth is None else haDepth*1000.
+    phaseLines = [line for _, line in tagged.get(" ", [])]
+    if phaseLines and ("7" not in tagged or
+                       not all(isOldPhaseLine(line) for line in phaseLines)):
+        return None
+    ort = EPOCH + timedelta(microseconds=ortNs//1000)
+    arrivals = []
+    others = []
+    try:
+        for line in phaseLines:
+            pick = parsePhaseLine(line, ortNs, ort)
+            if pick is not None:
+                (arrivals if pick[6] else others).append(pick)
+    except ValueError:
+        return None
+    origin = {"ORT": ortNs,
+              "Lon": nan if lon is None else lon,
+              "Lat": nan if lat is None else lat,
+              "Dep": nan if depth is None else depth*1e-3,
+              "Mag": preferredMagnitude([line for _, line in headers]),
+              "Nus": nus,
+              "GAP": gap,
+              "ERH": erh,
+              "ERZ": erz}
+    return origin, arrivals + others
+
+
+def iterNordicBlocks(catalog):
+    """Yield raw Nordic text of catalog events, one event at a time
+
+    Args:
+        catalog (dict): catalog tables
+
+    Yields:
+        bytes: lines of one event and the blank lines following it
+    """
+    with open(catalog["path"], "rb") as f:
+        for start, end in catalog["events"][["start", "end"]].to_numpy():
+            f.seek(start)
+            block = f.read(end-start)
+            if block.splitlines()[-1].strip():
+                block += b"\n"
+            yield block
+
+
+def readNordicEvents(catalog):
+    """Read obspy events of a catalog from their byte ranges
+
+    Args:
+        catalog (dict): catalog tables
+
+    Returns:
+        obspy.Catalog: parsed events, in catalog order
+    """
+    from obspy import read_events
+    from obspy.core.event import Catalog
+    buffer = BytesIO()
+    for block in iterNordicBlocks(catalog):
+        buffer.write(block)
+    if not buffer.tell():
+        return Catalog()
+    buffer.seek(0)
+    return read_events(buffer, format="NORDIC")
+
+
+def writeNordicEvents(catalog, relocated, outFile, core=None):
+    """Write relocated origins through obspy's Nordic writer
+
+    Args:
+        catalog (dict): catalog tables of the chunk
+        relocated (DataFrame): ORT, Lat, Lon, Dep, ERH, ERZ and GAP of
+        each chunk event, in km, with optional origin time error ERT in s
+        outFile (str): path to output Nordic file
+        core (array, optional): mask of events written to Nordic file.
+    """
+    from obspy import UTCDateTime as utc
+    from obspy.core.event import Catalog
+    from obspy.geodetics.base import kilometers2degrees as k2d
+    events = readNordicEvents(catalog)
+    origins = relocated[["ORT", "Lat", "Lon", "Dep", "ERH", "ERZ", "GAP"]]
+    origins = origins.assign(Dep=origins.Dep.where(origins.Dep != 0)*1e3,
+                             ERH=k2d(origins.ERH),
+                             ERZ=origins.ERZ*1e3).astype(object)
+    origins = origins.where(origins.notna(), None)
+    ert = [None]*len(events)
+    if "ERT" in relocated:
+        ert = relocated.ERT.astype(object).where(relocated.ERT.notna(), None)
+    keep = ones(len(events), dtype=bool) if core is None else core
+    outCatalog = Catalog()
+    for event, (ort, lat, lon, dep, erh, erz, gap), et, write in zip(
+            events, origins.itertuples(index=False, name=None), ert, keep):
+        preferred_origin = event.preferred_origin()
+        if ort:
+            preferred_origin.time = utc(ort)
+        preferred_origin.latitude = lat
+        preferred_origin.longitude = lon
+        preferred_origin.depth = dep
+        preferred_origin.latitude_errors.uncertainty = erh
+        preferred_origin.longitude_errors.uncertainty = erh
+        preferred_origin.depth_errors.uncertainty = erz
+        preferred_origin.quality.azimuthal_gap = gap
+        if "ERT" in relocated:
+            preferred_origin.time_errors.uncertainty = et
+        if write:
+            outCatalog.append(event)
+    outCatalog.write(outFile, format="nordic", high_accuracy=False)
+
+
+def formatField(value, fmt, width):
+    """Format a Nordic field, leaving it blank for missing values"""
+    if value is None or isnan(value):
+        return " "*width
+    return f"{value:{fmt}}"[:width].rjust(width)
+
+
+def patchHeaderLine(line, origin):
+    """Replace origin time and hypocentre of a type 1 line
+
+    Args:
+        line (str): type 1 line, without line ending
+        origin (tuple): time components, Lat, Lon and Dep in km
+
+    Returns:
+        str: patched line
+    """
+    year, month, day, hour, minute, second, lat, lon, dep = origin
+    line = line.ljust(80)
+    if year is not None:
+        line = (f"{line[0]}{year:4d} {month:2d}{day:2d}{line[10]}"
+                f"{hour:2d}{minute:2d} {second:4.1f}{line[20:]}")
+    return (f"{line[:23]}{formatField(lat, '7.3f', 7)}"
+            f"{formatField(lon, '8.3f', 8)}{formatField(dep, '5.1f', 5)}"
+            f"{line[43:]}")
+
+
+def patchHighAccuracyLine(line, origin):
+    """Replace origin time and hypocentre of a type H line
+
+    Args:
+        line (str): type H line, without line ending
+        origin (tuple): see patchHeaderLine
+
+    Returns:
+        str: patched line
+    """
+    year, month, day, hour, minute, second, lat, lon, dep = origin
+    line = line.ljust(80)
+    if year is not None:
+        line = (f"{line[0]}{year:4d} {month:2d}{day:2d}{line[10]}"
+                f"{hour:2d}{minute:2d} {second:6.3f}{line[22:]}")
+    return (f"{line[:23]}{formatField(lat, '9.5f', 9)}{line[32]}"
+            f"{formatField(lon, '10.5f', 10)}{line[43]}"
+            f"{formatField(dep, '8.3f', 8)}{line[52:]}")
+
+
+def patchErrorLine(line, erh, erz, gap, ert=None, covariance=None):
+    """Replace gap and hypocentre errors of a type E line
+
+    Args:
+        line (str): type E line, without line ending
+        erh (float): horizontal error in km
+        erz (float): depth error in km
+        gap (float): azimuthal gap in degrees
+        ert (float, optional): origin time error in s, kept if not given.
+        covariance (tuple, optional): xy, xz and yz covariances in km^2,
+        kept if not given.
+
+    Returns:
+        str: patched line
+    """
+    line = line.ljust(80)
+    gap = "   " if gap is None or isnan(gap) else f"{int(gap):<3d}"[:3]
+    ert = line[14:20] if ert is None else formatField(ert, "6.2f", 6)
+    covariance = line[43:79] if covariance is None else "".join(
+        formatField(value, "12.4e", 12) for value in covariance)
+    return (f"{line[:5]}{gap}{line[8:14]}{ert}{line[20:24]}"
+            f"{formatField(erh, '6.1f', 6)}"
+            f"{line[30:32]}{formatField(erh, '6.1f', 6)}"
+            f"{formatField(erz, '5.1f', 5)}{covariance}{line[79:]}")
+
+
+def patchEvent(block, origin, erh, erz, gap, ert=None, covariance=None,
+               accurateOrigin=None):
+    """Patch hypocentre lines of one Nordic event
+
+    Only the first type 1 line, the type H line following it and the
+    first type E line are rewritten; every other line is copied byte for
+    byte. A type E line is added after the header if the event has none.
+
+    Args:
+        block (bytes): raw Nordic text of the event
+        origin (tuple): see patchHeaderLine
+        erh (float): horizontal error in km
+        erz (float): depth error in km
+        gap (float): azimuthal gap in degrees
+        ert (float, optional): see patchErrorLine
+        covariance (tuple, optional): see patchErrorLine
+        accurateOrigin (tuple, optional): origin written to the type H
+        line, with seconds to the ms; origin if not given.
+
+    Returns:
+        bytes: patched event
+    """
+    lines = block.splitlines(keepends=True)
+    header = None
+    error = None
+    highAccuracy = None
+    for i, line in enumerate(lines):
+        body = line.rstrip(b"\r\n")
+        kind = body[79:80]
+        if kind == b"1":
+            if header is not None and highAccuracy is None:
+                highAccuracy = False
+            if header is None:
+                header = i
+        elif kind == b"H" and header is not None and highAccuracy is None:
+            highAccuracy = i
+        elif kind == b"E" and error is None:
+            error = i
+    if header is None:
+        return block
+    ending = lines[header][len(lines[header].rstrip(b"\r\n")):]
+    body = lines[header].rstrip(b"\r\n").decode("latin-1")
+    lines[header] = patchHeaderLine(body, origin).encode("latin-1") + ending
+    if highAccuracy:
+        body = lines[highAccuracy].rstrip(b"\r\n").decode("latin-1")
+        lines[highAccuracy] = patchHighAccuracyLine(
+            body, accurateOrigin or origin).encode("latin-1") + ending
+    if error is None:
+        body = " "*79 + "E"
+        lines.insert(header+1, patchErrorLine(
+            body, erh, erz, gap, ert, covariance).encode("latin-1") + ending)
+    else:
+        body = lines[error].rstrip(b"\r\n").decode("latin-1")
+        lines[error] = patchErrorLine(
+            body, erh, erz, gap, ert, covariance).encode("latin-1") + ending
+    return b"".join(lines)
+
+
+def patchNordic(catalog, relocated, outFile, core=None):
+    """Write relocated origins by patching the input Nordic file
+
+    The input file is streamed event by event, so memory use does not
+    grow with catalog size.
+
+    Args:
+        catalog (dict): catalog tables of the chunk
+        relocated (DataFrame): ORT, Lat, Lon, Dep, ERH, ERZ and GAP of
+        each chunk event, in km, with optional origin time error ERT in s
+        and COVXY, COVXZ and COVYZ covariances in km^2
+        outFile (str): path to output Nordic file
+        core (array, optional): mask of events written to Nordic file.
+    """
+    ort = to_datetime(relocated.ORT, format="%Y-%m-%dT%H:%M:%S.%fZ")
+    times, accurateTimes = [
+        [(None,)*6 if t is None else
+         (t.year, t.month, t.day, t.hour, t.minute,
+          t.second + t.microsecond*1e-6)
+         for t in rounded.astype(object).where(rounded.notna(), None)]
+        for rounded in [ort.dt.round("100ms"), ort.dt.round("1ms")]]
+    keep = ones(len(relocated), dtype=bool) if core is None else core
+    ert = relocated.ERT.values if "ERT" in relocated else \
+        [None]*len(relocated)
+    covariance = [None]*len(relocated)
+    if set(COVARIANCE_COLUMNS) <= set(relocated.columns):
+        covariance = relocated[COVARIANCE_COLUMNS].values
+    with open(outFile, "wb", buffering=1 << 20) as f:
+        for (block, time, accurateTime, lat, lon, dep, erh, erz, gap, et,
+             cov, write) in zip(
+                iterNordicBlocks(catalog),
+                times,
+                accurateTimes,
+                relocated.Lat.values,
+                relocated.Lon.values,
+                relocated.Dep.values,
+                relocated.ERH.values,
+                relocated.ERZ.values,
+                relocated.GAP.values,
+                ert,
+                covariance,
+                keep):
+            if write:
+                f.write(patchEvent(block, time + (lat, lon, dep),
+                                   erh, erz, gap, et, cov,
+                                   accurateTime + (lat, lon, dep)))
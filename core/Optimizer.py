@@ -1,16 +1,344 @@
-from skopt import gp_minimize
+import hashlib
+import json
+import os
+from pathlib import Path
+from shutil import copy, rmtree
 
+from numpy import argmin, isfinite, log10, median, nan
+from numpy.linalg import norm
+from pandas import DataFrame
+from skopt import Optimizer
+from skopt.space import Integer, Real
+from yaml import dump
 
-def objective(params):
-    # Set the parameters for HypoDD
-    # Run HypoDD
-    # Compute the score based on your criteria (e.g., accuracy of locations)
-    return score
+from core.Catalog import catalogKey, loadCatalog, selectEvents
+from core.Chunking import projectEvents, spatialChunks
+from core.Config import currentRun, processPool, runContext
+from core.DiffTime import buildDifferentialTimes
+from core.Extra import (loadHypoDDRelocFile, loadVelocityFile, logger,
+                        readHypoddConfig)
+from core.Input import prepareHypoddInputs
+from core.Runner import (ProgramError, readConditionNumbers,
+                         reportProgramError, runHypoDD, runPh2dt)
 
-res = gp_minimize(objective,                  # the function to minimize
-                  [(value1, value2),          # the bounds on the first parameter
-                   (value3, value4)],         # the bounds on the second parameter
-                  acq_func="EI",              # the acquisition function
-                  n_calls=100)                # the number of evaluations of f
+PH2DT_PARAMETERS = ["MINWGHT", "MAXDIST", "MAXSEP", "MAXNGH", "MINLNKS",
+                    "MINOBS", "MAXOBS"]
 
-print("Best parameters: {}".format(res.x))
\ No newline at end of file
+
+def searchSpace(config):
+    """Build the search space of hypoDD parameters
+
+    Args:
+        config (dict): configuration parameters
+
+    Returns:
+        list: skopt dimensions, named after hypoDD parameters
+    """
+    dimensions = []
+    for name, (low, high) in config["Optimizer"]["Space"].items():
+        if isinstance(low, int) and isinstance(high, int):
+            dimensions.append(Integer(low, high, name=name))
+        else:
+            dimensions.append(Real(low, high, name=name))
+    return dimensions
+
+
+def trialHypoddConfig(hypoddConfig, params):
+    """Apply trial parameters to hypoDD configuration
+
+    DAMP is the damping of the first iteration set, the following sets
+    are damped 10 less each, as in the default schedule.
+
+    Args:
+        hypoddConfig (dict): hypoDD configuration parameters
+        params (dict): trial parameters
+
+    Returns:
+        dict: hypoDD configuration parameters of the trial
+    """
+    trialConfig = dict(hypoddConfig)
+    trialConfig.update(params)
+    if "DAMP" in params:
+        trialConfig["DAMP"] = [max(params["DAMP"] - 10*i, 1)
+                               for i in range(len(hypoddConfig["DAMP"]))]
+    return trialConfig
+
+
+def toPython(value):
+    """Convert numpy scalars to python ones"""
+    return value.item() if hasattr(value, "item") else value
+
+
+def digest(*items):
+    """Hash json serializable items into a cache key"""
+    return hashlib.sha1(json.dumps(items, sort_keys=True,
+                                   default=str).encode()).hexdigest()
+
+
+def trialMetrics(nEvents, path=""):
+    """Summarize hypoDD results of a trial
+
+    Args:
+        nEvents (int): number of events given to hypoDD
+        path (str, optional): directory of the trial, the working
+        directory by default.
+
+    Returns:
+        dict: relocated fraction, mean catalog residual RMS in seconds
+        and largest condition number
+    """
+    try:
+        hypodd_df = loadHypoDDRelocFile(path)
+    except (FileNotFoundError, ValueError):
+        hypodd_df = DataFrame()
+    conditions = readConditionNumbers(os.path.join(path, "hypoDD.log"))
+    return {"relocated": len(hypodd_df)/nEvents if nEvents else 0.0,
+            "rms": hypodd_df.RCT.mean()*1e-3 if len(hypodd_df) else nan,
+            "condition": max(conditions) if conditions else nan}
+
+
+def trialScore(config, metrics):
+    """Score a trial, lower is better
+
+    score = wRMS*rms + wRelocated*(1 - relocated) + wCondition*log10(cnd)
+
+    A trial that relocated nothing is scored as with a 1 s residual RMS.
+
+    Args:
+        config (dict): configuration parameters
+        metrics (dict): trial metrics
+
+    Returns:
+        float: trial score
+    """
+    weights = config["Optimizer"]["Weights"]
+    rms = metrics["rms"] if isfinite(metrics["rms"]) else 1.0
+    score = weights["RMS"]*rms + weights["Relocated"]*(1-metrics["relocated"])
+    if isfinite(metrics["condition"]) and metrics["condition"] > 1:
+        score += weights["Condition"]*log10(metrics["condition"])
+    return float(score)
+
+
+def runTrial(nTrial,
+             config,
+             trialConfig,
+             catalog,
+             stationFile,
+             velocity_df,
+             optimizerPath,
+             run,
+             inputKey):
+    """Run ph2dt and hypoDD for one trial inside its own directory
+
+    Differential times are shared between trials through a directory
+    keyed by the tuning inputs and ph2dt parameters, so only the first
+    trial of each ph2dt parameter set builds them.
+
+    Args:
+        nTrial (int): trial number, starting from zero
+        config (dict): configuration parameters
+        trialConfig (dict): hypoDD configuration parameters of the trial
+        catalog (dict): catalog tables used for tuning
+        stationFile (str): path to the used stations file
+        velocity_df (DataFrame): velocity model
+        optimizerPath (str): path to the optimizer directory
+        run (dict): run logs go to, see core.Config.currentRun
+        inputKey (str): digest of catalog, stations and tuning subset the
+        differential times are built from.
+
+    Returns:
+        tuple: trial number and trial metrics
+    """
+    trialPath = os.path.join(optimizerPath, f"trial_{nTrial+1}")
+    Path(trialPath).mkdir(parents=True, exist_ok=True)
+    with runContext(run):
+        for f in ["hypoDD.reloc", "hypoDD.log"]:
+            if os.path.exists(os.path.join(trialPath, f)):
+                os.remove(os.path.join(trialPath, f))
+        prepareHypoddInputs(config,
+                            trialConfig,
+                            catalog,
+                            stationFile,
+                            velocity_df,
+                            optimizerPath,
+                            trialPath)
+        dtKey = digest(inputKey,
+                       [trialConfig[p] for p in PH2DT_PARAMETERS],
+                       config["Relocation"]["DiffTimes"])
+        dtPath = os.path.join(optimizerPath, "dt", dtKey)
+        try:
+            if os.path.exists(os.path.join(dtPath, "dt.ct")):
+                for f in ["dt.ct", "event.dat"]:
+                    copy(os.path.join(dtPath, f), trialPath)
+            else:
+                if config["Relocation"]["DiffTimes"] == "builtin":
+                    buildDifferentialTimes(config, trialConfig, catalog,
+                                           stationFile,
+                                           os.path.join(trialPath, "dt.ct"),
+                                           os.path.join(trialPath,
+                                                        "event.dat"))
+                else:
+                    runPh2dt(config, path=trialPath)
+                tmpPath = f"{dtPath}.{os.getpid()}"
+                Path(tmpPath).mkdir(parents=True, exist_ok=True)
+                for f in ["event.dat", "dt.ct"]:
+                    copy(os.path.join(trialPath, f), tmpPath)
+                try:
+                    os.rename(tmpPath, dtPath)
+                except OSError:
+                    rmtree(tmpPath, ignore_errors=True)
+            runHypoDD(config, f"Trial {nTrial+1}", len(catalog["events"]),
+                      path=trialPath)
+        except ProgramError as error:
+            reportProgramError(error, f"Trial {nTrial+1}")
+    return nTrial, trialMetrics(len(catalog["events"]), trialPath)
+
+
+def tuningCatalog(config, hypoddConfig, catalog):
+    """Select the events used for tuning
+
+    Catalogs larger than MaxEvents are cut to one spatial chunk, so
+    tuning sees a coherent region. Cells hold at most half of MaxEvents
+    and their halos the rest. Cells of the k-d partition have about the
+    same number of events, so the one whose events lie closest to their
+    centroid is the densest; it is chosen since its pairs are the most
+    linked and most sensitive to the parameters.
+
+    Args:
+        config (dict): configuration parameters
+        hypoddConfig (dict): hypoDD configuration parameters
+        catalog (dict): catalog tables
+
+    Returns:
+        dict: catalog tables of at most MaxEvents tuning events
+    """
+    maxEvents = config["Optimizer"]["MaxEvents"]
+    if len(catalog["events"]) <= maxEvents:
+        return catalog
+    eventsPerCell = max(1, maxEvents//2)
+    halo = config["Relocation"]["HaloFactor"]*hypoddConfig["MAXSEP"]
+    chunks = spatialChunks(config, catalog["events"], eventsPerCell, halo,
+                           maxEvents - eventsPerCell)
+    xyz = projectEvents(config, catalog["events"])
+    spread = [median(norm(xyz[core] - xyz[core].mean(axis=0), axis=1))
+              for core, _ in chunks]
+    nChunk = int(argmin(spread))
+    core, members = chunks[nChunk]
+    msg = f"Tuning on {len(members)} events around the densest of \
+{len(chunks)} cells ({len(core)} events)"
+    print(f"+++ {msg}")
+    logger(msg)
+    return selectEvents(catalog, members)
+
+
+def optimizeHypoDD(config, runPath=".", catalog=None, hypoddConfig=None):
+    """Tune hypoDD parameters by Bayesian optimization
+
+    Trials are asked from a Gaussian process optimizer in batches of
+    Workers and run concurrently. Each trial is cached under a key made
+    of its parameters and inputs, so repeated points are not run again.
+
+    Args:
+        config (dict): configuration parameters
+        runPath (str, optional): run directory holding files, stations
+        and results. Defaults to ".".
+        catalog (dict, optional): catalog tables of the input catalog,
+        loaded from Files.InputCatalogFileName if not given.
+        hypoddConfig (dict, optional): hypoDD configuration parameters,
+        read from files/hypodd.yml if not given.
+
+    Returns:
+        dict: best parameters found and their score
+    """
+    print("+++ Optimizing HypoDD parameters ...")
+    optimizerConfig = config["Optimizer"]
+    if hypoddConfig is None:
+        hypoddConfig = readHypoddConfig(
+            os.path.join(runPath, "files", "hypodd.yml"))
+    outName = f"{config['Region']['RegionName']}"
+    stationFile = os.path.abspath(
+        os.path.join(runPath, "stations", "usedStations.csv"))
+    optimizerPath = os.path.abspath(
+        os.path.join(runPath, "results", "optimizer"))
+    cachePath = os.path.join(optimizerPath, "cache")
+    Path(cachePath).mkdir(parents=True, exist_ok=True)
+    velocity_df = loadVelocityFile(config)
+    catalogFile = os.path.join(runPath,
+                               config["Files"]["InputCatalogFileName"])
+    if catalog is None:
+        catalog = loadCatalog(catalogFile,
+                              os.path.join(runPath, "results", "cache"))
+    catalog = tuningCatalog(config, hypoddConfig, catalog)
+    with open(stationFile, "rb") as f:
+        stationKey = hashlib.sha1(f.read()).hexdigest()
+    inputKey = digest(catalogKey(catalogFile),
+                      stationKey,
+                      config["VelocityModel"],
+                      config["Region"],
+                      config["Relocation"]["DiffTimes"],
+                      optimizerConfig["MaxEvents"],
+                      hypoddConfig)
+    dimensions = searchSpace(config)
+    names = [d.name for d in dimensions]
+    optimizer = Optimizer(dimensions,
+                          base_estimator="GP",
+                          acq_func="EI",
+                          n_initial_points=optimizerConfig["InitialTrials"],
+                          random_state=optimizerConfig["Seed"])
+    nWorkers = optimizerConfig["Workers"]
+    trials = []
+    with processPool(nWorkers) as pool:
+        while len(trials) < optimizerConfig["Trials"]:
+            nPoints = min(nWorkers, optimizerConfig["Trials"] - len(trials))
+            points = optimizer.ask(n_points=nPoints)
+            jobs = {}
+            results = {}
+            for point in points:
+                params = {n: toPython(v) for n, v in zip(names, point)}
+                key = digest(inputKey, params)
+                cacheFile = os.path.join(cachePath, f"{key}.json")
+                nTrial = len(trials)
+                trials.append({"trial": nTrial+1, **params})
+                if os.path.exists(cacheFile):
+                    with open(cacheFile) as f:
+                        results[nTrial] = json.load(f)
+                    continue
+                job = pool.submit(runTrial,
+                                  nTrial,
+                                  config,
+                                  trialHypoddConfig(hypoddConfig, params),
+                                  catalog,
+                                  stationFile,
+                                  velocity_df,
+                                  optimizerPath,
+                                  currentRun(),
+                                  inputKey)
+                jobs[job] = cacheFile
+            for job, cacheFile in jobs.items():
+                nTrial, metrics = job.result()
+                with open(cacheFile, "w") as f:
+                    json.dump(metrics, f)
+                results[nTrial] = metrics
+            scores = []
+            for nTrial in sorted(results):
+                trials[nTrial].update(results[nTrial])
+                trials[nTrial]["score"] = trialScore(config, results[nTrial])
+                scores.append(trials[nTrial]["score"])
+                msg = f"Trial {nTrial+1}: score {trials[nTrial]['score']:.4f}"
+                print(f"+++ {msg}")
+                logger(msg)
+            optimizer.tell(points, scores)
+    trials_df = DataFrame(trials)
+    trials_df.to_csv(os.path.join(optimizerPath, f"trials_{outName}.csv"),
+                     index=False, float_format="%.4f")
+    best = min(trials, key=lambda trial: trial["score"])
+    bestParams = {n: best[n] for n in names}
+    with open(os.path.join(optimizerPath, f"best_{outName}.yml"), "w") as f:
+        dump(trialHypoddConfig(hypoddConfig, bestParams),
+             f,
+             default_flow_style=None,
+             sort_keys=False)
+    msg = f"Best parameters: {bestParams}, score {best['score']:.4f}"
+    print(f"+++ {msg}")
+    logger(msg)
+    return {"params": bestParams, "score": best["score"]}
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+from graphlib import TopologicalSorter
+from pathlib import Path
+
+from core.Config import logger
+
+
+def fileDigest(path, blockSize=1 << 20):
+    """Hash the content of a file
+
+    Args:
+        path (str): path to file
+        blockSize (int, optional): read block size in bytes.
+
+    Returns:
+        str: sha1 digest, None if the file is missing
+    """
+    if not os.path.isfile(path):
+        return None
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blockSize), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def configValue(config, entry):
+    """Get a config section, or one key of it given as "Section.Key" """
+    section, _, key = entry.partition(".")
+    return config[section][key] if key else config[section]
+
+
+class Stage():
+    """A step of the workflow
+
+    Args:
+        name (str): name of stage
+        run (function): called without arguments to run the stage
+        config (list, optional): config sections, or "Section.Key" items,
+        the stage depends on.
+        inputs (list, optional): paths of files read by the stage.
+        outputs (list, optional): paths of files written by the stage.
+    """
+
+    def __init__(self, name, run, config=(), inputs=(), outputs=()):
+        self.name = name
+        self.run = run
+        self.config = list(config)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+    def key(self, config):
+        """Hash configuration and input files of the stage"""
+        items = {"stage": self.name,
+                 "config": {e: configValue(config, e) for e in self.config},
+                 "inputs": {p: fileDigest(p) for p in self.inputs}}
+        return hashlib.sha1(json.dumps(items, sort_keys=True,
+                                       default=str).encode()).hexdigest()
+
+
+class Pipeline():
+    """Run stages in dependency order, skipping up-to-date ones
+
+    A stage depends on the stages writing any of its inputs. After a
+    stage runs, the hash of its inputs and the digests of its outputs are
+    saved as a checkpoint. A stage is skipped when its inputs hash to the
+    checkpoint key and its outputs are unchanged since.
+
+    Args:
+        config (dict): configuration parameters
+        stages (list): Stage objects
+        checkpointPath (str, optional): directory of checkpoint files.
+    """
+
+    def __init__(self,
+                 config,
+                 stages,
+                 checkpointPath=os.path.join("results", "checkpoints")):
+        self.config = config
+        self.stages = {stage.name: stage for stage in stages}
+        self.checkpointPath = checkpointPath
+
+    def order(self):
+        """Sort stages so each comes after the stages it depends on"""
+        writers = {path: stage.name
+                   for stage in self.stages.values()
+                   for path in stage.outputs}
+        graph = {stage.name: {writers[p] for p in stage.inputs
+                              if p in writers and writers[p] != stage.name}
+                 for stage in self.stages.values()}
+        return list(TopologicalSorter(graph).static_order())
+
+    def checkpointFile(self, name):
+        return os.path.join(self.checkpointPath, f"{name}.json")
+
+    def upToDate(self, stage, key):
+        """Check the checkpoint of a stage against its current inputs"""
+        checkpointFile = self.checkpointFile(stage.name)
+        if not os.path.exists(checkpointFile):
+            return False
+        with open(checkpointFile) as f:
+            checkpoint = json.load(f)
+        if checkpoint["key"] != key:
+            return False
+        return all(fileDigest(p) == checkpoint["outputs"].get(p)
+                   for p in stage.outputs)
+
+    def run(self, targets=None, force=False):
+        """Run stages whose inputs changed
+
+        Args:
+            targets (list, optional): names of stages to consider, all by
+            default.
+            force (bool, optional): run stages even if up to date.
+
+        Returns:
+            list: names of stages that ran
+        """
+        Path(self.checkpointPath).mkdir(parents=True, exist_ok=True)
+        ran = []
+        for name in self.order():
+            if targets and name not in targets:
+                continue
+            stage = self.stages[name]
+            key = stage.key(self.config)
+            if not force and self.upToDate(stage, key):
+                msg = f"Stage {name} is up to date, skipped"
+                print(f"+++ {msg}")
+                logger(msg)
+                continue
+            checkpointFile = self.checkpointFile(name)
+            if os.path.exists(checkpointFile):
+                os.remove(checkpointFile)
+            stage.run()
+            checkpoint = {"key": key,
+                          "outputs": {p: fileDigest(p) for p in stage.outputs}}
+            with open(checkpointFile, "w") as f:
+                json.dump(checkpoint, f, indent=2)
+            ran.append(name)
+        return ran
@@ -0,0 +1,230 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock
+
+from core.Config import (RelocationError, currentRun, logger,
+                         readConfiguration, runContext)
+from core.Metrics import makeRun, measure, summarizeMetrics
+
+PLOT_LOCK = Lock()
+STAGES = ["stations", "locate", "plot", "figures"]
+
+
+class Project():
+    """Relocation of one region in its own run directory
+
+    A run directory holds files/hypodd.yml and receives stations/ and
+    results/. Relative paths of the configuration, e.g. the input
+    catalog, are relative to it. Nothing depends on the working
+    directory, so projects may run at once from threads of one process,
+    see runProjects.
+
+    Args:
+        config (dict): configuration parameters
+        runPath (str, optional): run directory. Defaults to ".".
+        hypoddConfig (dict, optional): hypoDD configuration parameters,
+        read from files/hypodd.yml of the run directory if not given.
+        shared (dict, optional): "catalog" tables and "stations" table
+        shared with other projects, see loadShared.
+    """
+
+    def __init__(self, config, runPath=".", hypoddConfig=None, shared=None):
+        self.config = config
+        self.runPath = runPath
+        self.hypoddConfig = hypoddConfig
+        self.shared = shared or {}
+        self.run = makeRun(config, runPath)
+
+    @classmethod
+    def fromPath(cls, runPath=".", shared=None):
+        """Make a project from config.yml of a run directory"""
+        with runContext(dict(currentRun(), path=os.path.abspath(runPath))):
+            config = readConfiguration(os.path.join(runPath, "config.yml"))
+        return cls(config, runPath, shared=shared)
+
+    @property
+    def name(self):
+        return f"{self.config['Region']['RegionName']}"
+
+    def path(self, *parts):
+        """Get the path of a file of the run directory"""
+        return os.path.normpath(os.path.join(self.runPath, *parts))
+
+    @contextmanager
+    def context(self):
+        """Send logs and metrics of the current thread to this run"""
+        with runContext(self.run):
+            yield self
+
+    def prepareStations(self):
+        from core.PrepareInputs import (CreatInputStationFile,
+                                        GetStationListFromCatalog)
+        catalogFile = self.path(self.config["Files"]["InputCatalogFileName"])
+        with self.context(), measure(
+                "stations", inputs=[catalogFile],
+                outputs=[self.path("stations", "usedStations.csv")]):
+            GetStationListFromCatalog(self.config, self.runPath,
+                                      self.shared.get("catalog"))
+            CreatInputStationFile(self.config, self.runPath,
+                                  self.shared.get("stations"))
+
+    def locate(self, force=False):
+        from core.Locate import locateHypoDD
+        with self.context():
+            locateHypoDD(self.config, force, self.runPath,
+                         self.shared.get("catalog"), self.hypoddConfig)
+
+    def optimize(self):
+        from core.Optimizer import optimizeHypoDD
+        with self.context():
+            return optimizeHypoDD(self.config, self.runPath,
+                                  self.shared.get("catalog"),
+                                  self.hypoddConfig)
+
+    def uncertainty(self):
+        from core.Uncertainty import estimateUncertainty
+        with self.context(), measure("uncertainty"):
+            return estimateUncertainty(self.config, self.runPath,
+                                       self.shared.get("catalog"),
+                                       self.hypoddConfig)
+
+    def visulize(self):
+        from core.Visulize import plotSeismicityMap
+        with self.context(), measure("plot"), PLOT_LOCK:
+            plotSeismicityMap(self.config, self.runPath)
+
+    def figures(self):
+        from core.Figures import plotFigures
+        with self.context(), measure("figures"):
+            plotFigures(self.config, self.runPath)
+
+    def summarize(self):
+        with self.context():
+            return summarizeMetrics(self.run["id"])
+
+    def stages(self, force=False):
+        from core.Pipeline import Stage
+        from core.Xyzm import xyzmPath
+        catalogFile = self.path(self.config["Files"]["InputCatalogFileName"])
+        xyzmFormat = self.config["Relocation"]["XyzmFormat"]
+        usedStations = self.path("stations", "usedStations.csv")
+        xyzmFiles = [xyzmPath(f"{self.name}_{name}", xyzmFormat,
+                              self.path("results"))
+                     for name in ["initial", "hypodd"]]
+        return [
+            Stage("stations",
+                  self.prepareStations,
+                  config=["Files", "Region", "Stations"],
+                  inputs=[catalogFile],
+                  outputs=[self.path("stations", "stationsInCatlog.yml"),
+                           usedStations,
+                           self.path("stations", "unusedStations.csv"),
+                           self.path("stations", "missedStations.yml")]),
+            Stage("locate",
+                  lambda: self.locate(force),
+                  config=["Files", "Region", "VelocityModel", "Relocation",
+                          "CrossCorrelation"],
+                  inputs=[catalogFile,
+                          usedStations,
+                          self.path("files", "hypodd.yml")],
+                  outputs=xyzmFiles + [self.path("results",
+                                                 f"{self.name}_hypodd.out")]),
+            Stage("plot",
+                  self.visulize,
+                  config=["Region", "Figures", "Relocation.XyzmFormat"],
+                  inputs=xyzmFiles + [usedStations],
+                  outputs=[self.path("results", "seismicity.png")]),
+            Stage("figures",
+                  self.figures,
+                  config=["Region", "Figures", "Relocation.XyzmFormat"],
+                  inputs=xyzmFiles + [usedStations])]
+
+    def runStages(self, targets=None, force=False):
+        """Run the pipeline of the project, skipping up-to-date stages
+
+        Args:
+            targets (list, optional): names of stages to consider, all by
+            default.
+            force (bool, optional): run stages even if up to date.
+
+        Returns:
+            list: names of stages that ran
+        """
+        from core.Pipeline import Pipeline
+        with self.context():
+            return Pipeline(self.config,
+                            self.stages(force),
+                            self.path("results", "checkpoints")).run(targets,
+                                                                     force)
+
+
+def loadShared(config, runPath="."):
+    """Parse the input catalog and get its stations once for many regions
+
+    Args:
+        config (dict): configuration parameters, Files and Stations are
+        used
+        runPath (str, optional): directory relative paths of config are
+        relative to, the catalog cache is kept in its results. Defaults
+        to ".".
+
+    Returns:
+        dict: "catalog" tables and "stations" table, to give to Project
+    """
+    from core.Catalog import loadCatalog
+    from core.PrepareInputs import catalogStations, stationTable
+    with runContext(makeRun(config, runPath)):
+        catalog = loadCatalog(
+            os.path.join(runPath, config["Files"]["InputCatalogFileName"]),
+            os.path.join(runPath, "results", "cache"))
+        stations = stationTable(config, catalogStations(catalog), runPath)
+    return {"catalog": catalog, "stations": stations}
+
+
+def runProjects(projects, targets=None, force=False, workers=None):
+    """Run the pipelines of several projects at once
+
+    Each project runs in a thread of this process; their relocations
+    still use worker processes. Seismicity maps are drawn one at a time
+    since pyplot is not thread-safe.
+
+    Args:
+        projects (list): Project objects, with distinct run directories
+        targets (list, optional): names of stages to consider, all by
+        default.
+        force (bool, optional): run stages even if up to date.
+        workers (int, optional): number of projects run at once, all by
+        default.
+
+    Raises:
+        RelocationError: if run directories are not distinct or projects
+        fail, with their names
+
+    Returns:
+        dict: names of stages that ran, by project name
+    """
+    runPaths = [os.path.abspath(project.runPath) for project in projects]
+    if len(set(runPaths)) < len(runPaths):
+        msg = "+++ Projects must have distinct run directories! Aborting ..."
+        print(msg)
+        logger(msg)
+        raise RelocationError(msg)
+    ran = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers or len(projects)) as pool:
+        jobs = {pool.submit(project.runStages, targets, force): project
+                for project in projects}
+        for job, project in jobs.items():
+            try:
+                ran[project.name] = job.result()
+            except Exception as error:
+                failed.append(project.name)
+                with project.context():
+                    logger(f"Project {project.name} failed: {error!r}")
+    if failed:
+        msg = f"Projects {failed} failed, see logs of their runs!"
+        print(f"+++ {msg}")
+        logger(msg)
+        raise RelocationError(msg, failed)
+    return ran
@@ -0,0 +1,299 @@
+import os
+import re
+from collections import deque
+from shutil import which
+from subprocess import DEVNULL, PIPE, STDOUT, Popen, TimeoutExpired
+from threading import Thread
+from time import perf_counter
+
+from core.Extra import logger
+
+REASONS = {"missing": "was not found on PATH",
+           "exit": "exited with an error",
+           "timeout": "exceeded its wall-clock limit",
+           "memory": "exceeded its memory limit"}
+MAX_SAMPLES = 512
+ITERATION_LINE = re.compile(r"^\s*(\d+)([a-z]?)\s")
+
+
+class ProgramError(RuntimeError):
+    """Failure of an external program
+
+    Attributes:
+        program (str): name of program
+        reason (str): one of "missing", "exit", "timeout" or "memory"
+        returncode (int): exit code, None if the program did not run
+        tail (list): last lines of program output
+    """
+
+    def __init__(self, program, reason, returncode=None, tail=()):
+        self.program = program
+        self.reason = reason
+        self.returncode = returncode
+        self.tail = list(tail)
+        msg = f"{program} {REASONS[reason]}"
+        if returncode is not None:
+            msg += f" (exit code {returncode})"
+        if self.tail:
+            msg += ", last output:\n" + "".join(self.tail)
+        super().__init__(msg)
+
+    def __reduce__(self):
+        return (ProgramError,
+                (self.program, self.reason, self.returncode, self.tail))
+
+
+def sampleProcess(pid):
+    """Read CPU time and resident memory of a running process
+
+    Args:
+        pid (int): process id
+
+    Returns:
+        tuple: CPU time in s and RSS in MB, None where /proc is missing
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    cpu = (int(fields[11]) + int(fields[12]))/os.sysconf("SC_CLK_TCK")
+    rss = int(fields[21])*os.sysconf("SC_PAGE_SIZE")/1024.0**2
+    return cpu, rss
+
+
+def runProgram(program,
+               args=(),
+               outputFile=None,
+               timeout=None,
+               maxMemoryMB=None,
+               onLine=None,
+               record=None,
+               sampleInterval=1.0,
+               cwd=None):
+    """Run an external program under wall-clock and memory limits
+
+    Output is streamed line by line to outputFile and onLine while the
+    program runs. CPU time and RSS of the program are sampled every
+    sampleInterval s; when more than MAX_SAMPLES are taken, every second
+    sample is dropped and the interval doubled.
+
+    Args:
+        program (str): name of program, e.g. "hypoDD"
+        args (list, optional): program arguments.
+        outputFile (str, optional): file receiving program output.
+        timeout (float, optional): wall-clock limit in s, 0 or None for
+        no limit.
+        maxMemoryMB (float, optional): RSS limit in MB, 0 or None for no
+        limit.
+        onLine (function, optional): called with each output line.
+        record (dict, optional): metrics record, see core.Metrics.measure,
+        updated with exit code and samples.
+        sampleInterval (float, optional): initial sampling interval in s.
+        cwd (str, optional): directory the program runs in, the working
+        directory by default.
+
+    Raises:
+        ProgramError: if the program is missing, fails or is killed
+
+    Returns:
+        list: samples of elapsed time in s, CPU time in s and RSS in MB
+    """
+    if which(program) is None:
+        raise ProgramError(program, "missing")
+    env = dict(os.environ, GFORTRAN_UNBUFFERED_PRECONNECTED="y")
+    proc = Popen([program, *args],
+                 stdin=DEVNULL,
+                 stdout=PIPE,
+                 stderr=STDOUT,
+                 env=env,
+                 cwd=cwd or None,
+                 text=True,
+                 errors="replace")
+    tail = deque(maxlen=20)
+
+    def readOutput():
+        out = open(outputFile, "w") if outputFile else None
+        try:
+            for line in proc.stdout:
+                tail.append(line)
+                if out:
+                    out.write(line)
+                if onLine:
+                    onLine(line)
+        finally:
+            if out:
+                out.close()
+
+    reader = Thread(target=readOutput, daemon=True)
+    reader.start()
+    st = perf_counter()
+    samples = []
+    reason = None
+    while True:
+        try:
+            proc.wait(timeout=sampleInterval)
+            break
+        except TimeoutExpired:
+            pass
+        elapsed = perf_counter() - st
+        sample = sampleProcess(proc.pid)
+        if sample:
+            samples.append([round(elapsed, 3), *sample])
+            if len(samples) > MAX_SAMPLES:
+                samples = samples[1::2]
+                sampleInterval *= 2
+        if timeout and elapsed > timeout:
+            reason = "timeout"
+        elif maxMemoryMB and sample and sample[1] > maxMemoryMB:
+            reason = "memory"
+        if reason:
+            proc.kill()
+            proc.wait()
+            break
+    reader.join()
+    if record is not None:
+        record["exitCode"] = proc.returncode
+        record["samples"] = samples
+    if reason is None and proc.returncode != 0:
+        reason = "exit"
+    if reason:
+        raise ProgramError(program, reason, proc.returncode, tail)
+    return samples
+
+
+def parseIteration(line):
+    """Parse a row of the hypoDD iteration table
+
+    Rows look like:
+      IT   EV  CT    CC    RMSCT      RMSCC   RMSST   DX   DY   DZ   DT   OS  AQ  CND
+     1    100 100     0   213 -100.0     0    0.0   512  1373  1266  2232   312   0   0 123
+
+    Args:
+        line (str): line of hypoDD output
+
+    Returns:
+        dict: iteration, percentage of events left, cross-correlation and
+        catalog residual RMS in ms and condition number, None if line is
+        not a table row
+    """
+    match = ITERATION_LINE.match(line)
+    fields = line.split()
+    if not match or len(fields) < 14:
+        return None
+    try:
+        return {"iteration": int(match.group(1)),
+                "events": float(fields[1]),
+                "rmsct": float(fields[4]),
+                "rmscc": float(fields[6]),
+                "condition": float(fields[-1])}
+    except ValueError:
+        return None
+
+
+class HypoDDProgress():
+    """Report hypoDD iterations while it runs
+
+    Args:
+        label (str): prefix of progress messages, e.g. "chunk 3"
+        nEvents (int): number of events given to hypoDD
+        verbose (bool, optional): print each iteration. Defaults to True.
+    """
+
+    def __init__(self, label, nEvents, verbose=True):
+        self.label = label
+        self.nEvents = nEvents
+        self.verbose = verbose
+        self.cluster = 0
+        self.iterations = []
+
+    def __call__(self, line):
+        if re.search(r"\bCND\b", line):
+            self.cluster += 1
+            return
+        iteration = parseIteration(line)
+        if iteration is None or not self.cluster:
+            return
+        iteration["cluster"] = self.cluster
+        self.iterations.append(iteration)
+        if not self.verbose:
+            return
+        nLeft = round(iteration["events"]*self.nEvents/100.0)
+        print(f"+++ {self.label}: cluster {self.cluster}, iteration \
+{iteration['iteration']}, {nLeft} events, RMS {iteration['rmsct']:.0f} ms")
+
+    def conditionNumbers(self):
+        """Condition numbers of the last iteration of each cluster"""
+        last = {}
+        for iteration in self.iterations:
+            last[iteration["cluster"]] = iteration["condition"]
+        return list(last.values())
+
+
+def readConditionNumbers(logFile="hypoDD.log"):
+    """Read condition numbers of the last iteration of each cluster
+
+    Args:
+        logFile (str, optional): path to hypoDD log or output file.
+
+    Returns:
+        list: condition numbers, empty if the log has none
+    """
+    if not os.path.exists(logFile):
+        return []
+    progress = HypoDDProgress("", 0, verbose=False)
+    with open(logFile) as f:
+        for line in f:
+            progress(line)
+    return progress.conditionNumbers()
+
+
+def programLimits(config):
+    """Get wall-clock and memory limits of external programs"""
+    return {"timeout": config["Relocation"]["ProgramTimeout"],
+            "maxMemoryMB": config["Relocation"]["ProgramMaxMemoryMB"]}
+
+
+def runPh2dt(config, record=None, path=""):
+    """Run ph2dt on ph2dt.inp of a directory
+
+    Args:
+        config (dict): configuration parameters
+        record (dict, optional): metrics record of the stage.
+        path (str, optional): directory of input and output files, the
+        working directory by default.
+    """
+    runProgram("ph2dt", ["ph2dt.inp"], os.path.join(path, "ph2dt.out"),
+               record=record, cwd=path, **programLimits(config))
+
+
+def runHypoDD(config, label, nEvents, record=None, path=""):
+    """Run hypoDD on hypoDD.inp of a directory
+
+    Args:
+        config (dict): configuration parameters
+        label (str): prefix of progress messages
+        nEvents (int): number of events given to hypoDD
+        record (dict, optional): metrics record of the stage.
+        path (str, optional): directory of input and output files, the
+        working directory by default.
+
+    Returns:
+        HypoDDProgress: iterations reported by hypoDD
+    """
+    progress = HypoDDProgress(label, nEvents)
+    try:
+        runProgram("hypoDD", ["hypoDD.inp"], os.path.join(path, "hypoDD.out"),
+                   onLine=progress, record=record, cwd=path,
+                   **programLimits(config))
+    finally:
+        if record is not None:
+            record["iterations"] = len(progress.iterations)
+    return progress
+
+
+def reportProgramError(error, label):
+    """Print and log a failed external program"""
+    msg = f"{label}: {error}"
+    print(f"+++ {msg}")
+    logger(msg)
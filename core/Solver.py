@@ -0,0 +1,362 @@
+import os
+
+from numpy import (abs, arange, bincount, column_stack, concatenate, float64,
+                   full, hypot, median, nan, ones, repeat, sqrt, where, zeros)
+from pandas import DataFrame, concat, factorize, read_csv, to_datetime
+from scipy.sparse import coo_matrix, csr_matrix, vstack
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import lsqr
+
+from core.Chunking import projectEvents, regionProjection
+from core.Config import logger
+from core.CrossCorr import correlatePairs
+from core.DiffTime import differentialTimes
+from core.Input import iterationSets
+from core.TravelTime import regionTravelTimeTable
+
+
+def rayDerivatives(table, xyz, stations, phases):
+    """Travel times of rays and their derivatives by source position
+
+    Args:
+        table (TravelTimeTable): travel-time tables of the velocity model
+        xyz (array): source coordinates in km, one row per ray
+        stations (array): station x and y in km, one row per ray
+        phases (array): "P" or "S" of each ray
+
+    Returns:
+        tuple: travel times in s and their derivatives by x, y and z
+    """
+    dx = xyz[:, 0] - stations[:, 0]
+    dy = xyz[:, 1] - stations[:, 1]
+    r = hypot(dx, dy)
+    t = zeros(len(xyz))
+    dtdr = zeros(len(xyz))
+    dtdz = zeros(len(xyz))
+    for phase in ["P", "S"]:
+        m = phases == phase
+        if m.any():
+            t[m], dtdr[m], dtdz[m], _ = table.lookup(xyz[m, 2], r[m], phase)
+    safe = where(r > 0, r, 1.0)
+    return t, dtdr*dx/safe, dtdr*dy/safe, dtdz
+
+
+def residualWeights(res, cutoff):
+    """Down-weight outliers with a biweight of a residual cutoff
+
+    Args:
+        res (array): residuals in s
+        cutoff (float): cutoff in s if below 1, else in units of the
+        residual spread (median absolute deviation), -9 keeps all data
+
+    Returns:
+        array: weights between 0 and 1
+    """
+    if cutoff < 0 or not len(res):
+        return ones(len(res))
+    if cutoff >= 1:
+        mad = median(abs(res - median(res)))
+        cutoff = median(res) + cutoff*mad/0.67449
+    return where(abs(res) < cutoff, (1.0 - (res/cutoff)**2)**2, 0.0)
+
+
+def distanceWeights(separation, maxDistance):
+    """Down-weight pairs of distant events
+
+    Args:
+        separation (array): inter-event distances in km
+        maxDistance (float): cutoff distance in km, -9 keeps all pairs
+
+    Returns:
+        array: weights between 0 and 1
+    """
+    if maxDistance < 0:
+        return ones(len(separation))
+    return where(separation < maxDistance,
+                 (1.0 - (separation/maxDistance)**5)**5, 0.0)
+
+
+def solveDoubleDifference(table, xyz, stations, obs, sets):
+    """Relocate events from differential times with damped LSQR
+
+    Unknowns are shifts of x, y, z and origin time of every event. Each
+    iteration linearizes travel times at current locations and solves
+    the weighted system, with columns scaled to unit RMS as hypoDD does
+    and one zero-mean shift constraint per cluster of linked events.
+    Weights follow the iteration sets of prepareHypoDD.
+
+    Args:
+        table (TravelTimeTable): travel-time tables of the velocity model
+        xyz (array): initial event coordinates in km
+        stations (array): x and y of stations in km
+        obs (DataFrame): observations with event positions "i" and "k",
+        station position "s", "pha", differential travel time "dt",
+        data weight "w" and "cc", true for cross-correlation data
+        sets (list): iteration sets, see core.Input.iterationSets
+
+    Returns:
+        dict: arrays by event of relocated "xyz", origin time shifts
+        "dtau" in s, location errors "exyz" in km, "cluster" numbers
+        starting from one, zero for events not relocated, numbers of
+        catalog and cross-correlation P and S data "nctp", "ncts", "nccp",
+        "nccs" and RMS residuals "rct" and "rcc" in s
+    """
+    n = len(xyz)
+    xyz = xyz.copy()
+    dtau = zeros(n)
+    exyz = full((n, 3), nan)
+    i = obs.i.to_numpy()
+    k = obs.k.to_numpy()
+    isS = (obs.pha == "S").to_numpy()
+    isCC = obs.cc.to_numpy(dtype=bool)
+    rays, rayIndex = factorize(concatenate([i, k])*len(stations)*2 +
+                               concatenate([obs.s.to_numpy()]*2)*2 +
+                               concatenate([isS]*2))
+    ray1, ray2 = rays[:len(obs)], rays[len(obs):]
+    rayEvent = rayIndex//(len(stations)*2)
+    rayStation = stations[(rayIndex//2) % len(stations)]
+    rayPhase = where(rayIndex % 2 == 1, "S", "P")
+    w = obs.w.to_numpy(dtype=float64)
+    dt = obs.dt.to_numpy(dtype=float64)
+    weights = zeros(len(obs))
+    res = zeros(len(obs))
+    for iSet in sets:
+        for _ in range(iSet["NITER"]):
+            t, tx, ty, tz = rayDerivatives(table, xyz[rayEvent],
+                                           rayStation, rayPhase)
+            res = dt - (t[ray1] + dtau[i] - t[ray2] - dtau[k])
+            separation = sqrt(((xyz[i] - xyz[k])**2).sum(axis=1))
+            weights = zeros(len(obs))
+            for cc, prefix in [(False, "CT"), (True, "CC")]:
+                for s, phase in [(False, "P"), (True, "S")]:
+                    m = (isCC == cc) & (isS == s)
+                    apriori = iSet[f"WT{prefix}{phase}"]
+                    if apriori > 0 and m.any():
+                        weights[m] = w[m]*apriori
+                m = isCC == cc
+                if m.any():
+                    weights[m] *= residualWeights(res[m], iSet[f"WR{prefix}"])
+                    weights[m] *= distanceWeights(separation[m],
+                                                  iSet[f"WD{prefix}"])
+            used = weights > 0
+            if not used.any():
+                break
+            weights /= weights[used].mean()
+            rows = arange(used.sum())
+            iu, ku, wu = i[used], k[used], weights[used]
+            r1, r2 = ray1[used], ray2[used]
+            links = csr_matrix((ones(len(iu)), (iu, ku)), shape=(n, n))
+            nClusters, cluster = connected_components(links, directed=False)
+            linked = bincount(concatenate([iu, ku]), minlength=n) > 0
+            cluster = where(linked, cluster, -1)
+            data = concatenate([column_stack([tx[r1], ty[r1], tz[r1],
+                                              ones(len(r1))])*wu[:, None],
+                                -column_stack([tx[r2], ty[r2], tz[r2],
+                                               ones(len(r2))])*wu[:, None]])
+            cols = concatenate([4*iu[:, None] + arange(4),
+                                4*ku[:, None] + arange(4)])
+            G = coo_matrix((data.ravel(),
+                            (concatenate([repeat(rows, 4)]*2), cols.ravel())),
+                           shape=(len(rows), 4*n)).tocsc()
+            norm = sqrt(G.multiply(G).sum(axis=0).A1/len(rows))
+            scale = where(norm > 0, 1.0/where(norm > 0, norm, 1.0), 0.0)
+            members = arange(n)[linked]
+            constraint = coo_matrix(
+                (ones(4*len(members)),
+                 ((4*cluster[members, None] + arange(4)).ravel(),
+                  (4*members[:, None] + arange(4)).ravel())),
+                shape=(4*nClusters, 4*n)).tocsc()
+            A = vstack([G, constraint]).tocsc()
+            A = A @ csr_matrix((scale, (arange(4*n), arange(4*n))),
+                               shape=(4*n, 4*n))
+            b = concatenate([res[used]*wu, zeros(4*nClusters)])
+            solution = lsqr(A, b, damp=iSet["DAMP"], atol=1e-6, btol=1e-6,
+                            iter_lim=max(100, 8*n), calc_var=True)
+            m = solution[0]*scale
+            variance = solution[-1]*scale**2
+            xyz[linked] += m.reshape(n, 4)[linked, :3]
+            dtau[linked] += m.reshape(n, 4)[linked, 3]
+            xyz[:, 2] = abs(xyz[:, 2])
+            nData = len(rows)
+            resvar = (b[:nData]**2).sum()/max(nData - 4*len(members), 1)
+            exyz = sqrt(variance.reshape(n, 4)[:, :3]*resvar)
+            exyz[~linked] = nan
+    used = weights > 0
+    counts = {}
+    rms = {}
+    for cc, prefix in [(False, "ct"), (True, "cc")]:
+        for s, phase in [(False, "p"), (True, "s")]:
+            m = used & (isCC == cc) & (isS == s)
+            counts[f"n{prefix}{phase}"] = bincount(i[m], minlength=n) + \
+                bincount(k[m], minlength=n)
+        m = used & (isCC == cc)
+        sq = bincount(i[m], res[m]**2, minlength=n) + \
+            bincount(k[m], res[m]**2, minlength=n)
+        nm = bincount(i[m], minlength=n) + bincount(k[m], minlength=n)
+        rms[f"r{prefix}"] = where(nm > 0, sqrt(sq/where(nm > 0, nm, 1)), nan)
+    linked = bincount(concatenate([i[used], k[used]]), minlength=n) > 0
+    links = csr_matrix((ones(used.sum()), (i[used], k[used])), shape=(n, n))
+    _, cluster = connected_components(links, directed=False)
+    return dict(xyz=xyz, dtau=dtau, exyz=exyz,
+                cluster=where(linked, cluster + 1, 0), **counts, **rms)
+
+
+def relocTable(config, catalog, result):
+    """Build the table of relocated events, as read from hypoDD.reloc
+
+    Args:
+        config (dict): configuration parameters
+        catalog (dict): catalog tables
+        result (dict): arrays made by solveDoubleDifference
+
+    Returns:
+        DataFrame: relocated events indexed by event number, starting
+        from one, with hypoDD.reloc columns and units, positions and
+        errors in m and RMS residuals RCT and RCC in ms
+    """
+    events = catalog["events"]
+    xyz = result["xyz"]
+    lon, lat = regionProjection(config)(xyz[:, 0], xyz[:, 1], inverse=True)
+    ort = to_datetime(events.ORT.to_numpy() +
+                      (result["dtau"]*1e9).round().astype("int64"),
+                      unit="ns")
+    exyz = result["exyz"]*1e3
+    hypodd_df = DataFrame({
+        "ID": arange(1, len(events)+1),
+        "LAT": lat, "LON": lon, "DEPTH": xyz[:, 2],
+        "X": xyz[:, 0]*1e3, "Y": xyz[:, 1]*1e3, "Z": xyz[:, 2]*1e3,
+        "EX": exyz[:, 0], "EY": exyz[:, 1], "EZ": exyz[:, 2],
+        "YR": ort.year, "MO": ort.month, "DY": ort.day,
+        "HR": ort.hour, "MI": ort.minute,
+        "SC": ort.second + ort.microsecond*1e-6 + ort.nanosecond*1e-9,
+        "MAG": events.Mag.to_numpy(),
+        "NCCP": result["nccp"], "NCCS": result["nccs"],
+        "NCTP": result["nctp"], "NCTS": result["ncts"],
+        "RCC": result["rcc"]*1e3, "RCT": result["rct"]*1e3,
+        "CID ": result["cluster"]})
+    hypodd_df = hypodd_df[result["cluster"] > 0]
+    hypodd_df.set_index(["ID"], inplace=True, drop=False)
+    return hypodd_df
+
+
+def keepPairs(obs, hypoddConfig):
+    """Drop event pairs with too few data, as hypoDD does
+
+    Args:
+        obs (DataFrame): observations, see solveDoubleDifference
+        hypoddConfig (dict): hypoDD configuration parameters
+
+    Returns:
+        DataFrame: observations of pairs with at least OBSCT catalog or
+        OBSCC cross-correlation data
+    """
+    size = obs.groupby(["i", "k", "cc"]).sta.transform("size").values
+    return obs[size >= where(obs.cc.values, hypoddConfig["OBSCC"],
+                             hypoddConfig["OBSCT"])]
+
+
+def solverInputs(config,
+                 hypoddConfig,
+                 catalog,
+                 stationFile,
+                 velocity_df,
+                 cachePath=os.path.join("results", "cache")):
+    """Gather differential times and geometry of a catalog in memory
+
+    Catalog differential times are selected as for dt.ct and
+    cross-correlation data are added as for dt.cc when enabled in
+    config, see keepPairs for the pairs kept.
+
+    Args:
+        config (dict): configuration parameters
+        hypoddConfig (dict): hypoDD configuration parameters
+        catalog (dict): catalog tables
+        stationFile (str): path to the used stations file
+        velocity_df (DataFrame): velocity model
+        cachePath (str, optional): directory of the correlation cache and
+        travel-time tables.
+
+    Returns:
+        dict: observations "obs" as solveDoubleDifference takes them,
+        with catalog travel times "tt2" of second events, station "codes"
+        and their x and y "stations" in km, initial event "xyz" in km and
+        travel-time "table"
+    """
+    obs = differentialTimes(config, hypoddConfig, catalog, stationFile)
+    obs = obs[obs.groupby(["i", "k"]).sta.transform("size") >=
+              hypoddConfig["OBSCT"]]
+    data = [DataFrame({"i": obs.i.values, "k": obs.k.values,
+                       "sta": obs.sta.values, "pha": obs.pha.values,
+                       "dt": obs.tt1.values - obs.tt2.values,
+                       "w": obs.w.values, "cc": False,
+                       "tt2": obs.tt2.values})]
+    if config["CrossCorrelation"]["Enabled"]:
+        cc = correlatePairs(config, catalog,
+                            obs.assign(id1=obs.i+1, id2=obs.k+1),
+                            os.path.join(cachePath, "crosscorr.sqlite"))
+        data.append(DataFrame({"i": cc.id1.values-1, "k": cc.id2.values-1,
+                               "sta": cc.sta.values, "pha": cc.pha.values,
+                               "dt": cc.dt.values, "w": cc.w.values,
+                               "cc": True, "tt2": nan}))
+    obs = keepPairs(concat(data, ignore_index=True), hypoddConfig)
+    station_df = read_csv(stationFile)
+    station_df.code = station_df.code.str.strip()
+    station_df.drop_duplicates(["code"], inplace=True)
+    proj = regionProjection(config)
+    stations = column_stack(proj(longitude=station_df.lon.values,
+                                 latitude=station_df.lat.values))
+    obs = obs.assign(s=station_df.set_index("code").index.get_indexer(
+        obs.sta))
+    xyz = projectEvents(config, catalog["events"])
+    xyz[:, 2] = catalog["events"].Dep.fillna(10.0).replace(0.0, 10.0).values
+    return {"obs": obs,
+            "codes": station_df.code.tolist(),
+            "stations": stations,
+            "xyz": xyz,
+            "table": regionTravelTimeTable(config, velocity_df, cachePath,
+                                           xyz[:, 2])}
+
+
+def relocateInProcess(config,
+                      hypoddConfig,
+                      catalog,
+                      stationFile,
+                      velocity_df,
+                      cachePath=os.path.join("results", "cache")):
+    """Relocate a catalog without hypoDD and its input files
+
+    Data are gathered by solverInputs. There is no limit on the number
+    of events.
+
+    Args:
+        config (dict): configuration parameters
+        hypoddConfig (dict): hypoDD configuration parameters
+        catalog (dict): catalog tables
+        stationFile (str): path to the used stations file
+        velocity_df (DataFrame): velocity model
+        cachePath (str, optional): directory of the correlation cache and
+        travel-time tables.
+
+    Returns:
+        DataFrame: relocated events, see relocTable
+    """
+    print("+++ Relocating events with the in-process solver ...")
+    inputs = solverInputs(config, hypoddConfig, catalog, stationFile,
+                          velocity_df, cachePath)
+    xyz = inputs["xyz"]
+    result = solveDoubleDifference(inputs["table"], xyz, inputs["stations"],
+                                   inputs["obs"],
+                                   iterationSets(
+                                       hypoddConfig,
+                                       config["CrossCorrelation"]["Enabled"]))
+    msg = f"{int((result['cluster'] > 0).sum())} of {len(xyz)} events \
+relocated in {len(set(result['cluster'])-{0})} clusters"
+    print(f"+++ {msg}")
+    deep = (result["cluster"] > 0) & \
+        (result["xyz"][:, 2] > inputs["table"].maxDepth)
+    if deep.any():
+        msg = f"{int(deep.sum())} events relocated below \
+{inputs['table'].maxDepth:g} km, the depth of travel-time tables"
+        print(f"+++ {msg}")
+        logger(msg)
+    return relocTable(config, catalog, result)
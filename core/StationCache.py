@@ -0,0 +1,74 @@
+import sqlite3
+from pathlib import Path
+from time import time
+
+
+def openStationCache(cacheFile):
+    """Open the station metadata cache, creating it if needed
+
+    Args:
+        cacheFile (str): path to the SQLite cache file
+
+    Returns:
+        sqlite3.Connection: connection to the cache
+    """
+    Path(cacheFile).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(cacheFile)
+    conn.execute("""CREATE TABLE IF NOT EXISTS stations (
+                        code TEXT PRIMARY KEY,
+                        lat REAL,
+                        lon REAL,
+                        elv REAL,
+                        provider TEXT,
+                        fetched REAL)""")
+    return conn
+
+
+def readCachedStations(conn, codes, ttl=None):
+    """Look up stations in the cache
+
+    A cached row with no coordinates means that no provider knew the
+    station when it was last fetched.
+
+    Args:
+        conn (sqlite3.Connection): connection to the cache
+        codes (list): station codes
+        ttl (float, optional): maximum age of rows in days, None accepts
+        rows of any age.
+
+    Returns:
+        tuple: dict of found stations by code and list of codes known to
+        be missing
+    """
+    codes = set(codes)
+    oldest = -1.0 if ttl is None else time() - ttl*86400.0
+    found = {}
+    missed = []
+    for code, lat, lon, elv in conn.execute(
+            "SELECT code, lat, lon, elv FROM stations WHERE fetched > ?",
+            (oldest,)):
+        if code not in codes:
+            continue
+        if lat is None:
+            missed.append(code)
+        else:
+            found[code] = {"code": code, "lat": lat, "lon": lon, "elv": elv}
+    return found, missed
+
+
+def writeCachedStations(conn, stations, provider, missed=()):
+    """Store fetched stations in the cache
+
+    Args:
+        conn (sqlite3.Connection): connection to the cache
+        stations (list): dicts with "code", "lat", "lon" and "elv"
+        provider (str): name of the provider stations came from
+        missed (list, optional): codes no provider knew.
+    """
+    now = time()
+    rows = [(s["code"], s["lat"], s["lon"], s["elv"], provider, now)
+            for s in stations]
+    rows.extend((code, None, None, None, "", now) for code in missed)
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO stations VALUES (?, ?, ?, ?, ?, ?)", rows)
@@ -0,0 +1,313 @@
+import hashlib
+import os
+from pathlib import Path
+
+from numpy import (arange, arctan2, asarray, broadcast_arrays, ceil, clip,
+                   degrees, empty, full, gradient, inf, isfinite, load,
+                   minimum, nanmax, ones, save, sqrt, where, zeros)
+
+PHASES = ["P", "S"]
+QUANTITIES = ["time", "dtdr", "dtdz", "takeoff"]
+DEPTH_MARGIN = 20.0
+
+
+def layerVelocities(velocity_df, phase="P"):
+    """Get layer tops and velocities of a phase
+
+    Args:
+        velocity_df (DataFrame): velocity model with "vp", "depth" and
+        "vpvs" columns
+        phase (str, optional): "P" or "S". Defaults to "P".
+
+    Returns:
+        tuple: layer tops in km and velocities in km/s
+    """
+    tops = velocity_df.depth.to_numpy(dtype=float)
+    velocities = velocity_df.vp.to_numpy(dtype=float)
+    if phase.upper().startswith("S"):
+        velocities = velocities/velocity_df.vpvs.to_numpy(dtype=float)
+    return tops, velocities
+
+
+def crossedThickness(tops, depth, bottom):
+    """Thickness of each layer crossed between the surface and depth
+
+    Args:
+        tops (array): layer tops in km
+        depth (array): depths in km
+        bottom (float): depth of the deepest layer bottom
+
+    Returns:
+        array: crossed thickness, one column per layer
+    """
+    bottoms = list(tops[1:]) + [bottom]
+    thickness = zeros(depth.shape + (len(tops),))
+    for i, (top, base) in enumerate(zip(tops, bottoms)):
+        thickness[..., i] = clip(depth, top, base) - top
+    return thickness
+
+
+def directTimes(tops, velocities, depth, distance, nIterations=40):
+    """Travel times of up-going direct rays, found by bisection on the
+    ray parameter
+
+    Distance left over by grazing rays, e.g. from sources at the
+    surface, is travelled at the fastest velocity above the source.
+
+    Args:
+        tops (array): layer tops in km
+        velocities (array): layer velocities in km/s
+        depth (array): source depths in km
+        distance (array): epicentral distances in km
+
+    Returns:
+        array: travel times in s
+    """
+    bottom = max(depth.max(), tops[-1]) + 1.0
+    thickness = crossedThickness(tops, depth, bottom)
+    vmax = where(thickness > 0, velocities, 0.0).max(axis=-1)
+    vmax = where(vmax > 0, vmax, velocities[0])
+    velocities = where(thickness > 0, velocities, vmax[..., None])
+    low = zeros(depth.shape)
+    high = (1.0 - 1e-9)/vmax
+    for _ in range(nIterations):
+        p = (low + high)*0.5
+        pv = p[..., None]*velocities
+        x = (thickness*pv/sqrt(1.0 - pv**2)).sum(axis=-1)
+        tooFar = x > distance
+        high = where(tooFar, p, high)
+        low = where(tooFar, low, p)
+    pv = ((low + high)*0.5)[..., None]*velocities
+    x = (thickness*pv/sqrt(1.0 - pv**2)).sum(axis=-1)
+    t = (thickness/(velocities*sqrt(1.0 - pv**2))).sum(axis=-1)
+    return t + clip(distance - x, 0.0, None)/vmax
+
+
+def headWaveTimes(tops, velocities, depth, distance):
+    """Travel times of waves refracted along each layer top below source
+
+    Args:
+        tops (array): layer tops in km
+        velocities (array): layer velocities in km/s
+        depth (array): source depths in km
+        distance (array): epicentral distances in km
+
+    Returns:
+        array: earliest head wave time in s, inf if there is none
+    """
+    times = full(depth.shape, inf)
+    for m in range(1, len(tops)):
+        vm = velocities[m]
+        if (velocities[:m] >= vm).any():
+            continue
+        above = tops[:m+1]
+        station = crossedThickness(above[:-1], ones(depth.shape)*tops[m],
+                                   tops[m])
+        source = station - crossedThickness(above[:-1], depth, tops[m])
+        legs = station + source
+        v = velocities[:m]
+        cosine = sqrt(vm**2 - v**2)/(vm*v)
+        critical = (legs*v/sqrt(vm**2 - v**2)).sum(axis=-1)
+        t = distance/vm + (legs*cosine).sum(axis=-1)
+        valid = (depth <= tops[m]) & (distance >= critical)
+        times = where(valid, minimum(times, t), times)
+    return times
+
+
+def travelTimes(velocity_df, depth, distance, phase="P"):
+    """First arrival times through a 1D layered model
+
+    The earliest of the direct wave and the head waves along each layer
+    below the source is taken. Stations are at the surface.
+
+    Args:
+        velocity_df (DataFrame): velocity model
+        depth (array): source depths in km, negative values are clipped
+        distance (array): epicentral distances in km
+        phase (str, optional): "P" or "S". Defaults to "P".
+
+    Returns:
+        array: travel times in s
+    """
+    depth, distance = broadcast_arrays(asarray(depth, dtype=float),
+                                       asarray(distance, dtype=float))
+    depth = clip(depth, 0.0, None)
+    tops, velocities = layerVelocities(velocity_df, phase)
+    direct = directTimes(tops, velocities, depth, distance)
+    return minimum(direct, headWaveTimes(tops, velocities, depth, distance))
+
+
+def modelKey(velocity_df, maxDepth, maxDistance, spacing):
+    """Compute the cache key of travel-time tables
+
+    Args:
+        velocity_df (DataFrame): velocity model
+        maxDepth (float): largest tabulated depth in km
+        maxDistance (float): largest tabulated distance in km
+        spacing (float): grid spacing in km
+
+    Returns:
+        str: sha1 digest of the model and the grid
+    """
+    sha = hashlib.sha1()
+    sha.update(velocity_df[["depth", "vp", "vpvs"]].to_numpy(
+        dtype=float).tobytes())
+    sha.update(repr((float(maxDepth), float(maxDistance),
+                     float(spacing))).encode())
+    return sha.hexdigest()
+
+
+def tabulate(velocity_df, maxDepth, maxDistance, spacing):
+    """Compute travel times and their derivatives on a depth-distance grid
+
+    Derivatives are taken by central differences between grid nodes,
+    take-off angles are measured from the downward vertical.
+
+    Args:
+        velocity_df (DataFrame): velocity model
+        maxDepth (float): largest depth in km
+        maxDistance (float): largest distance in km
+        spacing (float): grid spacing in km
+
+    Returns:
+        array: values by phase, quantity, depth and distance, in PHASES
+        and QUANTITIES order
+    """
+    depths = arange(0.0, maxDepth + spacing/2, spacing)
+    distances = arange(0.0, maxDistance + spacing/2, spacing)
+    data = empty((len(PHASES), len(QUANTITIES), len(depths), len(distances)))
+    for p, phase in enumerate(PHASES):
+        times = travelTimes(velocity_df, depths[:, None], distances[None, :],
+                            phase)
+        dtdz, dtdr = gradient(times, spacing)
+        data[p] = [times, dtdr, dtdz, degrees(arctan2(dtdr, -dtdz))]
+    return data
+
+
+class TravelTimeTable():
+    """P and S travel times of a 1D model, tabulated for fast lookups
+
+    Tables cover source depths from 0 to maxDepth and epicentral
+    distances from 0 to maxDistance on a square grid, values outside are
+    those of the nearest edge. Stations are at the surface.
+
+    Args:
+        data (array): tables made by tabulate, possibly memory-mapped
+        spacing (float): grid spacing in km
+    """
+
+    def __init__(self, data, spacing):
+        self.data = data
+        self.spacing = spacing
+
+    @property
+    def maxDepth(self):
+        """Largest tabulated depth in km"""
+        return (self.data.shape[2] - 1)*self.spacing
+
+    def lookup(self, depth, distance, phase="P"):
+        """Interpolate tables bilinearly at many source-receiver pairs
+
+        Args:
+            depth (array): source depths in km
+            distance (array): epicentral distances in km
+            phase (str, optional): "P" or "S". Defaults to "P".
+
+        Returns:
+            tuple: travel times in s, their derivatives by distance and
+            depth in s/km and take-off angles in degrees
+        """
+        depth, distance = broadcast_arrays(asarray(depth, dtype=float),
+                                           asarray(distance, dtype=float))
+        table = self.data[PHASES.index(phase.upper()[:1])]
+        nz, nr = table.shape[1:]
+        fz = clip(depth/self.spacing, 0, nz - 1)
+        fr = clip(distance/self.spacing, 0, nr - 1)
+        iz = minimum(fz.astype(int), nz - 2)
+        ir = minimum(fr.astype(int), nr - 2)
+        wz = fz - iz
+        wr = fr - ir
+        values = (table[:, iz, ir]*(1 - wz)*(1 - wr) +
+                  table[:, iz, ir + 1]*(1 - wz)*wr +
+                  table[:, iz + 1, ir]*wz*(1 - wr) +
+                  table[:, iz + 1, ir + 1]*wz*wr)
+        return tuple(values)
+
+
+def loadTravelTimeTable(velocity_df,
+                        maxDepth,
+                        maxDistance,
+                        spacing=0.5,
+                        cachePath=None):
+    """Load travel-time tables, computing them only on cache miss
+
+    Tables are saved in cachePath under a hash of the model and the grid
+    and memory-mapped back, so they are computed once and shared by
+    concurrent processes.
+
+    Args:
+        velocity_df (DataFrame): velocity model
+        maxDepth (float): largest depth in km
+        maxDistance (float): largest distance in km
+        spacing (float, optional): grid spacing in km. Defaults to 0.5.
+        cachePath (str, optional): directory of table caches, tables are
+        kept in memory only if not given.
+
+    Returns:
+        TravelTimeTable: the tables
+    """
+    if cachePath is None:
+        return TravelTimeTable(tabulate(velocity_df, maxDepth, maxDistance,
+                                        spacing), spacing)
+    Path(cachePath).mkdir(parents=True, exist_ok=True)
+    key = modelKey(velocity_df, maxDepth, maxDistance, spacing)
+    cacheFile = os.path.join(cachePath, f"traveltimes_{key}.npy")
+    if not os.path.exists(cacheFile):
+        print("+++ Computing travel-time tables ...")
+        tmpFile = f"{cacheFile}.{os.getpid()}.tmp"
+        with open(tmpFile, "wb") as f:
+            save(f, tabulate(velocity_df, maxDepth, maxDistance, spacing))
+        os.replace(tmpFile, cacheFile)
+    return TravelTimeTable(load(cacheFile, mmap_mode="r"), spacing)
+
+
+def tableDepth(velocity_df, depths=None):
+    """Choose the largest depth of travel-time tables
+
+    Tables reach DEPTH_MARGIN km below the deepest layer top of the model
+    and the deepest event, rounded up to 10 km so that catalogs of
+    similar depths share cached tables.
+
+    Args:
+        velocity_df (DataFrame): velocity model
+        depths (array, optional): event depths in km.
+
+    Returns:
+        float: largest depth in km
+    """
+    deepest = velocity_df.depth.max()
+    if depths is not None and isfinite(depths).any():
+        deepest = max(deepest, nanmax(depths))
+    return float(ceil((deepest + DEPTH_MARGIN)/10.0)*10.0)
+
+
+def regionTravelTimeTable(config, velocity_df, cachePath=None, depths=None):
+    """Load travel-time tables covering the study region
+
+    Distances reach the diameter of the region, so all pairs of events
+    and used stations are covered. Depths are chosen by tableDepth.
+
+    Args:
+        config (dict): configuration parameters
+        velocity_df (DataFrame): velocity model
+        cachePath (str, optional): directory of table caches, see
+        loadTravelTimeTable.
+        depths (array, optional): event depths in km.
+
+    Returns:
+        TravelTimeTable: the tables
+    """
+    return loadTravelTimeTable(velocity_df,
+                               tableDepth(velocity_df, depths),
+                               2*config["Region"]["Radius"],
+                               cachePath=cachePath)
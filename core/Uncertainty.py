@@ -0,0 +1,550 @@
+import json
+import os
+from pathlib import Path
+from shutil import rmtree
+
+from numpy import (arange, arcsin, arctan2, array, column_stack, degrees,
+                   einsum, full, isfinite, load, nan, nan_to_num, save, sqrt,
+                   where, zeros)
+from numpy.linalg import eigh
+from numpy.random import default_rng
+from pandas import DataFrame, concat, factorize, to_datetime
+
+from core.Catalog import loadCatalog, selectEvents
+from core.Chunking import coreMask, makeChunks, regionProjection
+from core.Config import (RelocationError, currentRun, processPool,
+                         runContext)
+from core.CrossCorr import writeCrossCorrelationTimes
+from core.DiffTime import writeEventFile, writePairs
+from core.Extra import (loadHypoDDRelocFile, loadVelocityFile, logger,
+                        readHypoddConfig)
+from core.Input import iterationSets, prepareHypoDD, prepareHypoddInputs
+from core.Nordic import COVARIANCE_COLUMNS, patchNordic, writeNordicEvents
+from core.Runner import ProgramError, reportProgramError, runHypoDD
+from core.Solver import (keepPairs, rayDerivatives, solveDoubleDifference,
+                         solverInputs)
+from core.TravelTime import regionTravelTimeTable
+from core.Xyzm import readXyzm, writeXyzm, xyzmPath
+
+METHODS = ["bootstrap", "station", "pair"]
+DATA_TYPE = [("i", "i8"), ("k", "i8"), ("s", "i8"), ("S", "?"),
+             ("cc", "?"), ("dt", "f8"), ("w", "f8"), ("tt2", "f8"),
+             ("res", "f8"), ("group", "i8")]
+
+
+def relocatedPositions(config, catalog, hypodd_df):
+    """Get event coordinates and origin time shifts from hypoDD.reloc
+
+    Args:
+        config (dict): configuration parameters
+        catalog (dict): catalog tables given to hypoDD
+        hypodd_df (DataFrame): relocated events, see
+        core.Extra.loadHypoDDRelocFile
+
+    Returns:
+        tuple: event x, y and z in km and origin time shifts in s, NaN for
+        events not relocated
+    """
+    n = len(catalog["events"])
+    xyz = full((n, 3), nan)
+    dtau = full(n, nan)
+    if not len(hypodd_df):
+        return xyz, dtau
+    pos = hypodd_df.ID.values.astype(int) - 1
+    x, y = regionProjection(config)(hypodd_df.LON.values,
+                                     hypodd_df.LAT.values)
+    xyz[pos] = column_stack([x, y, hypodd_df.DEPTH.values])
+    ort = to_datetime(DataFrame({"year": hypodd_df.YR.values,
+                                 "month": hypodd_df.MO.replace(0, 1).values,
+                                 "day": hypodd_df.DY.replace(0, 1).values,
+                                 "hour": hypodd_df.HR.values,
+                                 "minute": hypodd_df.MI.values,
+                                 "second": hypodd_df.SC.values}))
+    dtau[pos] = (ort.values.astype("int64") -
+                 catalog["events"].ORT.values[pos])*1e-9
+    return xyz, dtau
+
+
+def dataResiduals(table, xyz, dtau, stations, data):
+    """Residuals of differential times at relocated positions
+
+    Args:
+        table (TravelTimeTable): travel-time tables of the velocity model
+        xyz (array): event coordinates in km
+        dtau (array): origin time shifts in s
+        stations (array): x and y of stations in km
+        data (array): shared data, see DATA_TYPE
+
+    Returns:
+        array: residuals in s, NaN where an event was not relocated
+    """
+    i, k, s = data["i"], data["k"], data["s"]
+    phases = where(data["S"], "S", "P")
+    t1 = rayDerivatives(table, nan_to_num(xyz[i]), stations[s], phases)[0]
+    t2 = rayDerivatives(table, nan_to_num(xyz[k]), stations[s], phases)[0]
+    return data["dt"] - (t1 + dtau[i] - t2 - dtau[k])
+
+
+def resampleGroups(data, method, nRealizations, rng):
+    """Assign data to the groups left out by jackknife realizations
+
+    Args:
+        data (array): shared data, see DATA_TYPE
+        method (str): "station" or "pair"
+        nRealizations (int): largest number of groups
+        rng (Generator): random generator
+
+    Returns:
+        tuple: group of each datum and number of groups
+    """
+    if method == "station":
+        units, _ = factorize(data["s"])
+    else:
+        units, _ = factorize(data["i"]*(data["k"].max() + 1) + data["k"])
+    nUnits = units.max() + 1 if len(units) else 0
+    nGroups = min(nRealizations, nUnits)
+    if not nGroups:
+        return units, 0
+    return rng.permutation(nUnits)[units] % nGroups, nGroups
+
+
+def prepareShared(nChunk,
+                  config,
+                  hypoddConfig,
+                  catalog,
+                  stationFile,
+                  velocity_df,
+                  sharedPath,
+                  cachePath,
+                  run):
+    """Build differential times once and relocate them as a reference
+
+    Data are saved as one memory-mapped array used by all realizations,
+    see DATA_TYPE, with their residuals at reference locations and the
+    jackknife group they belong to. hypoDD input files are written next
+    to them.
+
+    Args:
+        nChunk (int): chunk number, starting from zero
+        config (dict): configuration parameters
+        hypoddConfig (dict): hypoDD configuration parameters
+        catalog (dict): catalog tables of the chunk
+        stationFile (str): path to the used stations file
+        velocity_df (DataFrame): velocity model
+        sharedPath (str): directory of shared files of the chunk
+        cachePath (str): directory of the correlation cache and
+        travel-time tables
+        run (dict): run logs go to, see core.Config.currentRun
+
+    Returns:
+        tuple: chunk number and number of realizations
+    """
+    uncertaintyConfig = config["Uncertainty"]
+    method = uncertaintyConfig["Method"]
+    Path(sharedPath).mkdir(parents=True, exist_ok=True)
+    with runContext(run):
+        inputs = solverInputs(config, hypoddConfig, catalog, stationFile,
+                              velocity_df, cachePath)
+        obs = inputs["obs"]
+        data = zeros(len(obs), dtype=DATA_TYPE)
+        for name, column in [("i", "i"), ("k", "k"), ("s", "s"),
+                             ("cc", "cc"), ("dt", "dt"), ("w", "w"),
+                             ("tt2", "tt2")]:
+            data[name] = obs[column].values
+        data["S"] = (obs.pha == "S").values
+        if config["Relocation"]["Engine"] == "python":
+            result = solveDoubleDifference(
+                inputs["table"], inputs["xyz"], inputs["stations"], obs,
+                iterationSets(hypoddConfig,
+                              config["CrossCorrelation"]["Enabled"]))
+            relocated = result["cluster"] > 0
+            xyz = where(relocated[:, None], result["xyz"], nan)
+            dtau = where(relocated, result["dtau"], nan)
+        else:
+            prepareHypoddInputs(config, hypoddConfig, catalog, stationFile,
+                                velocity_df, os.path.dirname(sharedPath),
+                                sharedPath)
+            writeEventFile(catalog, os.path.join(sharedPath, "event.dat"))
+            if writeData(sharedPath, data, inputs["codes"]):
+                prepareHypoDD(config, hypoddConfig, velocity_df, sharedPath,
+                              crossCorrelation=True)
+            runHypoDD(config, f"Chunk {nChunk+1} reference",
+                      len(catalog["events"]), path=sharedPath)
+            xyz, dtau = relocatedPositions(config, catalog,
+                                           loadHypoDDRelocFile(sharedPath))
+        data["res"] = dataResiduals(inputs["table"], xyz, dtau,
+                                    inputs["stations"], data)
+        rng = default_rng([uncertaintyConfig["Seed"], nChunk])
+        nRealizations = uncertaintyConfig["Realizations"]
+        if method != "bootstrap":
+            data["group"], nRealizations = resampleGroups(
+                data, method, nRealizations, rng)
+        save(os.path.join(sharedPath, "data.npy"), data)
+        save(os.path.join(sharedPath, "xyz.npy"), inputs["xyz"])
+        save(os.path.join(sharedPath, "stations.npy"), inputs["stations"])
+        with open(os.path.join(sharedPath, "codes.json"), "w") as f:
+            json.dump(inputs["codes"], f)
+    return nChunk, nRealizations
+
+
+def writeData(path, data, codes):
+    """Write dt.ct, and dt.cc if there are cross-correlation data
+
+    Args:
+        path (str): directory of output files
+        data (array): data, see DATA_TYPE
+        codes (list): station codes
+
+    Returns:
+        bool: whether dt.cc was written
+    """
+    codes = array(codes)
+    ct = data[~data["cc"]]
+    with open(os.path.join(path, "dt.ct"), "w") as f:
+        writePairs(f, DataFrame({"i": ct["i"], "k": ct["k"],
+                                 "sta": codes[ct["s"]],
+                                 "tt1": ct["dt"] + ct["tt2"],
+                                 "tt2": ct["tt2"], "w": ct["w"],
+                                 "pha": where(ct["S"], "S", "P")}))
+    cc = data[data["cc"]]
+    if not len(cc):
+        return False
+    writeCrossCorrelationTimes(
+        os.path.join(path, "dt.cc"),
+        DataFrame({"id1": cc["i"] + 1, "id2": cc["k"] + 1,
+                   "sta": codes[cc["s"]], "dt": cc["dt"], "w": cc["w"],
+                   "pha": where(cc["S"], "S", "P")}))
+    return True
+
+
+def resampleData(data, method, nRealization, rng):
+    """Draw the data of one realization
+
+    The residual bootstrap adds to each datum the difference between a
+    residual drawn from the same kind of data, catalog or correlation
+    and P or S, and its own residual. Jackknife realizations leave out
+    one group of stations or event pairs.
+
+    Args:
+        data (array): shared data, see DATA_TYPE
+        method (str): "bootstrap", "station" or "pair"
+        nRealization (int): realization number, starting from zero
+        rng (Generator): random generator
+
+    Returns:
+        array: data of the realization
+    """
+    if method != "bootstrap":
+        return data[data["group"] != nRealization]
+    data = array(data)
+    res = data["res"]
+    for cc in [False, True]:
+        for s in [False, True]:
+            index = ((data["cc"] == cc) & (data["S"] == s) &
+                     isfinite(res)).nonzero()[0]
+            if not len(index):
+                continue
+            centred = res[index] - res[index].mean()
+            data["dt"][index] += rng.choice(centred, len(index)) - \
+                centred
+    return data
+
+
+def runRealization(nChunk,
+                   nRealization,
+                   config,
+                   hypoddConfig,
+                   catalog,
+                   velocity_df,
+                   sharedPath,
+                   cachePath,
+                   run):
+    """Relocate one resampled set of differential times
+
+    Shared data are memory-mapped, hypoDD input files other than
+    differential times are linked from the shared directory. A
+    realization left without cross-correlation data gets its own
+    hypoDD.inp reading dt.ct only.
+
+    Args:
+        nChunk (int): chunk number, starting from zero
+        nRealization (int): realization number, starting from zero
+        config (dict): configuration parameters
+        hypoddConfig (dict): hypoDD configuration parameters
+        catalog (dict): catalog tables of the chunk
+        velocity_df (DataFrame): velocity model
+        sharedPath (str): directory of shared files of the chunk
+        cachePath (str): directory of travel-time tables
+        run (dict): run logs go to, see core.Config.currentRun
+
+    Returns:
+        tuple: chunk and realization numbers, event coordinates in km and
+        origin time shifts in s, NaN for events not relocated
+    """
+    uncertaintyConfig = config["Uncertainty"]
+    rng = default_rng([uncertaintyConfig["Seed"], nChunk, nRealization + 1])
+    data = resampleData(load(os.path.join(sharedPath, "data.npy"),
+                             mmap_mode="r"),
+                        uncertaintyConfig["Method"], nRealization, rng)
+    with open(os.path.join(sharedPath, "codes.json")) as f:
+        codes = json.load(f)
+    with runContext(run):
+        if config["Relocation"]["Engine"] == "python":
+            obs = keepPairs(DataFrame({
+                "i": data["i"], "k": data["k"], "s": data["s"],
+                "sta": data["s"], "pha": where(data["S"], "S", "P"),
+                "dt": data["dt"], "w": data["w"], "cc": data["cc"]}),
+                hypoddConfig)
+            xyz = load(os.path.join(sharedPath, "xyz.npy"))
+            result = solveDoubleDifference(
+                regionTravelTimeTable(config, velocity_df, cachePath,
+                                      xyz[:, 2]),
+                xyz,
+                load(os.path.join(sharedPath, "stations.npy")),
+                obs,
+                iterationSets(hypoddConfig,
+                              config["CrossCorrelation"]["Enabled"]))
+            relocated = result["cluster"] > 0
+            return (nChunk, nRealization,
+                    where(relocated[:, None], result["xyz"], nan),
+                    where(relocated, result["dtau"], nan))
+        realizationPath = os.path.join(sharedPath,
+                                       f"realization_{nRealization+1}")
+        Path(realizationPath).mkdir(parents=True, exist_ok=True)
+        shared = ["event.dat", "station.dat"]
+        if writeData(realizationPath, data, codes):
+            shared.append("hypoDD.inp")
+        else:
+            prepareHypoDD(config, hypoddConfig, velocity_df, realizationPath)
+        for f in shared:
+            target = os.path.join(realizationPath, f)
+            if not os.path.lexists(target):
+                os.symlink(os.path.join(sharedPath, f), target)
+        runHypoDD(config, f"Chunk {nChunk+1} realization {nRealization+1}",
+                  len(catalog["events"]), path=realizationPath)
+        xyz, dtau = relocatedPositions(config, catalog,
+                                       loadHypoDDRelocFile(realizationPath))
+        rmtree(realizationPath)
+    return nChunk, nRealization, xyz, dtau
+
+
+def ellipsoids(xyz, dtau, method):
+    """Reduce relocations of realizations to error ellipsoids
+
+    Covariances are the sample ones for the bootstrap and the jackknife
+    ones, scaled by (m-1)/m instead of 1/(m-1), otherwise, m being the
+    number of realizations that relocated the event. Events relocated by
+    fewer than three realizations get none. Semi-axes are one standard
+    deviation long.
+
+    Args:
+        xyz (array): event coordinates in km, by realization and event
+        dtau (array): origin time shifts in s, by realization and event
+        method (str): "bootstrap", "station" or "pair"
+
+    Returns:
+        DataFrame: by event, number of realizations "n", covariances
+        "SXX" to "SYZ" in km^2, origin time error "ERT" in s, semi-axes
+        "S1" to "S3" in km, largest first, and azimuth and plunge in
+        degrees of the largest "AZ1", "PL1" and smallest "AZ3", "PL3"
+        axes
+    """
+    relocated = isfinite(xyz).all(axis=2)
+    m = relocated.sum(axis=0)
+    scale = where(m > 2, 1.0/where(m > 1, m - 1, 1), nan)
+    if method != "bootstrap":
+        scale *= (m - 1)**2/where(m > 0, m, 1)
+    mean = nan_to_num(xyz).sum(axis=0)/where(m > 0, m, 1)[:, None]
+    d = where(relocated[:, :, None], xyz - mean, 0.0)
+    cov = einsum("rni,rnj->nij", d, d)*scale[:, None, None]
+    t = where(relocated, dtau - nan_to_num(dtau).sum(axis=0) /
+              where(m > 0, m, 1), 0.0)
+    values, vectors = eigh(nan_to_num(cov))
+    values = sqrt(values.clip(0, None))
+    axes = {}
+    for name, column in [("1", 2), ("3", 0)]:
+        v = vectors[:, :, column]*where(vectors[:, 2:, column] < 0, -1, 1)
+        axes[f"AZ{name}"] = degrees(arctan2(v[:, 0], v[:, 1])) % 360.0
+        axes[f"PL{name}"] = degrees(arcsin(v[:, 2].clip(-1, 1)))
+    df = DataFrame({"n": m,
+                    "SXX": cov[:, 0, 0], "SYY": cov[:, 1, 1],
+                    "SZZ": cov[:, 2, 2], "SXY": cov[:, 0, 1],
+                    "SXZ": cov[:, 0, 2], "SYZ": cov[:, 1, 2],
+                    "ERT": sqrt((t**2).sum(axis=0)*scale),
+                    "S1": values[:, 2], "S2": values[:, 1],
+                    "S3": values[:, 0], **axes})
+    df.loc[~(m > 2), df.columns[1:]] = nan
+    return df
+
+
+def writeUncertainty(config, catalog, ellipsoid_df, locationPath):
+    """Write error ellipsoids into the relocated xyzm and Nordic files
+
+    ERH and ERZ become sqrt(SXX + SYY) and sqrt(SZZ), Nordic type E
+    lines also receive the origin time error and, unless written through
+    obspy which has no field for them, covariances.
+
+    Args:
+        config (dict): configuration parameters
+        catalog (dict): catalog tables
+        ellipsoid_df (DataFrame): ellipsoids of catalog events, see
+        ellipsoids
+        locationPath (str): path to the results directory
+    """
+    outName = f"{config['Region']['RegionName']}"
+    xyzmFormat = config["Relocation"]["XyzmFormat"]
+    xyzmFile = xyzmPath(f"{outName}_hypodd", xyzmFormat, locationPath)
+    hypodd_df = readXyzm(xyzmFile)
+    if len(hypodd_df) != len(ellipsoid_df):
+        msg = f"+++ {xyzmFile} does not match the input catalog, relocate \
+it again! Aborting ..."
+        print(msg)
+        logger(msg)
+        raise RelocationError(msg)
+    hypodd_df["ERH"] = sqrt(ellipsoid_df.SXX + ellipsoid_df.SYY).values
+    hypodd_df["ERZ"] = sqrt(ellipsoid_df.SZZ).values
+    writeXyzm(hypodd_df, xyzmFile)
+    relocated = hypodd_df[["ORT", "Lat", "Lon", "Dep", "ERH", "ERZ", "GAP"]]
+    relocated = relocated.assign(ERT=ellipsoid_df.ERT.values)
+    nordicFile = os.path.join(locationPath, f"{outName}_hypodd.out")
+    if config["Relocation"]["NordicOutput"] == "obspy":
+        ellipsoidFile = os.path.join(locationPath, "uncertainty",
+                                     f"ellipsoids_{outName}.csv")
+        msg = f"Covariances are not written to {nordicFile} by obspy, \
+see {ellipsoidFile}"
+        print(f"+++ {msg}")
+        logger(msg)
+        writeNordicEvents(catalog, relocated, nordicFile)
+    else:
+        covariance = ellipsoid_df[["SXY", "SXZ", "SYZ"]].values
+        relocated = relocated.assign(**dict(zip(COVARIANCE_COLUMNS,
+                                                covariance.T)))
+        patchNordic(catalog, relocated, nordicFile)
+
+
+def estimateUncertainty(config, runPath=".", catalog=None, hypoddConfig=None):
+    """Estimate relocation errors by resampling differential times
+
+    Differential times of each chunk of locateHypoDD are built once and
+    relocated as a reference. Resampled sets, see resampleData, are then
+    relocated concurrently with the configured engine and reduced to
+    error ellipsoids, written to results/uncertainty and into the
+    relocated xyzm and Nordic files made by locateHypoDD.
+
+    Args:
+        config (dict): configuration parameters
+        runPath (str, optional): run directory holding files, stations
+        and results. Defaults to ".".
+        catalog (dict, optional): catalog tables of the input catalog,
+        loaded from Files.InputCatalogFileName if not given.
+        hypoddConfig (dict, optional): hypoDD configuration parameters,
+        read from files/hypodd.yml if not given.
+
+    Raises:
+        RelocationError: if settings or relocated files are invalid, or
+        chunks or realizations fail, with their labels
+
+    Returns:
+        DataFrame: ellipsoids of catalog events, see ellipsoids
+    """
+    print("+++ Estimating relocation uncertainty ...")
+    uncertaintyConfig = config["Uncertainty"]
+    method = uncertaintyConfig["Method"]
+    if method not in METHODS:
+        msg = f"+++ Uncertainty method must be one of {METHODS}! Aborting ..."
+        print(msg)
+        logger(msg)
+        raise RelocationError(msg)
+    if hypoddConfig is None:
+        hypoddConfig = readHypoddConfig(
+            os.path.join(runPath, "files", "hypodd.yml"))
+    outName = f"{config['Region']['RegionName']}"
+    stationFile = os.path.abspath(
+        os.path.join(runPath, "stations", "usedStations.csv"))
+    locationPath = os.path.abspath(os.path.join(runPath, "results"))
+    xyzmFile = xyzmPath(f"{outName}_hypodd",
+                        config["Relocation"]["XyzmFormat"], locationPath)
+    if not os.path.exists(xyzmFile):
+        msg = f"+++ {xyzmFile} not found, relocate the catalog first! \
+Aborting ..."
+        print(msg)
+        logger(msg)
+        raise RelocationError(msg)
+    uncertaintyPath = os.path.join(locationPath, "uncertainty")
+    cachePath = os.path.join(locationPath, "cache")
+    velocity_df = loadVelocityFile(config)
+    catalogFile = os.path.join(runPath,
+                               config["Files"]["InputCatalogFileName"])
+    if catalog is None:
+        catalog = loadCatalog(catalogFile, cachePath)
+    nEvents = len(catalog["events"])
+    if config["Relocation"]["Engine"] == "python":
+        chunks = [(arange(nEvents), arange(nEvents))]
+    else:
+        chunks = makeChunks(config, hypoddConfig, catalog["events"])
+    crossCorrelation = config["CrossCorrelation"]
+    chunkConfig = dict(config, CrossCorrelation=dict(
+        crossCorrelation,
+        Archive=os.path.abspath(os.path.join(runPath,
+                                             crossCorrelation["Archive"]))))
+    catalogs = [selectEvents(catalog, members) for _, members in chunks]
+    sharedPaths = [os.path.join(uncertaintyPath, f"chunk_{nChunk+1}")
+                   for nChunk in range(len(chunks))]
+    run = currentRun()
+    results = {}
+    failed = []
+    with processPool(uncertaintyConfig["Workers"]) as pool:
+        jobs = {pool.submit(prepareShared, nChunk, chunkConfig, hypoddConfig,
+                            catalogs[nChunk], stationFile, velocity_df,
+                            sharedPaths[nChunk], cachePath, run): nChunk
+                for nChunk in range(len(chunks))}
+        realizations = {}
+        for job, nChunk in jobs.items():
+            try:
+                realizations[nChunk] = job.result()[1]
+            except ProgramError as error:
+                failed.append(f"chunk {nChunk+1}")
+                reportProgramError(error, f"Chunk {nChunk+1} reference")
+        jobs = {}
+        for nChunk, nRealizations in realizations.items():
+            msg = f"Chunk {nChunk+1}: {nRealizations} {method} realizations"
+            print(f"+++ {msg}")
+            logger(msg)
+            for nRealization in range(nRealizations):
+                job = pool.submit(runRealization, nChunk, nRealization,
+                                  chunkConfig, hypoddConfig, catalogs[nChunk],
+                                  velocity_df, sharedPaths[nChunk], cachePath,
+                                  run)
+                jobs[job] = (nChunk, nRealization)
+        for job, (nChunk, nRealization) in jobs.items():
+            try:
+                _, _, xyz, dtau = job.result()
+            except ProgramError as error:
+                label = f"Chunk {nChunk+1} realization {nRealization+1}"
+                failed.append(label.lower())
+                reportProgramError(error, label)
+                continue
+            results.setdefault(nChunk, []).append((xyz, dtau))
+    if failed:
+        msg = f"Uncertainty estimation failed for {failed}, see logs!"
+        print(f"+++ {msg}")
+        logger(msg)
+        raise RelocationError(msg, failed)
+    ellipsoid_dfs = []
+    for nChunk, (core, members) in enumerate(chunks):
+        runs = results.get(nChunk, [])
+        xyz = array([r[0] for r in runs]).reshape(len(runs), len(members), 3)
+        dtau = array([r[1] for r in runs]).reshape(len(runs), len(members))
+        ellipsoid_df = ellipsoids(xyz, dtau, method)
+        ellipsoid_df.insert(0, "evt", catalogs[nChunk]["events"].index)
+        ellipsoid_dfs.append(ellipsoid_df[coreMask(core, members)])
+    ellipsoid_df = concat(ellipsoid_dfs).sort_values(by=["evt"])
+    ellipsoid_df.to_csv(os.path.join(uncertaintyPath,
+                                     f"ellipsoids_{outName}.csv"),
+                        index=False, float_format="%.6g")
+    writeUncertainty(config, catalog, ellipsoid_df, locationPath)
+    msg = f"Error ellipsoids of {int(ellipsoid_df.S1.notna().sum())} of \
+{nEvents} events written to {uncertaintyPath}"
+    print(f"+++ {msg}")
+    logger(msg)
+    return ellipsoid_df
@@ -0,0 +1,107 @@
+import os
+
+from numpy import load, savez
+from pandas import DataFrame, read_csv, read_feather, read_parquet
+
+XYZM_COLUMNS = ["ORT", "Lon", "Lat", "Dep", "Mag",
+                "Nus", "NuP", "NuS", "ADS", "MDS", "GAP", "RMS", "ERH", "ERZ"]
+XYZM_FORMATS = {
+    "ORT": "{:}",
+    "Lon": "{:7.3f}",
+    "Lat": "{:7.3f}",
+    "Dep": "{:7.3f}",
+    "Mag": "{:4.1f}",
+    "Nus": "{:3.0f}",
+    "NuP": "{:3.0f}",
+    "NuS": "{:3.0f}",
+    "ADS": "{:5.1f}",
+    "MDS": "{:5.1f}",
+    "GAP": "{:3.0f}",
+    "RMS": "{:5.2f}",
+    "ERH": "{:7.3f}",
+    "ERZ": "{:7.3f}",
+}
+XYZM_EXTENSIONS = {"text": ".dat",
+                   "npz": ".npz",
+                   "parquet": ".parquet",
+                   "feather": ".feather"}
+
+
+def xyzmPath(name, fmt="text", path=""):
+    """Build path of a xyzm file
+
+    Args:
+        name (str): name of xyzm file, e.g. "EAlborz_hypodd"
+        fmt (str, optional): one of "text", "npz", "parquet" or "feather".
+        path (str, optional): directory of xyzm file.
+
+    Returns:
+        str: path to xyzm file
+    """
+    return os.path.join(path, f"xyzm_{name}{XYZM_EXTENSIONS[fmt]}")
+
+
+def formatColumn(values, fmt):
+    """Format values of a column, writing missing values as NaN"""
+    return [fmt.format(v) if v is not None and v == v else "NaN"
+            for v in values]
+
+
+def writeXyzmText(df, outputFile):
+    """Write a fixed-width xyzm text file
+
+    The layout is the one of DataFrame.to_string: right-justified columns
+    separated by one space.
+
+    Args:
+        df (DataFrame): xyzm table
+        outputFile (str): path to output file
+    """
+    columns = []
+    for column in XYZM_COLUMNS:
+        cells = formatColumn(df[column].tolist(), XYZM_FORMATS[column])
+        width = max([len(column)] + [len(cell) for cell in cells])
+        columns.append([column.rjust(width)] +
+                       [cell.rjust(width) for cell in cells])
+    with open(outputFile, "w") as f:
+        f.write("\n".join(" ".join(row) for row in zip(*columns)))
+
+
+def writeXyzm(df, outputFile):
+    """Write a xyzm table in the format given by file extension
+
+    Args:
+        df (DataFrame): xyzm table
+        outputFile (str): path to output file
+    """
+    if outputFile.endswith(XYZM_EXTENSIONS["npz"]):
+        arrays = {c: df[c].to_numpy() for c in XYZM_COLUMNS}
+        arrays["ORT"] = df.ORT.fillna("").to_numpy(dtype=str)
+        savez(outputFile, **arrays)
+    elif outputFile.endswith(XYZM_EXTENSIONS["parquet"]):
+        df[XYZM_COLUMNS].reset_index(drop=True).to_parquet(outputFile)
+    elif outputFile.endswith(XYZM_EXTENSIONS["feather"]):
+        df[XYZM_COLUMNS].reset_index(drop=True).to_feather(outputFile)
+    else:
+        writeXyzmText(df, outputFile)
+
+
+def readXyzm(inputFile):
+    """Read a xyzm table in the format given by file extension
+
+    Args:
+        inputFile (str): path to xyzm file
+
+    Returns:
+        DataFrame: xyzm table
+    """
+    if inputFile.endswith(XYZM_EXTENSIONS["npz"]):
+        with load(inputFile) as data:
+            df = DataFrame({c: data[c] for c in XYZM_COLUMNS})
+        df["ORT"] = df.ORT.where(df.ORT != "")
+        return df
+    if inputFile.endswith(XYZM_EXTENSIONS["parquet"]):
+        return read_parquet(inputFile)
+    if inputFile.endswith(XYZM_EXTENSIONS["feather"]):
+        return read_feather(inputFile)
+    return read_csv(inputFile, sep=r"\s+")
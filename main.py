@@ -1,26 +1,74 @@
-from core.Extra import readConfiguration
-from core.Locate import locateHypoDD
-from core.PrepareInputs import CreatInputStationFile, GetStationListFromCatalog
-from core.Visulize import plotSeismicityMap
+"""Command line entry point of PyHypoDD.
 
+Each command imports only the modules it needs, so e.g. a relocation
+does not load plotting or web libraries.
 
-class Main():
-    def __init__(self):
-        self.config = readConfiguration()
+Usage:
+    python main.py [run] [--stages stations locate plot figures] [--force]
+    python main.py prepare-stations
+    python main.py locate [--force]
+    python main.py optimize
+    python main.py uncertainty
+    python main.py plot
+    python main.py figures
+"""
+import sys
+from argparse import ArgumentParser
 
-    def prepareStations(self):
-        GetStationListFromCatalog(self.config)
-        CreatInputStationFile(self.config)
+from core.Config import RelocationError
+from core.Project import STAGES, Project
 
-    def locate(self):
-        locateHypoDD(self.config)
 
-    def visulize(self):
-        plotSeismicityMap(self.config)
+def parseArguments(argv=None):
+    parser = ArgumentParser(description="Relocate earthquakes with hypoDD.")
+    commands = parser.add_subparsers(dest="command")
+    run = commands.add_parser("run", help="run the whole pipeline, skipping "
+                              "up-to-date stages (default)")
+    run.add_argument("--stages", nargs="+", default=None,
+                     choices=STAGES,
+                     help="stages to consider, all by default")
+    run.add_argument("--force", action="store_true",
+                     help="run stages even if up to date")
+    commands.add_parser("prepare-stations",
+                        help="build the station file of catalog stations")
+    locate = commands.add_parser("locate", help="relocate the catalog")
+    locate.add_argument("--force", action="store_true",
+                        help="relocate chunks completed by a previous run")
+    commands.add_parser("optimize", help="tune hypoDD parameters")
+    commands.add_parser("uncertainty",
+                        help="estimate relocation errors by resampling")
+    commands.add_parser("plot", help="plot the seismicity map")
+    commands.add_parser("figures",
+                        help="plot cross-sections and time-lapse frames")
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or argv[0] not in commands.choices and \
+            argv[0] not in ["-h", "--help"]:
+        argv = ["run"] + argv
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArguments(argv)
+    try:
+        app = Project.fromPath()
+        if args.command == "run":
+            app.runStages(args.stages, args.force)
+        elif args.command == "prepare-stations":
+            app.prepareStations()
+        elif args.command == "locate":
+            app.locate(args.force)
+        elif args.command == "optimize":
+            app.optimize()
+        elif args.command == "uncertainty":
+            app.uncertainty()
+        elif args.command == "plot":
+            app.visulize()
+        elif args.command == "figures":
+            app.figures()
+    except RelocationError:
+        sys.exit(1)
+    app.summarize()
 
 
 if "__main__" == __name__:
-    app = Main()
-    app.prepareStations()
-    app.locate()
-    app.visulize()
+    main()
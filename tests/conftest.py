@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = os.path.join(ROOT, "tests", "data")
+sys.path.insert(0, ROOT)
+
+from core.Config import currentRun, runContext  # noqa: E402
+from core.Config import readConfiguration, readHypoddConfig  # noqa: E402
+
+
+@pytest.fixture
+def run(tmp_path):
+    """Send logs of the test to its temporary directory"""
+    with runContext(dict(currentRun(), path=str(tmp_path))) as run:
+        yield run
+
+
+@pytest.fixture
+def config(run):
+    return readConfiguration(os.path.join(ROOT, "config.yml"))
+
+
+@pytest.fixture
+def hypoddConfig(run):
+    return readHypoddConfig(os.path.join(ROOT, "files", "hypodd.yml"))
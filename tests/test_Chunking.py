@@ -0,0 +1,35 @@
+import pytest
+from numpy import arange, concatenate, full
+from pandas import DataFrame
+
+from core.Chunking import coreMask, spatialChunks
+
+
+@pytest.fixture
+def events(config):
+    """A tight cluster west of a sparse line of events"""
+    lon = concatenate([full(30, 55.0) + arange(30)*1e-4,
+                       55.05 + arange(10)*0.01])
+    return DataFrame({"Lon": lon, "Lat": full(40, 37.0),
+                      "Dep": full(40, 10.0)})
+
+
+def testEmptyCatalogHasNoChunks(config, events):
+    assert spatialChunks(config, events[:0], 10, 5.0) == []
+
+
+def testEveryEventHasOneCore(config, events):
+    chunks = spatialChunks(config, events, 10, 5.0)
+    cores = concatenate([core for core, _ in chunks])
+    assert sorted(cores) == list(range(len(events)))
+    for core, members in chunks:
+        assert coreMask(core, members).sum() == len(core)
+
+
+def testHaloKeepsNearestEvents(config, events):
+    chunks = spatialChunks(config, events, 10, 100.0, maxHalo=3)
+    for core, members in chunks:
+        assert len(members) == len(core) + 3
+    core, members = chunks[-1]
+    halo = sorted(set(members) - set(core))
+    assert halo == list(range(core.min() - 3, core.min()))
@@ -0,0 +1,120 @@
+import os
+
+import pytest
+from pandas import DataFrame
+
+from benchmarks.Ph2dtReference import makeReference, realPh2dt
+from conftest import DATA
+from core.Catalog import EVENT_COLUMNS, PICK_COLUMNS, loadCatalog
+from core.DiffTime import (buildDifferentialTimes, compareDifferentialTimes,
+                           differentialTimes, readDifferentialTimes)
+
+STATION_FILE = os.path.join(DATA, "usedStations.csv")
+REFERENCE_PATH = os.path.join(DATA, "ph2dt")
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    return loadCatalog(os.path.join(DATA, "sample.out"),
+                       str(tmp_path / "cache"))
+
+
+def lineCatalog(stations):
+    """Events along a parallel at 0, 0.9, 2.7 and 6.2 km from the first,
+    with P picks of weight 0 at the given stations of each event"""
+    lons = [55.0, 55.01, 55.03, 55.07]
+    events = DataFrame([[10**9*e, lon, 37.0, 10.0, 2.0] + [0]*11
+                        for e, lon in enumerate(lons)],
+                       columns=EVENT_COLUMNS)
+    picks = DataFrame([[e, sta, "P", "P", 5.0 + e, 0, 0.5, True]
+                       for e in range(len(lons)) for sta in stations[e]],
+                      columns=PICK_COLUMNS)
+    return {"path": "", "events": events, "picks": picks}
+
+
+@pytest.mark.parametrize("weakSecond, pairs", [
+    (False, [(0, 1), (1, 2), (2, 3)]),
+    (True, [(0, 1), (0, 2), (1, 2), (2, 3)])])
+def testNeighboursFollowPh2dtRules(config, hypoddConfig, weakSecond, pairs):
+    """Neighbours are visited by separation up to MAXSEP, until MAXNGH
+    have MINLNKS links, and kept with MINOBS links, at most MAXOBS data
+    each. With three picks, the second event is a weak neighbour, so the
+    first event goes on to the third one."""
+    stations = [["STA0", "STA1", "STA2", "STA3"]]*4
+    if weakSecond:
+        stations[1] = ["STA0", "STA1", "STA2"]
+    hypoddConfig = dict(hypoddConfig, MINWGHT=0.0, MAXDIST=500, MAXSEP=5,
+                        MAXNGH=1, MINLNKS=4, MINOBS=1, MAXOBS=2)
+    obs = differentialTimes(config, hypoddConfig, lineCatalog(stations),
+                            STATION_FILE)
+    assert sorted({(min(p), max(p)) for p in zip(obs.i, obs.k)}) == pairs
+    assert (obs.groupby(["i", "k"]).size() == 2).all()
+    first = obs[(obs.i == 0) & (obs.k == 1)]
+    expected = ["STA0", "STA2"] if weakSecond else ["STA3", "STA0"]
+    assert first.sta.tolist() == expected
+
+
+def testBlockSizeDoesNotChangeOutput(config, hypoddConfig, catalog, tmp_path):
+    outputs = []
+    for blockSize in [3, 2000]:
+        dtFile = tmp_path / f"dt_{blockSize}.ct"
+        buildDifferentialTimes(config, hypoddConfig, catalog, STATION_FILE,
+                               str(dtFile), str(tmp_path / "event.dat"),
+                               blockSize)
+        outputs.append(dtFile.read_text())
+    assert outputs[0] == outputs[1]
+
+
+def testMinimumWeightAppliesToEachPick(config, hypoddConfig):
+    stations = ["STA0", "STA1", "STA2", "STA3"]
+    events = DataFrame([[0, 55.0, 37.0, 10.0, 2.0] + [0]*11,
+                        [10**9, 55.001, 37.001, 10.0, 2.0] + [0]*11],
+                       columns=EVENT_COLUMNS)
+    picks = DataFrame({"evt": [0]*4 + [1]*4,
+                       "sta": stations*2,
+                       "pha": ["P"]*8,
+                       "aph": ["P"]*8,
+                       "tt": [5.0, 6.0, 7.0, 8.0]*2,
+                       "wgt": [0, 0, 0, 0, 0, 0, 0, 3],
+                       "dis": [0.5]*8,
+                       "arr": [True]*8})
+    hypoddConfig = dict(hypoddConfig, MINWGHT=0.5, MINOBS=1, MINLNKS=1)
+    obs = differentialTimes(config, hypoddConfig,
+                            {"path": "", "events": events, "picks": picks},
+                            STATION_FILE)
+    assert sorted(obs.sta) == stations[:3]
+    assert (obs.w == 1.0).all()
+
+
+def ph2dtReference(config, hypoddConfig, path):
+    """Get ph2dt outputs, committed or made on the fly, see
+    benchmarks.Ph2dtReference"""
+    if os.path.exists(os.path.join(REFERENCE_PATH, "dt.ct")):
+        return REFERENCE_PATH
+    if realPh2dt() is None:
+        pytest.skip("ph2dt is not installed and no reference is committed, "
+                    "run python -m benchmarks.Ph2dtReference where it is")
+    path.mkdir()
+    return makeReference(config, hypoddConfig, str(path))
+
+
+def testBuiltinMatchesPh2dt(config, hypoddConfig, catalog, tmp_path):
+    refPath = ph2dtReference(config, hypoddConfig, tmp_path / "ph2dt")
+    dtFile = str(tmp_path / "dt.ct")
+    eventFile = str(tmp_path / "event.dat")
+    buildDifferentialTimes(config, hypoddConfig, catalog, STATION_FILE,
+                           dtFile, eventFile)
+    report = compareDifferentialTimes(dtFile, os.path.join(refPath, "dt.ct"))
+    assert report["pairs"] == report["refPairs"] == report["commonPairs"]
+    assert report["obs"] == report["refObs"] == report["commonObs"]
+    assert report["maxWeightDifference"] < 1e-3
+    with open(eventFile) as f, \
+            open(os.path.join(refPath, "event.dat")) as g:
+        for line, refLine in zip(f, g, strict=True):
+            fields = [float(v) for v in line.split()]
+            refFields = [float(v) for v in refLine.split()]
+            assert fields == pytest.approx(refFields, abs=1e-2)
+    obs = readDifferentialTimes(dtFile)
+    with open(os.path.join(refPath, "event.sel")) as f:
+        selected = [int(line.split()[-1]) for line in f if line.strip()]
+    assert selected == sorted(set(obs.id1) | set(obs.id2))
@@ -0,0 +1,22 @@
+import pytest
+
+from core.Config import RelocationError
+from core.Input import ITERATION_SETS, iterationSets
+
+
+def testIterationSetsFollowSchedule(hypoddConfig):
+    sets = iterationSets(hypoddConfig, crossCorrelation=True)
+    assert [s["DAMP"] for s in sets] == hypoddConfig["DAMP"]
+    assert [s["WTCCP"] for s in sets] == hypoddConfig["WTCC"]
+    assert {s["WTCCP"] for s in iterationSets(hypoddConfig)} == {-9}
+
+
+@pytest.mark.parametrize("key", ["DAMP", "WTCC"])
+@pytest.mark.parametrize("size", [len(ITERATION_SETS) - 1,
+                                  len(ITERATION_SETS) + 1])
+def testIterationSetsNeedOneValuePerSet(hypoddConfig, key, size, capsys):
+    hypoddConfig = dict(hypoddConfig, **{key: [1.0]*size})
+    with pytest.raises(RelocationError):
+        iterationSets(hypoddConfig, crossCorrelation=True)
+    assert f"+++ {key} in hypoDD configuration must have" in \
+        capsys.readouterr().out
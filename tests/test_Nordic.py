@@ -0,0 +1,40 @@
+import os
+from io import BytesIO
+
+import pytest
+from obspy import UTCDateTime, read_events
+
+from conftest import DATA
+from core.Nordic import parseNordicEvent, patchEvent
+
+ORIGIN = (2020, 1, 1, 0, 0, 1.2, 37.2, 55.3, 12.0)
+ACCURATE_ORIGIN = (2020, 1, 1, 0, 0, 1.234, 37.20123, 55.30456, 12.345)
+
+
+def sampleEvent(highAccuracy=True):
+    """First event of the sample catalog, with a type H line if asked"""
+    with open(os.path.join(DATA, "sample.out"), "rb") as f:
+        block = f.read().split(b"\n\n")[0] + b"\n\n"
+    if not highAccuracy:
+        return block
+    line = " 2020  1 1 0000  0.012  37.09012   55.00911    8.512  0.100"
+    header, rest = block.split(b"\n", 1)
+    return header + b"\n" + f"{line:<79s}H\n".encode() + rest
+
+
+@pytest.mark.parametrize("highAccuracy", [True, False])
+def testPatchedEventReadsBack(highAccuracy):
+    block = patchEvent(sampleEvent(highAccuracy), ORIGIN, 1.5, 2.5, 90,
+                       accurateOrigin=ACCURATE_ORIGIN)
+    expected = ACCURATE_ORIGIN if highAccuracy else ORIGIN
+    ort = UTCDateTime(*expected[:5]) + expected[5]
+    origin, _ = parseNordicEvent(block.decode("latin-1").splitlines(True))
+    assert origin["ORT"] == ort.ns
+    assert (origin["Lat"], origin["Lon"], origin["Dep"]) == \
+        pytest.approx(expected[6:], abs=1e-6)
+    assert origin["GAP"] == 90
+    event = read_events(BytesIO(block), format="NORDIC")[0]
+    preferred = event.preferred_origin()
+    assert preferred.time == ort
+    assert (preferred.latitude, preferred.longitude,
+            preferred.depth*1e-3) == pytest.approx(expected[6:], abs=1e-6)
@@ -0,0 +1,68 @@
+from threading import Barrier
+
+import pytest
+from pandas import read_csv
+from yaml import dump
+
+from core.Config import RelocationError
+from core.GetStationInfo import ISCProvider, StationProvider, getStationsInfo
+from core.PrepareInputs import CreatInputStationFile
+from core.StationCache import openStationCache, writeCachedStations
+
+
+@pytest.fixture
+def offlineConfig(config, tmp_path):
+    (tmp_path / "stations").mkdir()
+    with open(tmp_path / "stations" / "stationsInCatlog.yml", "w") as f:
+        dump({"catalogStations": ["STA0", "STA1"]}, f)
+    return dict(config, Stations=dict(config["Stations"], Offline=True))
+
+
+def testProvidersMustFetch():
+    with pytest.raises(TypeError):
+        StationProvider("", None)
+
+
+def testMissesAreFetchedConcurrentlyOnce(config, tmp_path, monkeypatch,
+                                         capsys):
+    codes = ["STA0", "STA1", "STA2", "NONE"]
+    barrier = Barrier(len(codes), timeout=10)
+    batches = []
+
+    def fetchBatch(self, batch):
+        batches.append(batch)
+        barrier.wait()
+        return [{"code": code, "lat": 37.0, "lon": 55.0, "elv": 0.0}
+                for code in batch if code != "NONE"]
+
+    monkeypatch.setattr(ISCProvider, "batchSize", 1)
+    monkeypatch.setattr(ISCProvider, "fetchBatch", fetchBatch)
+    config = dict(config, Stations=dict(
+        config["Stations"], Providers=["ISC"], Workers=len(codes),
+        CacheFile=str(tmp_path / "stations.sqlite")))
+    stations, missed = getStationsInfo(config, codes)
+    assert sorted(batches) == [[code] for code in sorted(codes)]
+    assert [s["code"] for s in stations] == codes[:-1]
+    assert missed == ["NONE"]
+    assert getStationsInfo(config, codes) == (stations, missed)
+    assert len(batches) == len(codes)
+    assert "+++ Found 3 stations in cache" in capsys.readouterr().out
+
+
+def testEmptyOfflineCacheStops(offlineConfig, tmp_path, capsys):
+    with pytest.raises(RelocationError):
+        CreatInputStationFile(offlineConfig, str(tmp_path))
+    assert "+++ No station metadata in cache! Aborting ..." in \
+        capsys.readouterr().out
+    assert "No station metadata in cache! Aborting ..." in \
+        (tmp_path / "results" / "running.log").read_text()
+
+
+def testOfflineCacheIsUsed(offlineConfig, tmp_path):
+    conn = openStationCache(str(tmp_path / "stations" / "stations.sqlite"))
+    writeCachedStations(conn, [{"code": "STA0", "lat": 37.0, "lon": 55.0,
+                                "elv": 100.0}], "ISC", ["STA1"])
+    conn.close()
+    CreatInputStationFile(offlineConfig, str(tmp_path))
+    stations = read_csv(tmp_path / "stations" / "usedStations.csv")
+    assert stations.code.str.strip().tolist() == ["STA0"]
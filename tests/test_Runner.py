@@ -0,0 +1,95 @@
+import os
+
+import pytest
+
+from conftest import ROOT
+from core.Runner import (ProgramError, parseIteration, readConditionNumbers,
+                         runHypoDD, runPh2dt, runProgram)
+
+EVENT_LINE = ("20200101  00000000  37.0900   55.0090     8.500  3.0   0.00"
+              "   0.00   0.00          1\n")
+PHASE_LINE = "# 2020  1  1  0  0  0.00  37.0900  55.0090  8.50  3.0  0.0  \
+0.0  0.0          1\n"
+
+
+@pytest.fixture(autouse=True)
+def standIns(monkeypatch, tmp_path):
+    """Run stand-ins of hypoDD and ph2dt from a temporary directory"""
+    monkeypatch.setenv("PATH", os.path.join(ROOT, "benchmarks", "bin") +
+                       os.pathsep + os.environ["PATH"])
+    (tmp_path / "event.dat").write_text(EVENT_LINE)
+    (tmp_path / "phase.dat").write_text(PHASE_LINE)
+
+
+def limited(config, timeout=0, maxMemoryMB=0):
+    return dict(config, Relocation=dict(config["Relocation"],
+                                        ProgramTimeout=timeout,
+                                        ProgramMaxMemoryMB=maxMemoryMB))
+
+
+def testParseIteration():
+    row = ("  1    100 100     0   213 -100.0     0    0.0   512  1373  1266"
+           "  2232   312   0   0 123")
+    assert parseIteration(row) == {"iteration": 1, "events": 100.0,
+                                   "rmsct": 213.0, "rmscc": 0.0,
+                                   "condition": 123.0}
+    assert parseIteration("  IT   EV  CT    CC    RMSCT") is None
+
+
+def testHypoDDProgress(config, tmp_path, capsys):
+    record = {}
+    progress = runHypoDD(limited(config), "chunk 1", 50, record,
+                         str(tmp_path))
+    assert [i["iteration"] for i in progress.iterations] == [1, 2, 3, 4]
+    assert {i["cluster"] for i in progress.iterations} == {1}
+    assert progress.iterations[0]["events"] == 99.0
+    assert progress.iterations[0]["rmsct"] == 200.0
+    assert progress.conditionNumbers() == [44.0]
+    assert readConditionNumbers(str(tmp_path / "hypoDD.log")) == [44.0]
+    assert "chunk 1: cluster 1, iteration 4, 48 events" in \
+        capsys.readouterr().out
+    assert record["exitCode"] == 0 and record["iterations"] == 4
+    assert (tmp_path / "hypoDD.reloc").exists()
+    assert (tmp_path / "hypoDD.out").read_text().count("\n") > 4
+
+
+def testPh2dt(config, tmp_path):
+    runPh2dt(limited(config), path=str(tmp_path))
+    assert (tmp_path / "dt.ct").read_text() == ""
+    assert (tmp_path / "event.dat").read_text().split()[-1] == "1"
+
+
+def testTimeoutKillsProgram(config, tmp_path, monkeypatch):
+    monkeypatch.setenv("HYPODD_STANDIN_SECONDS", "2")
+    record = {}
+    with pytest.raises(ProgramError) as error:
+        runHypoDD(limited(config, timeout=0.5), "chunk 1", 50, record,
+                  str(tmp_path))
+    assert error.value.reason == "timeout"
+    assert record["exitCode"] != 0
+    assert not (tmp_path / "hypoDD.reloc").exists()
+
+
+def testMemoryLimitKillsProgram(config, tmp_path, monkeypatch):
+    monkeypatch.setenv("HYPODD_STANDIN_SECONDS", "2")
+    with pytest.raises(ProgramError) as error:
+        runHypoDD(limited(config, maxMemoryMB=1), "chunk 1", 50,
+                  path=str(tmp_path))
+    assert error.value.reason == "memory"
+    assert not (tmp_path / "hypoDD.reloc").exists()
+
+
+def testExitCodeRaises(config, tmp_path, monkeypatch):
+    monkeypatch.setenv("HYPODD_STANDIN_EXIT", "3")
+    record = {}
+    with pytest.raises(ProgramError) as error:
+        runHypoDD(limited(config), "chunk 1", 50, record, str(tmp_path))
+    assert (error.value.reason, error.value.returncode) == ("exit", 3)
+    assert "stand-in asked to fail" in "".join(error.value.tail)
+    assert record["iterations"] == 4
+
+
+def testMissingProgramRaises():
+    with pytest.raises(ProgramError) as error:
+        runProgram("noSuchProgram")
+    assert error.value.reason == "missing"
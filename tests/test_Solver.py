@@ -0,0 +1,53 @@
+from itertools import combinations
+
+import pytest
+from numpy import arange, column_stack, cos, full, pi, sin, sqrt
+from numpy.random import default_rng
+from pandas import DataFrame
+
+from core.Extra import loadHypoDDRelocFile
+from core.Input import iterationSets
+from core.Solver import relocTable, solveDoubleDifference
+from core.TravelTime import loadTravelTimeTable
+
+NOISE = 0.01
+
+
+def synthetic(table):
+    """Catalog P differential times of a small cluster, with noise in s"""
+    rng = default_rng(0)
+    xyz = column_stack([rng.uniform(-1, 1, 6), rng.uniform(-1, 1, 6),
+                        full(6, 10.0)])
+    azimuth = arange(8)*pi/4
+    stations = column_stack([15.0*cos(azimuth), 15.0*sin(azimuth)])
+    distance = sqrt(((xyz[:, None, :2] - stations[None])**2).sum(axis=2))
+    times = table.lookup(full(distance.shape, 10.0).ravel(),
+                         distance.ravel(), "P")[0].reshape(distance.shape)
+    rows = [(i, k, s, times[i, s] - times[k, s])
+            for i, k in combinations(range(len(xyz)), 2)
+            for s in range(len(stations))]
+    obs = DataFrame(rows, columns=["i", "k", "s", "dt"]).assign(
+        pha="P", w=1.0, cc=False)
+    obs.dt += rng.normal(0, NOISE, len(obs))
+    return xyz, stations, obs
+
+
+def testRelocTableUsesHypoDDUnits(config, hypoddConfig, tmp_path):
+    velocity_df = DataFrame({"vp": [6.0], "depth": [0.0], "vpvs": [1.75]})
+    table = loadTravelTimeTable(velocity_df, 20.0, 30.0)
+    xyz, stations, obs = synthetic(table)
+    result = solveDoubleDifference(table, xyz, stations, obs,
+                                   iterationSets(hypoddConfig))
+    events = DataFrame({"ORT": full(len(xyz), 1577836800*10**9),
+                        "Mag": full(len(xyz), 2.0)})
+    hypodd_df = relocTable(config, {"events": events}, result)
+    assert len(hypodd_df) == len(xyz)
+    assert 0.2*NOISE*1e3 < hypodd_df.RCT.mean() < 2*NOISE*1e3
+    assert hypodd_df.RCT.values == \
+        pytest.approx(result["rct"][hypodd_df.ID.values-1]*1e3)
+    assert (hypodd_df.Z.values == result["xyz"][:, 2]*1e3).all()
+    hypodd_df.to_csv(tmp_path / "hypoDD.reloc", sep=" ", header=False,
+                     index=False, na_rep="-9")
+    reloc_df = loadHypoDDRelocFile(str(tmp_path))
+    assert list(reloc_df.columns) == list(hypodd_df.columns)
+    assert reloc_df.RCT.values == pytest.approx(hypodd_df.RCT.values)
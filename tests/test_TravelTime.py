@@ -0,0 +1,39 @@
+from numpy import array, nan
+from pandas import DataFrame
+
+from core.Extra import loadVelocityFile
+from core.TravelTime import (DEPTH_MARGIN, loadTravelTimeTable,
+                             regionTravelTimeTable, tableDepth)
+
+
+def testTableDepthCoversModelAndEvents(config):
+    velocity_df = loadVelocityFile(config)
+    deepest = velocity_df.depth.max()
+    assert tableDepth(velocity_df) >= deepest + DEPTH_MARGIN
+    assert tableDepth(velocity_df, array([5.0, nan])) == \
+        tableDepth(velocity_df)
+    assert tableDepth(velocity_df, array([150.0, nan])) >= \
+        150.0 + DEPTH_MARGIN
+    assert tableDepth(velocity_df, array([nan])) == tableDepth(velocity_df)
+
+
+def testRegionTableReachesDeepEvents(config, tmp_path):
+    config = dict(config, Region=dict(config["Region"], Radius=10.0))
+    velocity_df = loadVelocityFile(config)
+    table = regionTravelTimeTable(config, velocity_df, str(tmp_path),
+                                  array([10.0, 95.0]))
+    assert table.maxDepth >= 95.0 + DEPTH_MARGIN
+    cached = regionTravelTimeTable(config, velocity_df, str(tmp_path),
+                                   array([10.0, 99.0]))
+    assert cached.maxDepth == table.maxDepth
+    assert len(list(tmp_path.glob("traveltimes_*.npy"))) == 1
+
+
+def testHalfSpaceTimes():
+    velocity_df = DataFrame({"vp": [6.0], "depth": [0.0], "vpvs": [1.75]})
+    table = loadTravelTimeTable(velocity_df, 20.0, 30.0, spacing=0.5)
+    assert table.maxDepth == 20.0
+    times, dtdr, dtdz, _ = table.lookup(array([12.0]), array([16.0]), "P")
+    assert abs(times[0] - 20.0/6.0) < 1e-2
+    assert abs(dtdr[0] - 16.0/20.0/6.0) < 1e-2
+    assert abs(dtdz[0] - 12.0/20.0/6.0) < 1e-2